@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+
+"""
+Checks that the NumPy engine (numpy_engine.reclassify_reads, see stringmeup
+--engine numpy) reclassifies reads exactly like reclassify_read, on random
+batches of reads with ambiguous kmers ('A'), unassigned kmers ('0'), kmer
+runs of length 0, tax_ids written with leading zeros, paired reads ('|:|'),
+and with and without minimizer hit groups. The reclassifications, the
+maximum confidences and the kmer hit counts of the reads must be identical,
+and so must the report counts of numpy_engine.count_reclassified.
+
+The taxonomy is either existing files, or generated (see benchmarks.generate):
+    python -m benchmarks.check_numpy_engine --nodes nodes.dmp --names names.dmp
+    python -m benchmarks.check_numpy_engine --num_nodes 20000 --num_batches 500
+
+Exits with status 1 if any read is reclassified differently.
+"""
+
+import argparse
+import copy
+import logging
+import random
+import sys
+import tempfile
+from collections import Counter
+from os import path
+
+from benchmarks import generate
+from stringmeup import numpy_engine, stringmeup, taxonomy
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+# The confidence thresholds that the batches draw theirs from
+THRESHOLDS = [0, 0.05, 0.1, 0.2, 0.3, 0.5, 0.7, 0.9, 1.0]
+
+
+def random_kmer_string(rng, tax_ids, lineage):
+    """
+    Returns a random kmer string of one mate, with hits to the lineage of the
+    original tax_id of the read as well as to random tax_ids.
+    """
+    runs = []
+    for _ in range(rng.randint(1, 8)):
+        label = rng.random()
+        count = rng.randint(0, 6)
+        if label < 0.1:
+            tax_id = 'A'
+        elif label < 0.25:
+            tax_id = '0'
+        elif label < 0.6:
+            tax_id = str(rng.choice(lineage))
+        else:
+            tax_id = str(rng.choice(tax_ids))
+
+        # The same tax_id written in another way
+        if tax_id != 'A' and rng.random() < 0.05:
+            tax_id = '0' + tax_id
+
+        runs.append('{}:{}'.format(tax_id, count))
+
+    return ' '.join(runs)
+
+
+def random_line(rng, taxonomy_tree, tax_ids, read_number, verbose_input):
+    """
+    Returns a random line of a classified read in a Kraken 2 output file.
+    """
+    original_taxid = rng.choice(tax_ids)
+    lineage = taxonomy_tree.get_lineage([original_taxid])[original_taxid]
+    mates = 2 if rng.random() < 0.3 else 1
+    kmer_string = ' |:| '.join(random_kmer_string(rng, tax_ids, lineage) for _ in range(mates))
+
+    # Classified reads have at least one kmer that hits a taxon
+    if not any(run[0] not in 'A0|' and not run.endswith(':0') for run in kmer_string.split()):
+        kmer_string += ' {}:{}'.format(original_taxid, rng.randint(1, 6))
+
+    columns = ['C', 'read{}'.format(read_number), str(original_taxid), '|'.join(['150'] * mates)]
+    if verbose_input:
+        columns.append(str(rng.randint(0, 8)))
+    columns.append(kmer_string)
+
+    return '\t'.join(columns) + '\n'
+
+
+def differences(python_read, numpy_read):
+    """
+    Returns the fields that differ between the two reclassifications of a
+    read.
+    """
+    return [
+        field for field in ('reclassifications', 'max_confidence', 'total_kmer_hits', 'assigned_kmer_hits')
+        if getattr(python_read, field) != getattr(numpy_read, field)]
+
+
+def check_engines(nodes_filename, names_filename, num_batches, max_batch_size=40, seed=1):
+    """
+    Reclassifies num_batches random batches of reads with both engines.
+    Returns (the number of reads, the number of reads (or report counts of a
+    batch) that were reclassified differently).
+    """
+    rng = random.Random(seed)
+    taxonomy_tree = taxonomy.TaxonomyTree(nodes_filename, names_filename)
+    tax_ids = list(generate.read_parents(nodes_filename))
+    num_reads = 0
+    num_different = 0
+
+    for _ in range(num_batches):
+        verbose_input = rng.random() < 0.5
+        minimum_hit_groups = rng.randint(1, 5) if verbose_input else None
+        thresholds = sorted(set(rng.choice(THRESHOLDS) for _ in range(rng.randint(1, 3))))
+        lines = [
+            random_line(rng, taxonomy_tree, tax_ids, read_number, verbose_input)
+            for read_number in range(rng.randint(1, max_batch_size))]
+
+        python_reads = [stringmeup.create_read(line, verbose_input) for line in lines]
+        numpy_reads = copy.deepcopy(python_reads)
+        for read in python_reads:
+            stringmeup.reclassify_read(read, thresholds, taxonomy_tree, verbose_input, minimum_hit_groups)
+        numpy_engine.reclassify_reads(numpy_reads, thresholds, taxonomy_tree, verbose_input, minimum_hit_groups)
+
+        for line, python_read, numpy_read in zip(lines, python_reads, numpy_reads):
+            fields = differences(python_read, numpy_read)
+            if fields:
+                num_different += 1
+                log.error('Reclassified differently ({}) at {} with minimum hit groups {}: {}'.format(
+                    ', '.join(fields), thresholds, minimum_hit_groups, line.strip()))
+
+        # The report counts of the batch
+        batch = numpy_engine.reclassify_batch(
+            [read.original_taxid for read in python_reads],
+            [read.kmer_string for read in python_reads],
+            [read.minimizer_hit_groups for read in python_reads] if verbose_input else None,
+            thresholds,
+            taxonomy_tree,
+            verbose_input,
+            minimum_hit_groups)
+        for k, hits_at_node in enumerate(numpy_engine.count_reclassified(batch)):
+            python_hits_at_node = Counter(read.reclassifications[k].reclassified_taxid for read in python_reads)
+            if hits_at_node != python_hits_at_node:
+                num_different += 1
+                log.error('Counted differently at {}: {} instead of {}'.format(
+                    thresholds[k], hits_at_node, dict(python_hits_at_node)))
+
+        num_reads += len(lines)
+
+    return num_reads, num_different
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.check_numpy_engine',
+        description='Check that the NumPy engine reclassifies random reads exactly like reclassify_read.')
+    parser.add_argument(
+        '--nodes',
+        metavar='FILE',
+        help='Taxonomy nodes dump file (nodes.dmp). A taxonomy is generated if not given.')
+    parser.add_argument(
+        '--names',
+        metavar='FILE',
+        help='Taxonomy names dump file (names.dmp).')
+    parser.add_argument(
+        '--num_nodes',
+        metavar='INT',
+        type=int,
+        default=2000,
+        help='Number of nodes of the generated taxonomy [2000].')
+    parser.add_argument(
+        '--num_batches',
+        metavar='INT',
+        type=int,
+        default=1000,
+        help='Number of batches of up to 40 reads [1000].')
+    parser.add_argument(
+        '--seed',
+        metavar='INT',
+        type=int,
+        default=1,
+        help='Random seed [1].')
+    args = parser.parse_args()
+
+    if (args.nodes is None) != (args.names is None):
+        parser.error('--nodes and --names must be given together.')
+
+    return args
+
+
+def main():
+    args = get_arguments()
+
+    if numpy_engine.np is None:
+        log.error('NumPy is not installed.')
+        sys.exit(1)
+
+    logging.getLogger('taxonomy.py').setLevel(logging.WARNING)
+
+    if args.nodes is not None:
+        num_reads, num_different = check_engines(args.nodes, args.names, args.num_batches, seed=args.seed)
+    else:
+        with tempfile.TemporaryDirectory() as taxonomy_dir:
+            nodes, names = generate.generate_taxonomy(args.num_nodes, seed=args.seed)
+            generate.write_taxonomy(nodes, names, taxonomy_dir)
+            num_reads, num_different = check_engines(
+                path.join(taxonomy_dir, 'nodes.dmp'),
+                path.join(taxonomy_dir, 'names.dmp'),
+                args.num_batches,
+                seed=args.seed)
+
+    if num_different:
+        log.error('{} of {} reads (or batch counts) were reclassified differently by the NumPy engine.'.format(num_different, num_reads))
+        sys.exit(1)
+    log.info('All {} reads were reclassified identically by the NumPy engine.'.format(num_reads))
+
+
+if __name__ == '__main__':
+    main()
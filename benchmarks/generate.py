@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+"""
+Generators of synthetic taxonomies (nodes.dmp and names.dmp) and Kraken 2
+classification files, for benchmarking.
+
+The taxonomy is a random tree where each new node is attached to a random
+existing node (up to max_depth), which gives NCBI-like depths (the mean depth
+grows with the logarithm of the number of nodes). Ranks follow the standard
+ranks from the root and down, with "no rank", "clade" and other ranks in
+between. Tax IDs are spread out over a range a bit larger than the number of
+nodes, and nodes.dmp is sorted on tax ID, like the NCBI taxonomy.
+
+The reads of a classifications file come from a set of source taxa with Zipf
+distributed abundances. The kmers of a read hit its source taxon and (less
+often) its ancestors, other random taxa (noise), no taxon ('0') or are
+ambiguous ('A'), in runs like in Kraken 2 output.
+
+Usage:
+    python -m benchmarks.generate taxonomy --num_nodes 2500000 OUTDIR
+    python -m benchmarks.generate classifications --nodes OUTDIR/nodes.dmp --num_reads 1000000 --paired OUTFILE
+"""
+
+import argparse
+import bisect
+import itertools
+import logging
+import os
+import random
+from os import path
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+standard_ranks = ['superkingdom', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species']
+intermediate_ranks = ['no rank', 'clade', 'subphylum', 'superclass', 'subclass', 'suborder', 'superfamily', 'subfamily', 'tribe']
+below_species_ranks = ['subspecies', 'strain', 'no rank', 'serotype']
+
+KMER_SIZE = 35
+
+
+def generate_taxonomy(num_nodes, max_depth=40, intermediate_fraction=0.25, synonyms_per_node=2, common_name_fraction=0.1, seed=1):
+    """
+    Generates a random taxonomy of num_nodes nodes (including the root).
+
+    Returns (nodes, names), where nodes is a list of (tax_id, parent, rank)
+    sorted on tax_id, and names a list of (tax_id, name, name class).
+    """
+    rng = random.Random(seed)
+
+    # Sparse tax IDs, the root is always 1
+    tax_ids = [1] + rng.sample(range(2, int(num_nodes * 1.2) + 2), num_nodes - 1)
+
+    # For each node: depth and level in standard_ranks (-1 above superkingdom)
+    depths = [0]
+    levels = [-1]
+    parents = [0]
+    ranks = ['no rank']
+
+    # Nodes that can get children
+    open_nodes = [0]
+
+    for i in range(1, num_nodes):
+        parent = open_nodes[int(rng.random() * len(open_nodes))]
+        level = levels[parent]
+
+        if rng.random() < intermediate_fraction:
+            rank = rng.choice(intermediate_ranks if level < len(standard_ranks) - 1 else below_species_ranks)
+        elif level < len(standard_ranks) - 1:
+            level += 1
+            rank = standard_ranks[level]
+        else:
+            rank = rng.choice(below_species_ranks)
+
+        parents.append(parent)
+        depths.append(depths[parent] + 1)
+        levels.append(level)
+        ranks.append(rank)
+        if depths[i] < max_depth:
+            open_nodes.append(i)
+
+    nodes = sorted(
+        (tax_ids[i], tax_ids[parents[i]], ranks[i]) for i in range(num_nodes))
+
+    names = []
+    for tax_id, _, rank in nodes:
+        names.append((tax_id, '{} {}'.format(rank.capitalize(), tax_id), 'scientific name'))
+        if rng.random() < common_name_fraction:
+            names.append((tax_id, 'common {}'.format(tax_id), 'genbank common name'))
+        for k in range(synonyms_per_node):
+            names.append((tax_id, 'synonym {} of {}'.format(k, tax_id), 'synonym'))
+
+    return nodes, names
+
+
+def write_taxonomy(nodes, names, outdir):
+    """
+    Writes nodes.dmp and names.dmp (NCBI format) in outdir.
+    """
+    os.makedirs(outdir, exist_ok=True)
+
+    with open(path.join(outdir, 'nodes.dmp'), 'w') as f:
+        for tax_id, parent, rank in nodes:
+            f.write('\t|\t'.join([str(tax_id), str(parent), rank, '', '0', '1', '11', '1', '1', '1', '0', '0', '']) + '\t|\n')
+
+    with open(path.join(outdir, 'names.dmp'), 'w') as f:
+        for tax_id, name, name_class in names:
+            f.write('\t|\t'.join([str(tax_id), name, '', name_class]) + '\t|\n')
+
+
+def read_parents(nodes_filename):
+    """
+    Returns {tax_id: parent} from a nodes.dmp file.
+    """
+    parents = {}
+    with open(nodes_filename, 'r') as f:
+        for line in f:
+            tax_info = line.split('|', 2)
+            parents[int(tax_info[0])] = int(tax_info[1])
+    return parents
+
+
+class ClassificationGenerator:
+    """
+    Generates the lines of a Kraken 2 classifications file (see the module
+    docstring), from the {tax_id: parent} mapping of a taxonomy.
+
+    read_length: length of each read (of each mate, if paired).
+    minimizer_hit_groups: add the column of minimizer hit groups (6 columns).
+    num_source_taxa: number of taxa in the sample, drawn among the leaves.
+    abundance_skew: the exponent of the Zipf distribution of the abundances
+                    of the source taxa.
+    unclassified_fraction: fraction of reads without any hits.
+    ancestor_fraction, noise_fraction, unassigned_fraction,
+    ambiguous_fraction: fractions of the kmer runs of classified reads that
+                        hit an ancestor of the source taxon, a random taxon,
+                        no taxon ('0') or that are ambiguous ('A').
+    max_run_length: maximum length of a run of kmers with the same label.
+    """
+
+    def __init__(self, parents, read_length=150, paired=False, minimizer_hit_groups=False, num_source_taxa=1000, abundance_skew=1.0, unclassified_fraction=0.1, ancestor_fraction=0.2, noise_fraction=0.05, unassigned_fraction=0.15, ambiguous_fraction=0.01, max_run_length=30, seed=1):
+        self.rng = random.Random(seed)
+        self.read_length = read_length
+        self.paired = paired
+        self.minimizer_hit_groups = minimizer_hit_groups
+        self.unclassified_fraction = unclassified_fraction
+        self.max_run_length = max_run_length
+
+        # Probabilities of the labels of a kmer run, the rest hit the source
+        self._label_thresholds = list(itertools.accumulate(
+            [ambiguous_fraction, unassigned_fraction, noise_fraction, ancestor_fraction]))
+
+        self.tax_ids = list(parents)
+        has_children = set(parent for tax_id, parent in parents.items() if tax_id != parent)
+        leaves = [tax_id for tax_id in self.tax_ids if tax_id not in has_children] or self.tax_ids
+        source_taxa = self.rng.sample(leaves, min(num_source_taxa, len(leaves)))
+
+        # The lineages (without the root) of the source taxa, from the taxon
+        # and up
+        self.lineages = []
+        for tax_id in source_taxa:
+            lineage = [tax_id]
+            while parents[lineage[-1]] != lineage[-1] and parents[lineage[-1]] != 1:
+                lineage.append(parents[lineage[-1]])
+            self.lineages.append(lineage)
+
+        self._cumulative_abundances = list(itertools.accumulate(
+            1 / rank ** abundance_skew for rank in range(1, len(source_taxa) + 1)))
+
+    def _kmer_string(self, lineage):
+        """
+        Returns (kmer string of one mate, number of hit groups).
+        """
+        rng = self.rng
+        label_thresholds = self._label_thresholds
+        num_kmers = max(self.read_length - KMER_SIZE + 1, 1)
+        runs = []
+        hit_groups = 0
+
+        while num_kmers > 0:
+            run_length = min(num_kmers, rng.randint(1, self.max_run_length))
+            num_kmers -= run_length
+            label = bisect.bisect(label_thresholds, rng.random())
+
+            if label == 0:
+                tax_id = 'A'
+            elif label == 1:
+                tax_id = '0'
+            elif label == 2:
+                tax_id = rng.choice(self.tax_ids)
+            elif label == 3:
+                tax_id = lineage[min(int(rng.expovariate(0.7)) + 1, len(lineage) - 1)]
+            else:
+                tax_id = lineage[0]
+
+            if label > 1:
+                hit_groups += 1
+            runs.append('{}:{}'.format(tax_id, run_length))
+
+        return ' '.join(runs), hit_groups
+
+    def generate_line(self, read_number):
+        """
+        Returns one line (with newline) of the classifications file.
+        """
+        rng = self.rng
+        read_id = 'read{}'.format(read_number)
+        length = str(self.read_length)
+        num_kmers = max(self.read_length - KMER_SIZE + 1, 1)
+        mates = 2 if self.paired else 1
+
+        if rng.random() < self.unclassified_fraction:
+            columns = ['U', read_id, '0']
+            kmer_strings = ['0:{}'.format(num_kmers)] * mates
+            hit_groups = 0
+        else:
+            lineage = self.lineages[bisect.bisect(
+                self._cumulative_abundances, rng.random() * self._cumulative_abundances[-1])]
+            columns = ['C', read_id, str(lineage[0])]
+
+            # Classified reads have at least one kmer that hits a taxon
+            hit_groups = 0
+            while hit_groups == 0:
+                kmer_strings = []
+                for _ in range(mates):
+                    kmer_string, mate_hit_groups = self._kmer_string(lineage)
+                    kmer_strings.append(kmer_string)
+                    hit_groups += mate_hit_groups
+
+        columns.append('|'.join([length] * mates))
+        if self.minimizer_hit_groups:
+            columns.append(str(hit_groups))
+        columns.append(' |:| '.join(kmer_strings))
+
+        return '\t'.join(columns) + '\n'
+
+    def generate(self, num_reads):
+        """
+        Yields num_reads lines of the classifications file.
+        """
+        for read_number in range(num_reads):
+            yield self.generate_line(read_number)
+
+
+def write_classifications(generator, num_reads, filename):
+    """
+    Writes num_reads lines from a ClassificationGenerator to filename.
+    """
+    with open(filename, 'w') as f:
+        for line in generator.generate(num_reads):
+            f.write(line)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.generate',
+        description='Generate synthetic taxonomies and Kraken 2 classification files for benchmarking.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    taxonomy_parser = subparsers.add_parser('taxonomy', help='Generate nodes.dmp and names.dmp.')
+    taxonomy_parser.add_argument('outdir', metavar='OUTDIR', help='Directory to write nodes.dmp and names.dmp in.')
+    taxonomy_parser.add_argument('--num_nodes', metavar='INT', type=int, default=100000, help='Number of nodes in the taxonomy [100000]. The NCBI taxonomy has about 2500000.')
+    taxonomy_parser.add_argument('--max_depth', metavar='INT', type=int, default=40, help='Maximum depth of the taxonomy [40].')
+    taxonomy_parser.add_argument('--seed', metavar='INT', type=int, default=1, help='Random seed [1].')
+
+    reads_parser = subparsers.add_parser('classifications', help='Generate a Kraken 2 classifications file.')
+    reads_parser.add_argument('output', metavar='OUTFILE', help='File to write the classifications in.')
+    reads_parser.add_argument('--nodes', metavar='FILE', required=True, help='nodes.dmp of the taxonomy to draw taxa from.')
+    reads_parser.add_argument('--num_reads', metavar='INT', type=int, default=100000, help='Number of reads [100000].')
+    reads_parser.add_argument('--read_length', metavar='INT', type=int, default=150, help='Read length [150].')
+    reads_parser.add_argument('--paired', action='store_true', help='Paired reads.')
+    reads_parser.add_argument('--minimizer_hit_groups', action='store_true', help='Add the minimizer hit groups column (6 column output).')
+    reads_parser.add_argument('--num_source_taxa', metavar='INT', type=int, default=1000, help='Number of taxa in the sample [1000].')
+    reads_parser.add_argument('--abundance_skew', metavar='FLOAT', type=float, default=1.0, help='Exponent of the Zipf distribution of the abundances of the taxa [1.0].')
+    reads_parser.add_argument('--unclassified_fraction', metavar='FLOAT', type=float, default=0.1, help='Fraction of unclassified reads [0.1].')
+    reads_parser.add_argument('--noise_fraction', metavar='FLOAT', type=float, default=0.05, help='Fraction of kmer runs that hit random taxa [0.05].')
+    reads_parser.add_argument('--seed', metavar='INT', type=int, default=1, help='Random seed [1].')
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_arguments()
+
+    if args.command == 'taxonomy':
+        log.info('Generating a taxonomy with {} nodes...'.format(args.num_nodes))
+        nodes, names = generate_taxonomy(args.num_nodes, args.max_depth, seed=args.seed)
+        write_taxonomy(nodes, names, args.outdir)
+        log.info('Saved nodes.dmp and names.dmp in {}.'.format(args.outdir))
+
+    else:
+        log.info('Generating {} reads...'.format(args.num_reads))
+        generator = ClassificationGenerator(
+            read_parents(args.nodes),
+            read_length=args.read_length,
+            paired=args.paired,
+            minimizer_hit_groups=args.minimizer_hit_groups,
+            num_source_taxa=args.num_source_taxa,
+            abundance_skew=args.abundance_skew,
+            unclassified_fraction=args.unclassified_fraction,
+            noise_fraction=args.noise_fraction,
+            seed=args.seed)
+        write_classifications(generator, args.num_reads, args.output)
+        log.info('Saved the classifications in {}.'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""
+Times the stages of StringMeUp separately, and reports the time, the
+throughput and the peak resident set size (RSS) of each stage as JSON:
+
+    taxonomy_tree        TaxonomyTree construction from nodes.dmp/names.dmp
+    create_read          Parsing of the classification lines
+    process_kmer_string  process_kmer_string on the kmer strings
+    parse_kmer_string    parse_kmer_string on the kmer strings
+    reclassify_read      reclassify_read at the confidence threshold(s)
+    reclassify_numpy     numpy_engine.reclassify_reads on chunks of 10000
+                         reads (only if NumPy is installed)
+    verbose_formatting   Formatting of the --output_verbose rows
+    report               get_kraken2_report_content
+
+Each stage is run --repeat times, and the fastest run is reported. The peak
+RSS is that of the process up to and including the stage.
+
+The input is either existing files, or generated (see benchmarks.generate)
+with --generate:
+    python -m benchmarks.run --nodes nodes.dmp --names names.dmp sample.kraken2
+    python -m benchmarks.run --generate /tmp/bench --num_nodes 2500000 --num_reads 1000000 --paired
+"""
+
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from os import path
+
+from benchmarks import generate
+from stringmeup import numpy_engine, stringmeup, taxonomy
+from stringmeup.metrics import peak_rss_mib
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+
+def time_stage(function, repeat):
+    """
+    Runs function repeat times. Returns (the time of the fastest run, the
+    return value of the last run).
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def stage_result(seconds, num_items, unit):
+    return {
+        'seconds': round(seconds, 6),
+        unit: num_items,
+        '{}_per_second'.format(unit): round(num_items / seconds, 1) if seconds else None,
+        'peak_rss_mib': peak_rss_mib()}
+
+
+def run_benchmarks(nodes_filename, names_filename, classifications_filename, thresholds, minimum_hit_groups=None, repeat=3, max_reads=None):
+    """
+    Times the stages (see the module docstring) on the input files. Returns
+    the results as a dict.
+    """
+    stages = {}
+    results = {
+        'stringmeup_version': stringmeup.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'inputs': {
+            'nodes': path.abspath(nodes_filename),
+            'names': path.abspath(names_filename),
+            'classifications': path.abspath(classifications_filename),
+            'confidence_thresholds': thresholds,
+            'minimum_hit_groups': minimum_hit_groups,
+            'repeat': repeat},
+        'stages': stages}
+
+    # Taxonomy tree construction
+    log.info('Timing the taxonomy tree construction...')
+    seconds, taxonomy_tree = time_stage(
+        lambda: taxonomy.TaxonomyTree(nodes_filename=nodes_filename, names_filename=names_filename),
+        repeat)
+    stages['taxonomy_tree'] = stage_result(seconds, len(taxonomy_tree), 'nodes')
+
+    # The classification lines, read into memory so that reading the file
+    # isn't timed
+    verbose_input = stringmeup.is_verbose_input(classifications_filename)
+    paired_input = bool(stringmeup.is_paired_input(classifications_filename))
+    if not verbose_input:
+        minimum_hit_groups = None
+    elif minimum_hit_groups is None:
+        minimum_hit_groups = 1
+
+    num_lines = 0
+    lines = []
+    with stringmeup.read_file(classifications_filename) as f:
+        for line in f:
+            num_lines += 1
+            if line.startswith('C'):
+                lines.append(line)
+                if max_reads and len(lines) == max_reads:
+                    break
+    num_reads = len(lines)
+    results['inputs'].update({
+        'lines': num_lines,
+        'classified_reads': num_reads,
+        'paired': paired_input,
+        'minimizer_hit_groups': verbose_input})
+    log.info('Timing the stages on {} classified reads...'.format(num_reads))
+
+    seconds, reads = time_stage(
+        lambda: [stringmeup.create_read(line, verbose_input) for line in lines],
+        repeat)
+    stages['create_read'] = stage_result(seconds, num_reads, 'reads')
+
+    seconds, _ = time_stage(
+        lambda: [stringmeup.process_kmer_string(read.kmer_string, paired_input) for read in reads],
+        repeat)
+    stages['process_kmer_string'] = stage_result(seconds, num_reads, 'reads')
+
+    seconds, _ = time_stage(
+        lambda: [stringmeup.parse_kmer_string(read.kmer_string) for read in reads],
+        repeat)
+    stages['parse_kmer_string'] = stage_result(seconds, num_reads, 'reads')
+
+    seconds, _ = time_stage(
+        lambda: [
+            stringmeup.reclassify_read(read, thresholds, taxonomy_tree, verbose_input, minimum_hit_groups)
+            for read in reads],
+        repeat)
+    stages['reclassify_read'] = stage_result(seconds, num_reads, 'reads')
+
+    if numpy_engine.np is not None:
+        seconds, _ = time_stage(
+            lambda: [
+                numpy_engine.reclassify_reads(reads[k:k + 10000], thresholds, taxonomy_tree, verbose_input, minimum_hit_groups)
+                for k in range(0, num_reads, 10000)],
+            repeat)
+        stages['reclassify_numpy'] = stage_result(seconds, num_reads, 'reads')
+
+    # The reads are now reclassified at the first threshold. A new formatter
+    # is used for each run, so that its caches are filled in every run.
+    seconds, _ = time_stage(
+        lambda: [
+            formatter.format(read)
+            for formatter in [stringmeup.VerboseFormatter(taxonomy_tree, verbose_input)]
+            for read in reads],
+        repeat)
+    stages['verbose_formatting'] = stage_result(seconds, num_reads, 'reads')
+
+    hits_at_node = {}
+    for read in reads:
+        hits_at_node[read.reclassified_taxid] = hits_at_node.get(read.reclassified_taxid, 0) + 1
+
+    seconds, report_node_list = time_stage(
+        lambda: stringmeup.get_kraken2_report_content(
+            {'hits_at_node': hits_at_node, 'hits_at_clade': {}}, taxonomy_tree, num_lines),
+        repeat)
+    stages['report'] = stage_result(seconds, len(report_node_list), 'rows')
+    stages['report']['taxa_with_reads'] = len(hits_at_node)
+
+    return results
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Time the stages of StringMeUp and report the results as JSON.')
+    parser.add_argument('classifications', metavar='classifications', nargs='?', help='Kraken 2 classifications file (not needed with --generate).')
+    parser.add_argument('--nodes', metavar='FILE', help='Taxonomy nodes dump file (nodes.dmp).')
+    parser.add_argument('--names', metavar='FILE', help='Taxonomy names dump file (names.dmp).')
+    parser.add_argument('--confidence', metavar='THRESHOLDS', type=stringmeup.parse_confidence_thresholds, default=[0.1], help='Confidence threshold(s), as for stringmeup [0.1].')
+    parser.add_argument('--minimum_hit_groups', metavar='INT', type=int, help='Minimum hit groups, if the input has that column.')
+    parser.add_argument('--repeat', metavar='INT', type=int, default=3, help='Number of runs of each stage, the fastest is reported [3].')
+    parser.add_argument('--max_reads', metavar='INT', type=int, help='Only use the first INT classified reads of the input.')
+    parser.add_argument('--output', metavar='FILE', help='File to save the results in (JSON) [stdout].')
+    parser.add_argument('--generate', metavar='DIR', help='Generate a taxonomy and a classifications file in DIR (see benchmarks.generate) and run on those. Files that already exist are reused.')
+    parser.add_argument('--num_nodes', metavar='INT', type=int, default=100000, help='With --generate: number of nodes in the taxonomy [100000].')
+    parser.add_argument('--num_reads', metavar='INT', type=int, default=100000, help='With --generate: number of reads [100000].')
+    parser.add_argument('--paired', action='store_true', help='With --generate: paired reads.')
+    parser.add_argument('--with_minimizer_hit_groups', action='store_true', help='With --generate: add the minimizer hit groups column.')
+    parser.add_argument('--seed', metavar='INT', type=int, default=1, help='With --generate: random seed [1].')
+    args = parser.parse_args()
+
+    if args.generate is None and not (args.classifications and args.nodes and args.names):
+        parser.error('Give --nodes, --names and a classifications file, or --generate.')
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1.')
+
+    return args
+
+
+def generate_inputs(args):
+    """
+    Generates the input files in args.generate, unless they already exist.
+    Returns the filenames (nodes, names, classifications).
+    """
+    nodes_filename = path.join(args.generate, 'nodes.dmp')
+    names_filename = path.join(args.generate, 'names.dmp')
+    classifications_filename = path.join(args.generate, '{}_{}{}{}.kraken2'.format(
+        args.num_reads,
+        'paired' if args.paired else 'single',
+        '_mhg' if args.with_minimizer_hit_groups else '',
+        '_seed{}'.format(args.seed)))
+
+    if not (path.isfile(nodes_filename) and path.isfile(names_filename)):
+        log.info('Generating a taxonomy with {} nodes in {}...'.format(args.num_nodes, args.generate))
+        nodes, names = generate.generate_taxonomy(args.num_nodes, seed=args.seed)
+        generate.write_taxonomy(nodes, names, args.generate)
+
+    if not path.isfile(classifications_filename):
+        log.info('Generating {} reads in {}...'.format(args.num_reads, classifications_filename))
+        generator = generate.ClassificationGenerator(
+            generate.read_parents(nodes_filename),
+            paired=args.paired,
+            minimizer_hit_groups=args.with_minimizer_hit_groups,
+            seed=args.seed)
+        generate.write_classifications(generator, args.num_reads, classifications_filename)
+
+    return nodes_filename, names_filename, classifications_filename
+
+
+def main():
+    args = get_arguments()
+
+    if args.generate is not None:
+        nodes_filename, names_filename, classifications_filename = generate_inputs(args)
+    else:
+        nodes_filename, names_filename, classifications_filename = args.nodes, args.names, args.classifications
+
+    # Only the results, not the progress of each run, are of interest
+    logging.getLogger('stringmeup.py').setLevel(logging.WARNING)
+    logging.getLogger('taxonomy.py').setLevel(logging.WARNING)
+
+    results = run_benchmarks(
+        nodes_filename,
+        names_filename,
+        classifications_filename,
+        args.confidence,
+        args.minimum_hit_groups,
+        args.repeat,
+        args.max_reads)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        log.info('Results saved in {}.'.format(args.output))
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
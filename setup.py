@@ -19,8 +19,14 @@ setup(
         'Programming Language :: Python :: 3'
         ],
     install_requires=['dataclasses'],
+    extras_require={'numpy': ['numpy']},
     packages=find_packages(exclude=['contrib', 'docs', 'test*'], include=['stringmeup']),
     entry_points={'console_scripts': [  'stringmeup=stringmeup.stringmeup:stringmeup',
+                                        'stringmeup-build-taxonomy-cache=stringmeup.taxonomy:build_taxonomy_cache',
+                                        'stringmeup-merge-threshold-index=stringmeup.threshold_index:merge_threshold_indexes',
+                                        'stringmeup-batch=stringmeup.batch:stringmeup_batch',
+                                        'stringmeup-merge-reports=stringmeup.stringmeup:merge_reports',
+                                        'stringmeup-collect-taxids=stringmeup.stringmeup:collect_taxids',
 #                                        'kraken2-taxonomy=kraken2_confidence_recal.taxonomy:main',
 
 ]})
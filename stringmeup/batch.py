@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+
+"""
+Batch mode: runs many stringmeup jobs (samples, cutoffs) against one taxonomy
+that is loaded once, in a pool of worker processes (see stringmeup-batch).
+"""
+
+import argparse
+import logging
+import os
+import shlex
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path
+
+from stringmeup import stringmeup, taxonomy
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+# Taxonomy options that can't be given to the jobs (all but
+# --prune_taxonomy_to_input are given to stringmeup-batch instead)
+BATCH_OPTIONS = ('--names', '--nodes', '--taxonomy_k2d', '--taxonomy_cache', '--names_index', '--prune_taxonomy', '--prune_taxonomy_to_input')
+
+# A job of the manifest: the line number of the manifest and the parsed
+# stringmeup arguments
+BatchJob = namedtuple('BatchJob', ['line_number', 'args'])
+
+# The outcome of a job: status is 'ok' or 'failed', message is the (last)
+# error of a failed job
+JobResult = namedtuple('JobResult', ['line_number', 'classifications', 'status', 'seconds', 'message'])
+
+# The taxonomy tree of the worker processes
+_worker_state = {}
+
+
+class BatchException(Exception):
+    pass
+
+
+class _ErrorRecorder(logging.Handler):
+    """
+    Remembers the last error that was logged while a job ran, since stringmeup
+    logs its errors before it exits.
+    """
+
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+        self.message = None
+
+    def emit(self, record):
+        self.message = record.getMessage()
+
+
+def taxonomy_argv(args):
+    """
+    Returns the command line options of the taxonomy source of the batch
+    (--names and --nodes, or --taxonomy_k2d), which the jobs are parsed with.
+    """
+    if args.taxonomy_k2d:
+        return ['--taxonomy_k2d', args.taxonomy_k2d]
+    return ['--names', args.names, '--nodes', args.nodes]
+
+
+def read_manifest(filename, taxonomy_options):
+    """
+    Reads the jobs of a manifest. Each line holds the arguments of one
+    stringmeup run, as on the command line but without the taxonomy options
+    (--names, --nodes, --taxonomy_k2d, --taxonomy_cache, --names_index,
+    --prune_taxonomy and --prune_taxonomy_to_input), e.g.:
+        0.1,0.5 sample1.kraken2 --output_report sample1.report --output_classifications sample1.cls
+    Empty lines and lines that start with # are skipped. The jobs are parsed
+    with taxonomy_options (see taxonomy_argv) added, and without
+    abbreviations of the options, so that an abbreviated taxonomy option
+    can't get through.
+
+    Raises BatchException if a line can't be parsed.
+    """
+    jobs = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            try:
+                argv = shlex.split(line)
+            except ValueError as e:
+                raise BatchException('Line {} of the manifest "{}": {}.'.format(line_number, filename, e))
+
+            for arg in argv:
+                if arg.split('=')[0] in BATCH_OPTIONS:
+                    raise BatchException('Line {} of the manifest "{}": the taxonomy option {} can not be given to the jobs of a batch.'.format(line_number, filename, arg))
+
+            # argparse exits on errors (after printing them)
+            try:
+                args = stringmeup.get_arguments(argv + taxonomy_options, allow_abbrev=False)
+            except SystemExit:
+                raise BatchException('Line {} of the manifest "{}" could not be parsed: {}'.format(line_number, filename, line))
+
+            jobs.append(BatchJob(line_number, args))
+
+    return jobs
+
+
+def run_job(job, taxonomy_tree):
+    """
+    Runs a job with the (already loaded) taxonomy tree. Returns a JobResult.
+    """
+    recorder = _ErrorRecorder()
+    logging.getLogger().addHandler(recorder)
+    start = time.perf_counter()
+    status = 'ok'
+    message = ''
+
+    try:
+        stringmeup.run_stringmeup(job.args, taxonomy_tree)
+
+    # stringmeup exits (after logging the error) when it can't go on
+    except SystemExit as e:
+        status = 'failed'
+        message = recorder.message or 'Exited with {}.'.format(e.code)
+    except Exception as e:
+        status = 'failed'
+        message = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        logging.getLogger().removeHandler(recorder)
+
+    return JobResult(
+        job.line_number,
+        job.args.original_classifications_file,
+        status,
+        time.perf_counter() - start,
+        message)
+
+
+def _init_worker(taxonomy_tree):
+    """
+    Initializer of the worker processes (shares the taxonomy tree
+    copy-on-write when the processes are forked).
+    """
+    _worker_state['taxonomy_tree'] = taxonomy_tree
+
+
+def _run_job_worker(job):
+    return run_job(job, _worker_state['taxonomy_tree'])
+
+
+def input_size(job):
+    try:
+        return path.getsize(job.args.original_classifications_file)
+    except OSError:
+        return 0
+
+
+def run_batch(jobs, taxonomy_tree, num_workers):
+    """
+    Runs the jobs in a pool of num_workers worker processes that share the
+    taxonomy tree. The jobs with the largest input files are started first, so
+    that a large job doesn't run alone at the end of the batch. Returns the
+    JobResults in the same order as the jobs.
+    """
+    results = {}
+
+    def log_result(result):
+        log.info('Job on line {} ({}): {} in {:.1f} s.{}'.format(
+            result.line_number,
+            result.classifications,
+            result.status,
+            result.seconds,
+            ' ' + result.message if result.message else ''))
+
+    scheduled = sorted(jobs, key=input_size, reverse=True)
+
+    if num_workers == 1:
+        for job in scheduled:
+            results[job.line_number] = run_job(job, taxonomy_tree)
+            log_result(results[job.line_number])
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers, mp_context=stringmeup.fork_context(), initializer=_init_worker, initargs=(taxonomy_tree,)) as executor:
+            futures = [executor.submit(_run_job_worker, job) for job in scheduled]
+            for future in as_completed(futures):
+                result = future.result()
+                results[result.line_number] = result
+                log_result(result)
+
+    return [results[job.line_number] for job in jobs]
+
+
+def write_summary(results, filename):
+    """
+    Writes the status and timing of each job as a tab separated table.
+    """
+    with open(filename, 'w') as f:
+        f.write('line\tclassifications\tstatus\tseconds\tmessage\n')
+        for result in results:
+            f.write('{}\t{}\t{}\t{:.3f}\t{}\n'.format(
+                result.line_number,
+                result.classifications,
+                result.status,
+                result.seconds,
+                result.message.replace('\t', ' ').replace('\n', ' ')))
+
+
+def stringmeup_batch():
+    """
+    Command line entry point to run the jobs of a manifest against one
+    taxonomy.
+    """
+    parser = argparse.ArgumentParser(
+        prog='stringmeup-batch',
+        description='Run many stringmeup jobs (e.g. samples and cutoffs) listed in a manifest, loading the taxonomy only once and running the jobs in parallel.')
+    parser.add_argument(
+        'manifest',
+        metavar='MANIFEST',
+        help='File with one stringmeup job per line: the arguments of the job as on the stringmeup command line, without the taxonomy options --names, --nodes, --taxonomy_k2d, --taxonomy_cache, --names_index, --prune_taxonomy and --prune_taxonomy_to_input, and with the options spelled out in full (e.g. "0.1,0.5 sample1.kraken2 --output_report sample1.report"). Empty lines and lines starting with # are skipped.')
+    parser.add_argument(
+        '--names',
+        metavar='FILE',
+        help='Taxonomy names dump file (names.dmp)')
+    parser.add_argument(
+        '--nodes',
+        metavar='FILE',
+        help='Taxonomy nodes dump file (nodes.dmp)')
+    parser.add_argument(
+        '--taxonomy_k2d',
+        metavar='FILE',
+        help='Taxonomy file of the Kraken 2 database (taxo.k2d), instead of --names and --nodes (see stringmeup --taxonomy_k2d).')
+    parser.add_argument(
+        '--taxonomy_cache',
+        metavar='FILE',
+        help='Binary cache of the taxonomy in --names and --nodes (see stringmeup --taxonomy_cache).')
+    parser.add_argument(
+        '--names_index',
+        metavar='FILE',
+        help='Index of the names in --names (see stringmeup --names_index).')
+    parser.add_argument(
+        '--prune_taxonomy',
+        metavar='FILE',
+        help='Prune the taxonomy to the tax_ids in FILE and their ancestors (see stringmeup --prune_taxonomy).')
+    parser.add_argument(
+        '--jobs',
+        metavar='INT',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of jobs to run at the same time [number of CPUs]. Jobs that use --threads start their own worker processes in addition.')
+    parser.add_argument(
+        '--summary',
+        metavar='FILE',
+        help='File to save the status and run time of each job in (tab separated).')
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+    stringmeup.check_taxonomy_arguments(parser, args)
+
+    try:
+        jobs = read_manifest(args.manifest, taxonomy_argv(args))
+    except (OSError, BatchException) as e:
+        log.error(str(e))
+        sys.exit(1)
+    if not jobs:
+        log.error('There are no jobs in the manifest "{}".'.format(args.manifest))
+        sys.exit(1)
+
+    prune_tax_ids = None
+    if args.prune_taxonomy:
+        try:
+            prune_tax_ids = taxonomy.read_tax_id_list(args.prune_taxonomy)
+        except (OSError, taxonomy.TaxonomyTreeException) as e:
+            log.error(str(e))
+            sys.exit(1)
+
+    taxonomy_tree = stringmeup.load_taxonomy_tree(args, prune_tax_ids)
+
+    num_workers = min(args.jobs, len(jobs))
+    log.info('Running {} jobs from "{}" in {} worker(s).'.format(len(jobs), args.manifest, num_workers))
+    results = run_batch(jobs, taxonomy_tree, num_workers)
+
+    if args.summary:
+        write_summary(results, args.summary)
+        log.info('Job summary saved in {}.'.format(args.summary))
+
+    num_failed = sum(result.status != 'ok' for result in results)
+    if num_failed:
+        log.error('{} of {} jobs failed.'.format(num_failed, len(results)))
+        sys.exit(1)
+    log.info('All {} jobs finished.'.format(len(results)))
+
+
+if __name__ == '__main__':
+    stringmeup_batch()
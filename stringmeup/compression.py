@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+"""
+Opening of (possibly) compressed input files, and writing of (possibly)
+gzipped output files.
+
+The compression is detected from the magic bytes at the start of the file, not
+from the file name. gzip (including bgzip, which is multi member gzip), bz2, xz
+and zstd are supported. zstd needs either the zstd program or the zstandard
+module.
+
+Files are decompressed by an external program when one is available (e.g.
+pigz or igzip for gzip), otherwise by the Python module of the format. Either
+way, the decompression runs in a background thread that fills a bounded queue
+of blocks, so that it overlaps the processing of the decompressed data.
+
+Output files are written in batches by a background thread (see OutputWriter).
+Gzipped output is compressed batch by batch on a pool of threads, as
+independent gzip members (like pigz), which together make up a valid gzip
+file.
+"""
+
+import bz2
+import gzip
+import io
+import locale
+import logging
+import lzma
+import queue
+import shutil
+import subprocess
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+# The magic bytes at the start of files of each compression format
+MAGIC_BYTES = [
+    (b'\x1f\x8b', 'gzip'),
+    (b'BZh', 'bz2'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd')]
+
+# External programs that decompress a file to stdout, in order of preference
+EXTERNAL_DECOMPRESSORS = {
+    'gzip': [['pigz', '-dc'], ['igzip', '-dc'], ['gzip', '-dc']],
+    'bz2': [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+    'xz': [['xz', '-dc', '-T0']],
+    'zstd': [['zstd', '-dcq']]}
+
+
+# Python openers (binary mode) of each compression format
+PYTHON_DECOMPRESSORS = {
+    'gzip': lambda filename: gzip.open(filename, 'rb'),
+    'bz2': lambda filename: bz2.open(filename, 'rb'),
+    'xz': lambda filename: lzma.open(filename, 'rb')}
+if zstandard is not None:
+    PYTHON_DECOMPRESSORS['zstd'] = lambda filename: zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), closefd=True, read_across_frames=True)
+
+BLOCK_SIZE = 1 << 20
+MAX_QUEUED_BLOCKS = 16
+
+DEFAULT_COMPRESS_LEVEL = 9
+BATCH_SIZE = 4 << 20
+
+
+class CompressionException(Exception):
+    pass
+
+
+def detect_compression(filename):
+    """
+    Returns the compression format of the file ('gzip', 'bz2', 'xz' or
+    'zstd'), or None if it isn't compressed.
+    """
+    with open(filename, 'rb') as f:
+        start = f.read(max(len(magic) for magic, _ in MAGIC_BYTES))
+
+    for magic, compression in MAGIC_BYTES:
+        if start.startswith(magic):
+            return compression
+    return None
+
+
+def find_external_decompressor(compression):
+    """
+    Returns the command of the first external decompressor of the
+    compression format that is installed, or None.
+    """
+    for command in EXTERNAL_DECOMPRESSORS.get(compression, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+class DecompressorProcess:
+    """
+    Binary stream of the output of an external decompressor.
+    """
+
+    def __init__(self, command, filename):
+        self.command = command
+        self._process = subprocess.Popen(
+            command + [filename],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def read(self, size):
+        data = self._process.stdout.read(size)
+
+        # At the end of the output, make sure that the decompression worked
+        if not data:
+            _, stderr = self._process.communicate()
+            if self._process.returncode != 0:
+                raise CompressionException('{} failed: {}'.format(
+                    ' '.join(self.command), stderr.decode(errors='replace').strip()))
+        return data
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.communicate()
+
+
+class BackgroundReader(io.RawIOBase):
+    """
+    Reads a binary stream in a background thread, block by block, into a
+    bounded queue. The blocks are read from the queue as a raw binary stream.
+    The stream is closed by the background thread.
+    """
+
+    def __init__(self, stream, block_size=BLOCK_SIZE, max_queued_blocks=MAX_QUEUED_BLOCKS):
+        super().__init__()
+        self._stream = stream
+        self._block_size = block_size
+        self._queue = queue.Queue(max_queued_blocks)
+        self._stop = threading.Event()
+        self._block = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        # Wait for room in the queue, unless the reader is being closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fill(self):
+        try:
+            while True:
+                block = self._stream.read(self._block_size)
+                if not self._put(block) or not block:
+                    break
+        except Exception as e:
+            self._put(e)
+        finally:
+            self._stream.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._block and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            if not item:
+                self._eof = True
+            self._block = memoryview(item)
+
+        size = min(len(buffer), len(self._block))
+        buffer[:size] = self._block[:size]
+        self._block = self._block[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread.join()
+        super().close()
+
+
+def open_input(filename, mode='rt', background=True):
+    """
+    Opens a file for reading, decompressing it if it is compressed (see
+    detect_compression). mode is 'rt' (text) or 'rb' (binary).
+
+    With background, a compressed file is decompressed by an external program
+    if one is installed (see EXTERNAL_DECOMPRESSORS) and read in a background
+    thread (see BackgroundReader). Without, it is opened directly with the
+    Python module of its compression format if there is one, which is cheaper
+    for reading just the first few lines of a file.
+    """
+    compression = detect_compression(filename)
+
+    # There is nothing to gain from reading uncompressed files in the
+    # background
+    if compression is None:
+        stream = open(filename, 'rb')
+    elif not background and compression in PYTHON_DECOMPRESSORS:
+        stream = PYTHON_DECOMPRESSORS[compression](filename)
+    else:
+        command = find_external_decompressor(compression)
+        if command:
+            log.debug('Decompressing "{}" with {}.'.format(filename, ' '.join(command)))
+            stream = DecompressorProcess(command, filename)
+        elif compression in PYTHON_DECOMPRESSORS:
+            stream = PYTHON_DECOMPRESSORS[compression](filename)
+        else:
+            raise CompressionException('"{}" is {} compressed, but there is no program or Python module installed to decompress it with.'.format(filename, compression))
+        stream = io.BufferedReader(BackgroundReader(stream), BLOCK_SIZE)
+
+    if mode == 'rb':
+        return stream
+    return io.TextIOWrapper(stream)
+
+
+class OutputWriter:
+    """
+    Writes a file in a background thread. The written data is collected into
+    batches of (at least) batch_size bytes, that are handed to the background
+    thread through a bounded queue, so write() only blocks when the queue is
+    full.
+
+    With compress_level (0-9), each batch is gzip compressed as an independent
+    gzip member on a pool of compress_threads threads, and the members are
+    written in order.
+
+    mode is 'wt' (write str) or 'wb' (write bytes). Text is encoded in the
+    locale's preferred encoding, like a file opened with open(filename, 'w').
+    """
+
+    def __init__(self, filename, mode='wt', compress_level=None, compress_threads=1, batch_size=BATCH_SIZE):
+        self.name = filename
+        self._binary = mode == 'wb'
+        self._encoding = None if self._binary else locale.getpreferredencoding(False)
+        self._compress_level = compress_level
+        self._batch_size = batch_size
+        self._batch = []
+        self._batched_bytes = 0
+        self._num_batches = 0
+        self._error = None
+        self._handle = open(filename, 'wb')
+
+        if compress_level is not None:
+            self._pool = ThreadPoolExecutor(max_workers=compress_threads)
+        else:
+            self._pool = None
+
+        # Room for every compression thread to work on a batch, while the
+        # compressed batches before them wait to be written
+        self._queue = queue.Queue(2 * compress_threads + 2)
+        self._thread = threading.Thread(target=self._write_batches, daemon=True)
+        self._thread.start()
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+
+        size = len(data)
+        if not self._binary:
+            data = data.encode(self._encoding)
+        self._batch.append(data)
+        self._batched_bytes += len(data)
+
+        if self._batched_bytes >= self._batch_size:
+            self._flush_batch()
+
+        return size
+
+    def _flush_batch(self):
+        batch = b''.join(self._batch)
+        self._batch = []
+        self._batched_bytes = 0
+        self._num_batches += 1
+
+        if self._pool is not None:
+            batch = self._pool.submit(gzip.compress, batch, self._compress_level)
+        self._queue.put(batch)
+
+    def _write_batches(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+
+            # After an error, the batches are only taken off the queue
+            if self._error is not None:
+                continue
+
+            try:
+                if isinstance(batch, Future):
+                    batch = batch.result()
+                self._handle.write(batch)
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        if self._handle.closed:
+            return
+
+        # An empty gzip file still has one (empty) member
+        if self._batch or self._num_batches == 0:
+            self._flush_batch()
+
+        self._queue.put(None)
+        self._thread.join()
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._handle.close()
+
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+"""
+Reading and writing of confidence ladder files (see stringmeup --output_ladder
+and --from_ladder).
+
+A confidence ladder holds, for one read, the original classification and the
+ancestors along its lineage where the confidence increases, each with the
+number of kmers that hit within the clade rooted at it:
+    [(original_taxid, clade_kmer_hits), (ancestor_taxid, clade_kmer_hits), ...]
+
+Together with the total number of queried kmers and the number of assigned
+kmers, that is all that is needed to reclassify the read at any confidence
+threshold, without parsing its kmer string.
+
+File layout: the magic bytes and a flags byte, followed by records. Each record
+starts with a record type byte. Read records hold the read ID, length, kmer
+string and minimizer hit groups (to be able to write classification files),
+the kmer counts and the ladder. The end record holds the total number of lines
+in the original classifications file.
+"""
+
+import logging
+import struct
+from collections import namedtuple
+from os import path
+
+from stringmeup import compression
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+LADDER_MAGIC = b'SMUPLAD1'
+FLAG_VERBOSE_INPUT = 1
+
+RECORD_READ = b'R'
+RECORD_END = b'E'
+
+# Read record: id length, length length, kmer string length, minimizer hit
+# groups (-1 if missing), total kmer hits, assigned kmer hits, number of rungs
+READ_HEADER = struct.Struct('<HHIiIIH')
+RUNG = struct.Struct('<qI')
+END = struct.Struct('<Q')
+
+LadderRecord = namedtuple('LadderRecord', ['id', 'length', 'kmer_string', 'minimizer_hit_groups', 'total_kmer_hits', 'assigned_kmer_hits', 'ladder'])
+
+
+class LadderFileException(Exception):
+    pass
+
+
+def encode_read(read_id, length, kmer_string, minimizer_hit_groups, total_kmer_hits, assigned_kmer_hits, ladder):
+    """
+    Encodes a read record. ladder is a list of (tax_id, clade_kmer_hits).
+    """
+    read_id = read_id.encode('utf-8')
+    length = length.encode('utf-8')
+    kmer_string = kmer_string.encode('utf-8')
+    if minimizer_hit_groups is None:
+        minimizer_hit_groups = -1
+
+    record = [
+        RECORD_READ,
+        READ_HEADER.pack(len(read_id), len(length), len(kmer_string), minimizer_hit_groups, total_kmer_hits, assigned_kmer_hits, len(ladder)),
+        read_id,
+        length,
+        kmer_string]
+    record.extend(RUNG.pack(tax_id, clade_kmer_hits) for tax_id, clade_kmer_hits in ladder)
+
+    return b''.join(record)
+
+
+class LadderWriter:
+    """
+    Writes a ladder file (gzipped if filename ends with .gz). Read records
+    (from encode_read) are written as they come, and close() writes the end
+    record.
+    """
+
+    def __init__(self, filename, verbose_input, compress_level=compression.DEFAULT_COMPRESS_LEVEL, compress_threads=1):
+        self.name = filename
+        if filename.endswith('.gz'):
+            self._handle = compression.OutputWriter(filename, 'wb', compress_level, compress_threads)
+        else:
+            self._handle = compression.OutputWriter(filename, 'wb')
+        self._handle.write(LADDER_MAGIC + bytes([FLAG_VERBOSE_INPUT if verbose_input else 0]))
+
+    def write(self, records):
+        """
+        Writes encoded read records (bytes).
+        """
+        return self._handle.write(records)
+
+    def close(self, num_lines):
+        """
+        num_lines: total number of lines in the classifications file the
+        ladders were made from (classified or not).
+        """
+        self._handle.write(RECORD_END + END.pack(num_lines))
+        self._handle.close()
+
+
+class LadderReader:
+    """
+    Iterates over the read records (as LadderRecord) of a ladder file. After
+    the last record, num_lines holds the total number of lines of the original
+    classifications file.
+    """
+
+    def __init__(self, filename):
+        self.name = filename
+        self.num_lines = None
+        # Compressed ladder files are detected from their contents
+        self._handle = compression.open_input(filename, 'rb')
+
+        magic = self._handle.read(len(LADDER_MAGIC))
+        if magic != LADDER_MAGIC:
+            self._handle.close()
+            raise LadderFileException('"{}" is not a ladder file.'.format(filename))
+        flags = self._handle.read(1)[0]
+        self.verbose_input = bool(flags & FLAG_VERBOSE_INPUT)
+
+    def _read(self, size):
+        data = self._handle.read(size)
+        if len(data) != size:
+            raise LadderFileException('The ladder file "{}" is truncated.'.format(self.name))
+        return data
+
+    def __iter__(self):
+        while True:
+            record_type = self._read(1)
+
+            if record_type == RECORD_END:
+                self.num_lines = END.unpack(self._read(END.size))[0]
+                return
+
+            if record_type != RECORD_READ:
+                raise LadderFileException('Malformatted record in the ladder file "{}".'.format(self.name))
+
+            id_size, length_size, kmer_string_size, minimizer_hit_groups, total_kmer_hits, assigned_kmer_hits, num_rungs = READ_HEADER.unpack(self._read(READ_HEADER.size))
+            strings = self._read(id_size + length_size + kmer_string_size)
+            rungs = self._read(num_rungs * RUNG.size)
+
+            yield LadderRecord(
+                id=strings[:id_size].decode('utf-8'),
+                length=strings[id_size:id_size + length_size].decode('utf-8'),
+                kmer_string=strings[id_size + length_size:].decode('utf-8'),
+                minimizer_hit_groups=minimizer_hit_groups if minimizer_hit_groups >= 0 else None,
+                total_kmer_hits=total_kmer_hits,
+                assigned_kmer_hits=assigned_kmer_hits,
+                ladder=list(RUNG.iter_unpack(rungs)))
+
+    def close(self):
+        self._handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Metrics of a run (see stringmeup --metrics): wall and CPU time of the stages,
+counters, cache statistics, bytes read and written and peak memory.
+"""
+
+import json
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from os import path
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+
+def add_counts(total, part):
+    """
+    Adds the numbers in part to those in total, recursively for nested dicts
+    and lists (of the same length). Keys that are missing in total are added.
+    """
+    for key, value in (part.items() if isinstance(part, dict) else enumerate(part)):
+        if isinstance(value, (dict, list)):
+            if isinstance(total, dict) and key not in total:
+                total[key] = {} if isinstance(value, dict) else [{} for _ in value]
+            add_counts(total[key], value)
+        elif isinstance(total, dict):
+            total[key] = total.get(key, 0) + value
+        else:
+            total[key] += value
+
+
+def peak_rss_mib(who='self'):
+    """
+    Returns the peak RSS in MiB of this process (who='self') or of its
+    largest terminated child process (who='children'), or None if it is not
+    available on this platform.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == 'self' else resource.RUSAGE_CHILDREN)
+
+    # In bytes on macOS, in KiB elsewhere
+    if sys.platform == 'darwin':
+        return round(usage.ru_maxrss / (1 << 20), 1)
+    return round(usage.ru_maxrss / (1 << 10), 1)
+
+
+def children_cpu_seconds():
+    """
+    Returns the CPU time (user + system) of the terminated child processes
+    (e.g. the worker processes of --threads), or None if it is not available.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return round(usage.ru_utime + usage.ru_stime, 6)
+
+
+def hit_rate(hits, misses):
+    if hits + misses == 0:
+        return None
+    return round(hits / (hits + misses), 6)
+
+
+class RunMetrics:
+    """
+    Collects the metrics of a run, and saves them as JSON.
+
+    stages: {stage: {'wall_seconds': float, 'cpu_seconds': float}}. Stages
+            that run per chunk of reads (possibly in worker processes) only
+            have the wall time, summed over the chunks.
+    counters: {name: int}
+    thresholds: one dict of counters per confidence threshold.
+    caches, bytes: {name: ...}
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = {}
+        self.thresholds = []
+        self.caches = {}
+        self.bytes = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that adds the wall and CPU time (of this process) of
+        the code it wraps to the stage.
+        """
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            stage = self.stages.setdefault(name, {'wall_seconds': 0, 'cpu_seconds': 0})
+            stage['wall_seconds'] += time.perf_counter() - wall_start
+            stage['cpu_seconds'] += time.process_time() - cpu_start
+
+    def add_chunk(self, chunk_metrics):
+        """
+        Adds the metrics of a chunk of reads (see stringmeup.reclassify_lines):
+        {'counters': {...}, 'thresholds': [{...}, ...], 'seconds': {...}}.
+        """
+        add_counts(self.counters, chunk_metrics['counters'])
+        if not self.thresholds:
+            self.thresholds = [{} for _ in chunk_metrics['thresholds']]
+        add_counts(self.thresholds, chunk_metrics['thresholds'])
+        for name, seconds in chunk_metrics['seconds'].items():
+            stage = self.stages.setdefault(name, {'wall_seconds': 0})
+            stage['wall_seconds'] += seconds
+
+    def to_dict(self):
+        return {
+            'stages': {
+                name: {key: round(seconds, 6) for key, seconds in stage.items()}
+                for name, stage in self.stages.items()},
+            'worker_cpu_seconds': children_cpu_seconds(),
+            'counters': self.counters,
+            'thresholds': self.thresholds,
+            'caches': self.caches,
+            'bytes': self.bytes,
+            'peak_rss_mib': {
+                'main': peak_rss_mib('self'),
+                'workers': peak_rss_mib('children')}}
+
+    def save(self, filename, **extra):
+        """
+        Saves the metrics (and any extra items) as JSON in filename.
+        """
+        content = dict(extra)
+        content.update(self.to_dict())
+        with open(filename, 'w') as f:
+            json.dump(content, f, indent=2)
+            f.write('\n')
+        log.info('Metrics saved in {}.'.format(filename))
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+Reclassification of a batch of reads at once with NumPy (see stringmeup
+--engine numpy), with the same results as reclassify_read.
+
+The kmer strings of the batch are tokenized into CSR arrays: the kmer hits of
+read r are hit_nodes[read_offsets[r]:read_offsets[r + 1]] (node indices of the
+taxonomy tree) with hit_counts. The lineages of all reads are then walked up
+together, one level per step, and each hit is given the step at which it
+enters the clade of the read's current node (see climb_lineages). The clade
+hits of a read at any step are the sum of the counts of its hits that entered
+at that step or before, so the lowest ancestor that meets a threshold can be
+picked for all reads of the batch at once.
+
+NumPy is optional: numpy_engine.np is None if it is not installed.
+"""
+
+import logging
+import weakref
+from collections import namedtuple
+from os import path
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+# The kmer hits of a batch of reads in CSR form (see tokenize_kmer_strings).
+# hit_tax_ids and hit_counts hold the hits to tax_ids in the database (not 0),
+# total_kmer_hits and assigned_kmer_hits are per read.
+KmerHits = namedtuple('KmerHits', ['read_offsets', 'hit_tax_ids', 'hit_counts', 'total_kmer_hits', 'assigned_kmer_hits'])
+
+# The reclassification of a batch of reads (see reclassify_batch): arrays
+# with one item per read. The new_taxids (0 for unclassified reads),
+# classified, original_confidences and new_confidences fields hold one array
+# per confidence threshold.
+BatchReclassification = namedtuple('BatchReclassification', ['total_kmer_hits', 'assigned_kmer_hits', 'max_confidences', 'new_taxids', 'classified', 'original_confidences', 'new_confidences'])
+
+# The arrays of a taxonomy tree as NumPy arrays, per tree
+_tree_arrays = weakref.WeakKeyDictionary()
+
+_SPACE, _COLON, _AMBIGUOUS, _PAIR_DELIMITER, _ZERO = (ord(c) for c in ' :A|0')
+
+
+def _get_tree_arrays(taxonomy_tree):
+    """
+    Returns the NodeArrays of the taxonomy tree as NumPy arrays (views of the
+    arrays of the tree, where possible).
+    """
+    if taxonomy_tree not in _tree_arrays:
+        node_arrays = taxonomy_tree.get_node_arrays()
+        index = node_arrays.index
+        _tree_arrays[taxonomy_tree] = node_arrays._replace(
+            index=index if isinstance(index, dict) else np.asarray(index),
+            **{name: np.asarray(getattr(node_arrays, name)) for name in ('tax_ids', 'parents', 'depths', 'entries', 'exits')})
+    return _tree_arrays[taxonomy_tree]
+
+
+def _parse_ints(data, starts, ends):
+    """
+    Parses the unsigned decimal integers in data[starts[k]:ends[k]] (data is
+    a uint8 array of ASCII). Raises ValueError if a field is empty or not a
+    number.
+    """
+    lengths = ends - starts
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    if lengths.min() < 1:
+        raise ValueError('Empty field in a kmer string.')
+
+    # Each digit times 10 to the power of its place in its field, added up
+    # per field
+    field_ends = np.cumsum(lengths)
+    field_offsets = field_ends - lengths
+    positions = np.arange(int(field_ends[-1]))
+    places = np.repeat(field_ends, lengths) - positions - 1
+    digits = data[np.repeat(starts - field_offsets, lengths) + positions].astype(np.int64) - _ZERO
+    if ((digits < 0) | (digits > 9)).any():
+        raise ValueError('Invalid number in a kmer string.')
+
+    return np.add.reduceat(digits * 10 ** places, field_offsets)
+
+
+def tokenize_kmer_strings(kmer_strings):
+    """
+    Tokenizes the kmer strings (last column of a Kraken 2 output file) of a
+    batch of reads into KmerHits, with the same numbers as parse_kmer_string:
+    ambiguous kmers ("A:N") and the "|:|" delimiter of paired data are
+    skipped, and kmers that hit tax_id 0 only count towards total_kmer_hits.
+    """
+    data = np.frombuffer((' '.join(kmer_strings) + ' ').encode('ascii'), dtype=np.uint8)
+
+    # The reads' kmer strings start after each other, with a space between
+    string_lengths = np.fromiter(map(len, kmer_strings), dtype=np.int64, count=len(kmer_strings))
+    string_starts = np.cumsum(string_lengths + 1) - (string_lengths + 1)
+
+    # The tokens ("tax_id:count") are the runs between spaces
+    token_ends = np.flatnonzero(data == _SPACE)
+    token_starts = np.concatenate(([0], token_ends[:-1] + 1))
+    non_empty = token_ends > token_starts
+    token_starts = token_starts[non_empty]
+    token_ends = token_ends[non_empty]
+
+    # Every token has exactly one colon
+    colons = np.flatnonzero(data == _COLON)
+    if len(colons) != len(token_starts) or ((colons <= token_starts) | (colons >= token_ends)).any():
+        raise ValueError('Malformatted kmer string: every kmer should be written as tax_id:count.')
+
+    first_characters = data[token_starts]
+    counted = (first_characters != _AMBIGUOUS) & (first_characters != _PAIR_DELIMITER)
+    token_reads = np.searchsorted(string_starts, token_starts[counted], side='right') - 1
+    tax_ids = _parse_ints(data, token_starts[counted], colons[counted])
+    counts = _parse_ints(data, colons[counted] + 1, token_ends[counted])
+
+    num_reads = len(kmer_strings)
+    total_kmer_hits = np.bincount(token_reads, weights=counts, minlength=num_reads).astype(np.int64)
+
+    assigned = tax_ids != 0
+    hit_reads = token_reads[assigned]
+    hit_counts = counts[assigned]
+    assigned_kmer_hits = np.bincount(hit_reads, weights=hit_counts, minlength=num_reads).astype(np.int64)
+    read_offsets = np.concatenate(([0], np.cumsum(np.bincount(hit_reads, minlength=num_reads))))
+
+    return KmerHits(read_offsets, tax_ids[assigned], hit_counts, total_kmer_hits, assigned_kmer_hits)
+
+
+def lookup_nodes(taxonomy_tree, tax_ids):
+    """
+    Returns the node indices of the tax_ids. Raises KeyError (as the taxonomy
+    tree does) for the first tax_id that is not in the tree.
+    """
+    index = _get_tree_arrays(taxonomy_tree).index
+
+    if isinstance(index, dict):
+        unique_tax_ids, inverse = np.unique(tax_ids, return_inverse=True)
+        nodes = np.array([index.get(tax_id, -1) for tax_id in unique_tax_ids.tolist()], dtype=np.int64)[inverse]
+    else:
+        in_range = (tax_ids >= 0) & (tax_ids < len(index))
+        nodes = np.full(len(tax_ids), -1, dtype=np.int64)
+        nodes[in_range] = index[tax_ids[in_range]]
+
+    missing = np.flatnonzero(nodes < 0)
+    if len(missing):
+        taxonomy_tree.get_dfs_interval(int(tax_ids[missing[0]]))
+
+    return nodes
+
+
+def climb_lineages(taxonomy_tree, original_nodes, hit_reads, hit_nodes):
+    """
+    Walks up the lineages of all reads at once. Returns, for each hit, the
+    number of steps up from the read's original node to the lowest ancestor
+    whose clade holds the hit (-1 if no ancestor does).
+    """
+    tree = _get_tree_arrays(taxonomy_tree)
+    hit_entries = tree.entries[hit_nodes]
+    hit_steps = np.full(len(hit_nodes), -1, dtype=np.int64)
+    current_nodes = original_nodes.copy()
+    pending = np.arange(len(hit_nodes))
+    step = 0
+
+    while len(pending):
+        nodes = current_nodes[hit_reads[pending]]
+        entries = hit_entries[pending]
+        inside = (tree.entries[nodes] <= entries) & (entries < tree.exits[nodes])
+        hit_steps[pending[inside]] = step
+        pending = pending[~inside]
+
+        # One step up for the reads with hits outside their current clade,
+        # except at the root
+        reads = hit_reads[pending]
+        parents = tree.parents[current_nodes[reads]]
+        has_parent = parents >= 0
+        current_nodes[reads[has_parent]] = parents[has_parent]
+        pending = pending[has_parent]
+        step += 1
+
+    return hit_steps
+
+
+def reclassify_batch(original_taxids, kmer_strings, minimizer_hit_groups, confidence_thresholds, taxonomy_tree, verbose_input, minimum_hit_groups):
+    """
+    Reclassifies a batch of reads, given as their original tax_ids, kmer
+    strings and (with verbose_input) minimizer hit groups, at the confidence
+    thresholds (a list). Returns a BatchReclassification, with the same
+    results as reclassify_read gives for each read.
+    """
+    num_reads = len(kmer_strings)
+    tree = _get_tree_arrays(taxonomy_tree)
+    kmer_hits = tokenize_kmer_strings(kmer_strings)
+    total_kmer_hits = kmer_hits.total_kmer_hits
+    if (total_kmer_hits == 0).any():
+        raise ZeroDivisionError('A read has no (non-ambiguous) kmers.')
+
+    original_nodes = lookup_nodes(taxonomy_tree, np.asarray(original_taxids, dtype=np.int64))
+    hit_reads = np.repeat(np.arange(num_reads), np.diff(kmer_hits.read_offsets))
+    hit_nodes = lookup_nodes(taxonomy_tree, kmer_hits.hit_tax_ids)
+    hit_steps = climb_lineages(taxonomy_tree, original_nodes, hit_reads, hit_nodes)
+
+    # The rungs of the reads' confidence ladders: the steps where the clade
+    # hits increase, in (read, step) order, with the clade hits at each
+    keep = (hit_steps >= 0) & (kmer_hits.hit_counts > 0)
+    hit_reads = hit_reads[keep]
+    hit_steps = hit_steps[keep]
+    order = np.lexsort((hit_steps, hit_reads))
+    rung_keys = hit_reads[order] * (int(hit_steps.max(initial=0)) + 1) + hit_steps[order]
+    rung_keys, rung_starts = np.unique(rung_keys, return_index=True)
+    step_hits = np.add.reduceat(kmer_hits.hit_counts[keep][order], rung_starts) if len(rung_starts) else np.zeros(0, dtype=np.int64)
+    rung_reads = hit_reads[order][rung_starts]
+    rung_steps = hit_steps[order][rung_starts]
+
+    # Cumulative clade hits within each read
+    cumulative_hits = np.cumsum(step_hits)
+    first_rungs = np.unique(rung_reads, return_index=True)[1]
+    read_first_rung = np.full(num_reads, -1, dtype=np.int64)
+    read_first_rung[rung_reads[first_rungs]] = first_rungs
+    rung_hits = cumulative_hits - (cumulative_hits[first_rungs] - step_hits[first_rungs])[np.searchsorted(first_rungs, np.arange(len(rung_reads)), side='right') - 1]
+
+    # The confidences (as floats, like reclassify_read) at the original node,
+    # at the rungs and at the root
+    total_floats = total_kmer_hits.astype(np.float64)
+    rung_confidences = rung_hits / total_floats[rung_reads]
+    original_hits = np.zeros(num_reads, dtype=np.int64)
+    at_original = rung_steps == 0
+    original_hits[rung_reads[at_original]] = rung_hits[at_original]
+    original_confidences = original_hits / total_floats
+    max_confidences = kmer_hits.assigned_kmer_hits / total_floats
+    last_confidences = original_confidences.copy()
+    np.maximum.at(last_confidences, rung_reads, rung_confidences)
+
+    # The first non-zero confidence along the lineage, which is the original
+    # confidence of reads that move up from an original node without hits
+    has_rungs = read_first_rung >= 0
+    first_nonzero_confidences = original_confidences.copy()
+    no_original_hits = has_rungs & (original_hits == 0)
+    first_nonzero_confidences[no_original_hits] = rung_confidences[read_first_rung[no_original_hits]]
+
+    if verbose_input:
+        failed_hit_groups = np.asarray(minimizer_hit_groups, dtype=np.int64) < minimum_hit_groups
+    else:
+        failed_hit_groups = np.zeros(num_reads, dtype=bool)
+
+    batch = BatchReclassification(total_kmer_hits, kmer_hits.assigned_kmer_hits, max_confidences, [], [], [], [])
+    for threshold in confidence_thresholds:
+        can_classify = ~failed_hit_groups & (max_confidences >= threshold)
+
+        # The lowest rung at or above the threshold (the original node is
+        # a rung of all reads)
+        steps = np.full(num_reads, -1, dtype=np.int64)
+        new_confidences = last_confidences.copy()
+        met = np.flatnonzero(rung_confidences >= threshold)
+        met_reads, first_met = np.unique(rung_reads[met], return_index=True)
+        steps[met_reads] = rung_steps[met[first_met]]
+        new_confidences[met_reads] = rung_confidences[met[first_met]]
+        at_original = original_confidences >= threshold
+        steps[at_original] = 0
+        new_confidences[at_original] = original_confidences[at_original]
+
+        classified = can_classify & (steps >= 0)
+        new_nodes = original_nodes.copy()
+        for step in range(int(steps.max(initial=0))):
+            moving = classified & (steps > step)
+            new_nodes[moving] = tree.parents[new_nodes[moving]]
+        new_taxids = np.where(classified, tree.tax_ids[new_nodes], 0)
+
+        threshold_original_confidences = np.where(classified & (steps == 0), original_confidences, first_nonzero_confidences)
+        threshold_original_confidences[~can_classify] = original_confidences[~can_classify]
+        new_confidences[~can_classify] = max_confidences[~can_classify]
+
+        batch.new_taxids.append(new_taxids)
+        batch.classified.append(classified)
+        batch.original_confidences.append(threshold_original_confidences)
+        batch.new_confidences.append(new_confidences)
+
+    return batch
+
+
+def reclassify_reads(reads, confidence_thresholds, taxonomy_tree, verbose_input, minimum_hit_groups):
+    """
+    Reclassifies the reads (instances of ReadClassification) at the
+    confidence thresholds (a list), with the same results as reclassify_read:
+    read.reclassifications, the regular fields (from the first threshold),
+    read.max_confidence, read.total_kmer_hits and read.assigned_kmer_hits are
+    set. The confidence ladders of the reads (read.ladder) are not.
+
+    Returns the reads.
+    """
+    # Avoid a circular import (stringmeup imports this module)
+    from stringmeup.stringmeup import Reclassification, set_reclassification
+
+    if not reads:
+        return reads
+
+    batch = reclassify_batch(
+        [read.original_taxid for read in reads],
+        [read.kmer_string for read in reads],
+        [read.minimizer_hit_groups for read in reads] if verbose_input else None,
+        confidence_thresholds,
+        taxonomy_tree,
+        verbose_input,
+        minimum_hit_groups)
+
+    reclassifications = [
+        map(Reclassification, new_taxids.tolist(), classified.tolist(), original_confidences.tolist(), new_confidences.tolist())
+        for new_taxids, classified, original_confidences, new_confidences in zip(
+            batch.new_taxids, batch.classified, batch.original_confidences, batch.new_confidences)]
+
+    for read, read_reclassifications, total, assigned, max_confidence in zip(
+            reads,
+            zip(*reclassifications),
+            batch.total_kmer_hits.tolist(),
+            batch.assigned_kmer_hits.tolist(),
+            batch.max_confidences.tolist()):
+        read.total_kmer_hits = total
+        read.assigned_kmer_hits = assigned
+        read.max_confidence = max_confidence
+        read.reclassifications = list(read_reclassifications)
+        set_reclassification(read, read.reclassifications[0])
+
+    return reads
+
+
+def count_reclassified(batch):
+    """
+    Returns the number of reads at each tax_id (0 for unclassified), at each
+    threshold of a BatchReclassification: one hits_at_node dict per
+    threshold.
+    """
+    hits_at_node_list = []
+    for new_taxids in batch.new_taxids:
+        tax_ids, counts = np.unique(new_taxids, return_counts=True)
+        hits_at_node_list.append(dict(zip(tax_ids.tolist(), counts.tolist())))
+    return hits_at_node_list
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+"""
+Reclassification of reads from Python code, in the same process: a
+Reclassifier is set up once with a taxonomy tree and the settings, and can
+then be called with any number of batches of reads, without the command line,
+temporary files or loading the taxonomy again.
+
+    taxonomy_tree = taxonomy.TaxonomyTree(nodes_filename, names_filename)
+    reclassifier = Reclassifier(taxonomy_tree, [0.1, 0.5])
+    with open(classifications_filename) as f:
+        reads = reclassifier.reclassify_lines(f)
+    reclassifier.write_report('sample_0.1.report', 0)
+"""
+
+import logging
+from array import array
+from collections import Counter, namedtuple
+from os import path
+
+from stringmeup import stringmeup
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+# The reclassified reads of a batch, in the order they were given (the
+# unclassified lines given to reclassify_lines are skipped). The new_taxids,
+# original_confidences, new_confidences and distances fields hold one array
+# per confidence threshold. A new tax_id of 0 means that the read is
+# unclassified at the threshold, and its distance is then -1.
+ReclassifiedReads = namedtuple('ReclassifiedReads', ['read_ids', 'original_taxids', 'max_confidences', 'new_taxids', 'original_confidences', 'new_confidences', 'distances'])
+
+
+class ReclassifierException(Exception):
+    pass
+
+
+class ReportCounts:
+    """
+    The number of reads at each tax_id at each confidence threshold, added
+    up over batches of reads, for Kraken 2 style reports. total_reads counts
+    all reads, also those that were unclassified in the input, so that the
+    report has the same percentages as one of the whole input file.
+    """
+
+    def __init__(self, num_thresholds):
+        self.total_reads = 0
+        self.hits_at_node = [Counter() for _ in range(num_thresholds)]
+
+    def add(self, reclassified_reads, num_unclassified=0):
+        """
+        Adds the reads of a ReclassifiedReads, and num_unclassified reads
+        that were unclassified in the input.
+        """
+        for hits_at_node, new_taxids in zip(self.hits_at_node, reclassified_reads.new_taxids):
+            hits_at_node.update(new_taxids)
+        self.total_reads += len(reclassified_reads.read_ids) + num_unclassified
+
+    def add_unclassified(self, num_reads):
+        """
+        Adds reads that were unclassified in the input (and therefore not
+        reclassified).
+        """
+        self.total_reads += num_reads
+
+    def merge(self, other):
+        """
+        Adds the counts of another ReportCounts (of the same thresholds), e.g.
+        of a Reclassifier in another process.
+        """
+        if len(other.hits_at_node) != len(self.hits_at_node):
+            raise ReclassifierException('Can not merge report counts of {} and {} confidence thresholds.'.format(len(self.hits_at_node), len(other.hits_at_node)))
+        for hits_at_node, other_hits_at_node in zip(self.hits_at_node, other.hits_at_node):
+            hits_at_node.update(other_hits_at_node)
+        self.total_reads += other.total_reads
+
+    def tax_reads(self, k=0):
+        """
+        Returns the counts at threshold number k as a tax_reads dict (see
+        stringmeup.get_kraken2_report_content).
+        """
+        return {'hits_at_node': dict(self.hits_at_node[k]), 'hits_at_clade': {}}
+
+    def get_report(self, taxonomy_tree, k=0):
+        """
+        Returns the rows of the report at threshold number k, as a list of
+        stringmeup.ReportNode (see stringmeup.format_kraken2_report_row).
+        """
+        return stringmeup.get_kraken2_report_content(self.tax_reads(k), taxonomy_tree, self.total_reads)
+
+    def write_report(self, taxonomy_tree, output_report, k=0):
+        """
+        Writes the report at threshold number k to the file output_report, or
+        to stdout if it is None.
+        """
+        stringmeup.make_kraken2_report(self.tax_reads(k), taxonomy_tree, self.total_reads, output_report)
+
+
+class Reclassifier:
+    """
+    Reclassifies reads at one or more confidence thresholds, in the same way
+    as stringmeup, and adds them up for reports (see ReportCounts).
+
+    confidence_thresholds: a threshold, or a list of thresholds.
+    verbose_input:         the reads come with minimizer hit groups (from the
+                           forked Kraken 2, see README).
+    minimum_hit_groups:    the minimum number of minimizer hit groups of a
+                           classified read (needs verbose_input).
+    profile_cache_size:    the number of read hit profiles to cache the
+                           reclassification of (see stringmeup.ProfileCache).
+    """
+
+    def __init__(self, taxonomy_tree, confidence_thresholds, verbose_input=False, minimum_hit_groups=None, profile_cache_size=0):
+        if isinstance(confidence_thresholds, (list, tuple)):
+            thresholds = [float(threshold) for threshold in confidence_thresholds]
+        else:
+            thresholds = [float(confidence_thresholds)]
+
+        if not thresholds:
+            raise ReclassifierException('No confidence thresholds were given.')
+        for threshold in thresholds:
+            if not 0 <= threshold <= 1:
+                raise ReclassifierException('The confidence threshold must be between 0 and 1, was {}.'.format(threshold))
+
+        if minimum_hit_groups and not verbose_input:
+            raise ReclassifierException('minimum_hit_groups needs reads with minimizer hit groups (verbose_input).')
+
+        self.taxonomy_tree = taxonomy_tree
+        self.thresholds = thresholds
+        self.verbose_input = verbose_input
+
+        # As in stringmeup: reads with minimizer hit groups always have at
+        # least 1
+        self.minimum_hit_groups = (minimum_hit_groups or 1) if verbose_input else None
+
+        self.profile_cache = stringmeup.ProfileCache(profile_cache_size) if profile_cache_size else None
+        self.counts = ReportCounts(len(thresholds))
+        self._depths = {0: None}
+        self._taxa_kmer_dict = {}
+
+    def _get_depth(self, tax_id):
+        if tax_id not in self._depths:
+            self._depths[tax_id] = self.taxonomy_tree.get_depth([tax_id])[tax_id]
+        return self._depths[tax_id]
+
+    def _reclassify_reads(self, reads):
+        """
+        Reclassifies the reads (instances of stringmeup.ReadClassification)
+        at all thresholds. Returns a ReclassifiedReads.
+        """
+        num_thresholds = len(self.thresholds)
+        reclassified_reads = ReclassifiedReads(
+            read_ids=[],
+            original_taxids=array('q'),
+            max_confidences=array('d'),
+            new_taxids=[array('q') for _ in range(num_thresholds)],
+            original_confidences=[array('d') for _ in range(num_thresholds)],
+            new_confidences=[array('d') for _ in range(num_thresholds)],
+            distances=[array('i') for _ in range(num_thresholds)])
+
+        for read in reads:
+            stringmeup.reclassify_read(
+                read,
+                self.thresholds,
+                self.taxonomy_tree,
+                self.verbose_input,
+                self.minimum_hit_groups,
+                self.profile_cache,
+                taxa_kmer_dict=self._taxa_kmer_dict)
+
+            reclassified_reads.read_ids.append(read.id)
+            reclassified_reads.original_taxids.append(read.original_taxid)
+            reclassified_reads.max_confidences.append(read.max_confidence)
+            original_depth = self._get_depth(read.original_taxid)
+
+            for k, reclassification in enumerate(read.reclassifications):
+                new_taxid = reclassification.reclassified_taxid
+                reclassified_reads.new_taxids[k].append(new_taxid)
+                reclassified_reads.original_confidences[k].append(reclassification.original_conf)
+                reclassified_reads.new_confidences[k].append(reclassification.recalculated_conf)
+
+                # The reclassified tax_id is an ancestor of the original one
+                reclassified_reads.distances[k].append(original_depth - self._get_depth(new_taxid) if new_taxid else -1)
+
+        return reclassified_reads
+
+    def reclassify_lines(self, lines):
+        """
+        Reclassifies the reads in lines of a Kraken 2 output file (e.g. an
+        open file, or a list of lines). Unclassified lines are not
+        reclassified, and are not in the returned ReclassifiedReads, but are
+        counted in the report.
+        """
+        num_unclassified = 0
+        reads = []
+        for line in lines:
+            if line.startswith('C'):
+                reads.append(stringmeup.create_read(line, self.verbose_input))
+            elif line.strip():
+                num_unclassified += 1
+
+        reclassified_reads = self._reclassify_reads(reads)
+        self.counts.add(reclassified_reads, num_unclassified)
+        return reclassified_reads
+
+    def reclassify_batch(self, records):
+        """
+        Reclassifies classified reads given as records of (read_id,
+        original_taxid, kmer_string), or (read_id, original_taxid,
+        kmer_string, minimizer_hit_groups) with verbose_input. The kmer
+        string is that of the Kraken 2 output. Returns a ReclassifiedReads.
+        """
+        reads = []
+        for record in records:
+            read = stringmeup.ReadClassification(
+                original_taxid=int(record[1]),
+                id=record[0],
+                kmer_string=record[2])
+            if self.verbose_input:
+                read.minimizer_hit_groups = int(record[3])
+            reads.append(read)
+
+        reclassified_reads = self._reclassify_reads(reads)
+        self.counts.add(reclassified_reads)
+        return reclassified_reads
+
+    def get_report(self, k=0):
+        """
+        Returns the rows of the report of all reads so far at threshold
+        number k (see ReportCounts.get_report).
+        """
+        return self.counts.get_report(self.taxonomy_tree, k)
+
+    def write_report(self, output_report, k=0):
+        """
+        Writes the report of all reads so far at threshold number k to the
+        file output_report, or to stdout if it is None.
+        """
+        self.counts.write_report(self.taxonomy_tree, output_report, k)
+
+    def reset_counts(self):
+        """
+        Starts the report counts over, e.g. for the next sample.
+        """
+        self.counts = ReportCounts(len(self.thresholds))
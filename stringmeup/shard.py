@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+Byte ranges of uncompressed classifications files, so that parts of a file
+can be read by several processes at once (see stringmeup --shard, and
+--threads on uncompressed input).
+
+A byte range [start, end) holds the lines that start in it: a line that
+starts before end is read to its end, and a line that starts before start
+belongs to the range before it. Every line of the file is therefore in
+exactly one of a set of adjacent ranges, whatever their boundaries.
+"""
+
+import argparse
+import io
+import locale
+import logging
+from collections import namedtuple
+from os import path
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+# Bytes of the input file per chunk of lines
+CHUNK_BYTES = 4 << 20
+
+# Shard number (1 to count) of count shards
+Shard = namedtuple('Shard', ['number', 'count'])
+
+
+def parse_shard(shard_string):
+    """
+    Parses the --shard argument, "i/N" (the ith of N shards, 1 <= i <= N).
+    """
+    try:
+        number, count = [int(x) for x in shard_string.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid shard: "{}", it should be i/N (e.g. 1/4).'.format(shard_string))
+
+    if not 1 <= number <= count:
+        raise argparse.ArgumentTypeError(
+            'Invalid shard: "{}", i must be between 1 and N.'.format(shard_string))
+
+    return Shard(number, count)
+
+
+def shard_byte_range(file_size, shard):
+    """
+    Returns the byte range (start, end) of the file that the shard holds. The
+    N shards of a file hold about the same number of bytes each.
+    """
+    start = file_size * (shard.number - 1) // shard.count
+    end = file_size * shard.number // shard.count
+    return start, end
+
+
+def split_byte_range(start, end, chunk_bytes=CHUNK_BYTES):
+    """
+    Splits the byte range [start, end) into adjacent ranges of (at most)
+    chunk_bytes bytes.
+    """
+    return [(chunk_start, min(chunk_start + chunk_bytes, end)) for chunk_start in range(start, end, chunk_bytes)]
+
+
+def read_byte_range(f_handle, start, end):
+    """
+    Returns the bytes of the lines that start in the byte range [start, end)
+    of a file opened in binary mode.
+    """
+    # Skip the end of a line that started before the range (if start is at
+    # the start of a line, this only reads the newline before it)
+    if start > 0:
+        f_handle.seek(start - 1)
+        start += len(f_handle.readline()) - 1
+    if start >= end:
+        return b''
+
+    f_handle.seek(start)
+    data = f_handle.read(end - start)
+
+    # The last line starts in the range, but may end after it
+    if data and not data.endswith(b'\n'):
+        data += f_handle.readline()
+
+    return data
+
+
+def read_lines(filename, start, end):
+    """
+    Returns the lines that start in the byte range [start, end) of the file,
+    as when the file is read in text mode (see compression.open_input): in
+    the locale's preferred encoding, with universal newlines.
+    """
+    with open(filename, 'rb') as f:
+        data = read_byte_range(f, start, end)
+    return list(io.StringIO(data.decode(locale.getpreferredencoding(False)), newline=None))
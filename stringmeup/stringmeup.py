@@ -3,11 +3,13 @@
 __version__ = "0.1.4"
 
 import argparse
-import operator
 import logging
-import gzip
+import multiprocessing
 import sys
-from stringmeup import taxonomy
+import time
+from stringmeup import compression, ladder, metrics, numpy_engine, shard, taxonomy, threshold_index
+from collections import Counter, OrderedDict, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass
 from os import path
 
@@ -17,7 +19,6 @@ logging.basicConfig(
     datefmt='%Y-%m-%d [%H:%M:%S]')
 log = logging.getLogger(path.basename(__file__))
 
-# TODO: make sure confidence_threshold is between 0 and 1
 # TODO: For the verbose output, also output (1) the number of kmers that hit in total, (2) the number of non-ambiguous kmers (queried).
 
 
@@ -39,6 +40,22 @@ class ReadClassification:
     classified: bool = False
     max_confidence = None
     minimizer_hit_groups = None
+    reclassifications = None
+    total_kmer_hits = None
+    assigned_kmer_hits = None
+    ladder = None
+
+
+# The outcome of reclassifying a read at one confidence threshold
+Reclassification = namedtuple('Reclassification', ['reclassified_taxid', 'classified', 'original_conf', 'recalculated_conf'])
+
+# The outcome of reclassifying a chunk of lines from the input file. The
+# hits_at_node, classification_rows and verbose_rows fields hold one item per
+# confidence threshold. metrics is None unless --metrics is used.
+ChunkResult = namedtuple('ChunkResult', ['num_lines', 'hits_at_node', 'classification_rows', 'verbose_rows', 'ladder_records', 'threshold_index', 'cache_hits', 'cache_misses', 'metrics'])
+
+# Holds the taxonomy tree and settings of a worker process (see --threads)
+_worker_state = {}
 
 
 @dataclass
@@ -53,6 +70,131 @@ class ReportNode:
     offset: int
 
 
+class ProfileCache:
+    """
+    Bounded LRU cache of reclassification results, keyed on the hit profile
+    of a read: its original tax_id, whether it failed the minimum hit groups,
+    its total number of queried kmers and its (aggregated) kmer hits per
+    tax_id. Reads with the same hit profile are always reclassified the same
+    way (for the same confidence thresholds), which is common in amplicon,
+    host-depleted and clonal samples.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns the cached value for key, or None.
+        """
+        try:
+            value = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._cache.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Caches value for key, evicting the least recently used entry if the
+        cache is full.
+        """
+        self._cache[key] = value
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class VerboseFormatter:
+    """
+    Formats the rows of the output_verbose file. A row holds the tab
+    separated columns: read ID, read length, (minimizer hit groups, with
+    verbose_input,) distance from the original to the reclassified tax_id,
+    original and reclassified tax_id, original, recalculated and maximum
+    confidence, original and reclassified rank code, original and
+    reclassified name, and the kmer string. Unclassified reads have the
+    reclassified tax_id 0, rank code U, name unclassified and distance NaN.
+
+    The original and reclassified tax_ids of the reads are drawn from a small
+    set of tax_ids. Their columns (tax_ids, rank codes, names and the distance
+    between them) are therefore rendered once per pair of tax_ids, from the
+    tax_id, rank code, name and depth of each tax_id, which are looked up in
+    the taxonomy tree the first time the tax_id is seen.
+
+    The reclassified tax_id is always an ancestor of the original one, so the
+    distance between them is the difference of their depths.
+    """
+
+    def __init__(self, taxonomy_tree, verbose_input):
+        self.taxonomy_tree = taxonomy_tree
+        self.verbose_input = verbose_input
+        self.hits = 0
+        self.misses = 0
+        self._taxa = {}
+        self._pairs = {}
+
+    def _get_taxon(self, tax_id):
+        """
+        Returns (tax_id, rank code, name, depth) of the tax_id, with the first
+        three as strings.
+        """
+        if tax_id not in self._taxa:
+            self._taxa[tax_id] = (
+                str(tax_id),
+                self.taxonomy_tree.get_formatted_rank_code([tax_id])[tax_id],
+                self.taxonomy_tree.get_name([tax_id])[tax_id],
+                self.taxonomy_tree.get_depth([tax_id])[tax_id])
+        return self._taxa[tax_id]
+
+    def _get_pair(self, original_taxid, reclassified_taxid):
+        """
+        Returns the columns of a pair of tax_ids that come before and after
+        the confidences in a row.
+        """
+        pair = (original_taxid, reclassified_taxid)
+        if pair in self._pairs:
+            self.hits += 1
+        else:
+            self.misses += 1
+            original = self._get_taxon(original_taxid)
+
+            # TaxonomyTree doesn't cope with tax_id=0
+            if reclassified_taxid:
+                reclassified = self._get_taxon(reclassified_taxid)
+                distance = str(original[3] - reclassified[3])
+            else:
+                reclassified = ('0', 'U', 'unclassified')
+                distance = 'NaN'
+
+            self._pairs[pair] = (
+                '\t'.join([distance, original[0], reclassified[0]]),
+                '\t'.join([original[1], reclassified[1], original[2], reclassified[2]]))
+
+        return self._pairs[pair]
+
+    def format(self, read):
+        """
+        Formats the row of a read (instance of ReadClassification).
+        """
+        before_confidences, after_confidences = self._get_pair(read.original_taxid, read.reclassified_taxid)
+        confidences = '{0:.2f}\t{1:.2f}\t{2:.2f}'.format(
+            read.original_conf, read.recalculated_conf, read.max_confidence)
+
+        if self.verbose_input:
+            row_items = [read.id, read.length, str(read.minimizer_hit_groups), before_confidences, confidences, after_confidences, read.kmer_string]
+        else:
+            row_items = [read.id, read.length, before_confidences, confidences, after_confidences, read.kmer_string]
+
+        return '\t'.join(row_items) + '\n'
+
+
 def validate_input_file(putative_classifications_file, verbose_input, minimum_hit_groups, paired_input):
     """
     Perform simple validation of the input file.
@@ -184,7 +326,148 @@ def process_kmer_string(kmer_info_string, paired_input):
     return taxa_kmer_dict
 
 
-def reclassify_read(read, confidence_threshold, taxonomy_tree, verbose_input, minimum_hit_groups, taxa_lineages, paired_input):
+def parse_kmer_string(kmer_info_string, taxa_kmer_dict=None):
+    """
+    Parses a kmer info string (last column of a Kraken 2 output file) in one
+    pass. Ambiguous kmers ("A:N") and the "|:|" delimiter of paired data are
+    skipped, and the kmer hits are summed per (int) tax_id as they are read.
+
+    Returns (total_kmer_hits, assigned_kmer_hits, taxa_kmer_dict), where
+    total_kmer_hits is the number of kmers that were queried against the
+    database (non-ambiguous), assigned_kmer_hits the number of kmers that hit
+    a tax_id in the database (not 0), and taxa_kmer_dict maps those tax_ids
+    to their kmer hits. The numbers are the same as from process_kmer_string.
+
+    If a dict is given as taxa_kmer_dict, it is cleared and filled instead of
+    a new one, so that one dict can be reused for many reads.
+    """
+    if taxa_kmer_dict is None:
+        taxa_kmer_dict = {}
+    else:
+        taxa_kmer_dict.clear()
+
+    total_kmer_hits = 0
+    for kmer_info in kmer_info_string.split():
+        tax_id, _, num_kmers = kmer_info.partition(':')
+        if tax_id == 'A' or tax_id == '|':
+            continue
+        num_kmers = int(num_kmers)
+        total_kmer_hits += num_kmers
+        tax_id = int(tax_id)
+        if tax_id:
+            taxa_kmer_dict[tax_id] = taxa_kmer_dict.get(tax_id, 0) + num_kmers
+
+    return total_kmer_hits, sum(taxa_kmer_dict.values()), taxa_kmer_dict
+
+
+def climb_lineage(taxonomy_tree, original_taxid, taxa_kmer_dict, total_kmer_hits, max_threshold):
+    """
+    Walks up the taxonomy from original_taxid and sums the number of kmers
+    that hit within the clade rooted at each node. Stops at the first node
+    where the confidence (clade_kmer_hits / total_kmer_hits) is at or above
+    max_threshold, or at the root.
+
+    Returns the confidence ladder of the read: the original node and each
+    ancestor where the clade kmer hits increase, as a list of
+    (tax_id, clade_kmer_hits). The confidence at any node on the way is that of
+    the closest rung below (or at) it.
+    """
+    # The position of each tax_id in the depth first numbering of the
+    # taxonomy, together with the number of kmers that hit it. A tax_id is in
+    # the clade rooted at a node if its position is within the interval of
+    # the node (see TaxonomyTree.get_dfs_interval).
+    taxa_outside_clade = [
+        (taxonomy_tree.get_dfs_interval(tax_id)[0], num_hits)
+        for tax_id, num_hits in taxa_kmer_dict.items()]
+
+    # The nr of kmers that hit within the clade rooted at the current node:
+    num_hits_within_clade = 0
+    current_node = original_taxid
+    ladder = []
+
+    while True:
+        clade_start, clade_end = taxonomy_tree.get_dfs_interval(current_node)
+        taxa_still_outside = []
+
+        # For each tax_id that kmers in the read were assigned to, that wasn't
+        # in the clade rooted at any of the nodes below the current node:
+        for position, num_hits in taxa_outside_clade:
+
+            # If the tax_id is in the clade rooted at current_node, we add the
+            # kmers that hit tax_id to the total hits at the clade. There is
+            # no need to check it again in future iterations since it will
+            # always be in the clade rooted at current_node (we only ever go
+            # up in the taxonomy).
+            if clade_start <= position < clade_end:
+                num_hits_within_clade += num_hits
+            else:
+                taxa_still_outside.append((position, num_hits))
+
+        taxa_outside_clade = taxa_still_outside
+
+        if not ladder or num_hits_within_clade > ladder[-1][1]:
+            ladder.append((current_node, num_hits_within_clade))
+
+        # Stop when the confidence is high enough, or if the current node is
+        # the root (can't go higher up in the taxonomy).
+        if num_hits_within_clade / total_kmer_hits >= max_threshold or current_node == 1:
+            return ladder
+
+        # Otherwise, set the current_node to the parent and keep going.
+        current_node = taxonomy_tree.get_parent([current_node])[current_node]
+
+
+def resolve_ladder(ladder, total_kmer_hits, assigned_kmer_hits, thresholds, failed_hit_groups):
+    """
+    Reclassifies a read from its confidence ladder (see climb_lineage), at each
+    of the confidence thresholds. Returns a list with one Reclassification per
+    threshold.
+
+    The read is classified to the first node where the confidence is at or
+    above the threshold. Its original confidence is the first non-zero
+    confidence along the lineage up to that node.
+
+    Reads that can't achieve a confidence high enough (the confidence at the
+    root, max_confidence, is below the threshold), or that have too few
+    minimizer hit groups, are unclassified and keep the confidence of the
+    originally classified node as their original confidence.
+
+    If the threshold isn't met even at the root, the read is unclassified.
+    """
+    max_confidence = assigned_kmer_hits / total_kmer_hits
+    confidences = [clade_kmer_hits / total_kmer_hits for _, clade_kmer_hits in ladder]
+    reclassifications = []
+
+    for threshold in thresholds:
+        if failed_hit_groups or max_confidence < threshold:
+            reclassifications.append(Reclassification(
+                reclassified_taxid=0,
+                classified=False,
+                original_conf=confidences[0],
+                recalculated_conf=max_confidence))
+            continue
+
+        for rung, conf in enumerate(confidences):
+            if conf >= threshold:
+                reclassifications.append(Reclassification(
+                    reclassified_taxid=ladder[rung][0],
+                    classified=True,
+                    original_conf=confidences[0] if confidences[0] or rung == 0 else confidences[1],
+                    recalculated_conf=conf))
+                break
+
+        # The threshold wasn't met, even at the root
+        else:
+            reclassifications.append(Reclassification(
+                reclassified_taxid=0,
+                classified=False,
+                original_conf=confidences[0] if confidences[0] or len(confidences) == 1 else confidences[1],
+                recalculated_conf=confidences[-1]))
+
+    return reclassifications
+
+
+def reclassify_read(read, confidence_threshold, taxonomy_tree, verbose_input, minimum_hit_groups, profile_cache=None, full_ladder=False, taxa_kmer_dict=None):
     """
     Sums the number of kmers that hit in the clade rooted at "current_node",
     and divides it with the total number of kmers queried against the database:
@@ -194,261 +477,257 @@ def reclassify_read(read, confidence_threshold, taxonomy_tree, verbose_input, mi
     step up the taxonomy (to the parent node) and recalculates the confidence.
     This is repeated until confidence >= confidence_threshold.
 
+    confidence_threshold can also be a list of thresholds. The read is then
+    only walked up the taxonomy once, and the node it lands on is recorded for
+    every threshold in read.reclassifications (one Reclassification per
+    threshold, in the same order as the list). The regular fields of the read
+    are set from the first threshold in the list.
+
+    The confidence ladder of the walk (see climb_lineage) is saved in
+    read.ladder. With full_ladder, the read is walked all the way to the root
+    so that the ladder can be used to reclassify it at any threshold.
+
+    If a ProfileCache is given, reads with a hit profile that has been seen
+    before get the cached reclassifications instead of being walked up the
+    taxonomy. The cache must only be used with one set of thresholds.
+
+    taxa_kmer_dict is an optional dict to parse the kmer string into (see
+    parse_kmer_string), reused from read to read.
+
     In this function it's envisionable to include other parameters for the
     classification... Right now I'm only considering the confidence score
     and minimum hit groups.
     """
-    # Process the kmer string into a dict of {tax_id: #kmers} key, value pairs
-    taxa_kmer_dict = process_kmer_string(read.kmer_string, paired_input)
-
-    # Make the current node the same as the original classification
-    read.current_node = read.original_taxid
-
-    # The total number of kmers that were interrogated against the
-    # database (non-ambiguous):
-    total_kmer_hits = sum(taxa_kmer_dict.values())
+    if isinstance(confidence_threshold, list):
+        thresholds = confidence_threshold
+    else:
+        thresholds = [confidence_threshold]
 
-    # Only interested in tax_ids that are in the database. A '0' signifies that
-    # the kmer could not be assigned to any tax_id (missing from database).
-    assigned_taxa_set = set(
-        [tax_id for tax_id in taxa_kmer_dict.keys() if tax_id != 0])
+    # Process the kmer string into a dict of {tax_id: #kmers} key, value
+    # pairs. Only interested in tax_ids that are in the database, so a '0'
+    # (the kmer could not be assigned to any tax_id, missing from database)
+    # is only part of the total number of kmers that were interrogated
+    # against the database (non-ambiguous).
+    total_kmer_hits, total_hits, taxa_kmer_dict = parse_kmer_string(read.kmer_string, taxa_kmer_dict)
+    read.total_kmer_hits = total_kmer_hits
+    read.assigned_kmer_hits = total_hits
 
     # Make a quick check to see if it is even possible to obtain the confidence
     # needed to make a classification. If it isn't we don't have to go through
     # the hassle of calculating the confidence at all parent nodes. Potentially
     # saving us a lot of time.
-    doomed_to_fail = False
-    total_hits = sum(taxa_kmer_dict[tax_id] for tax_id in assigned_taxa_set)
     max_confidence = total_hits / total_kmer_hits
     read.max_confidence = max_confidence
 
-    # The read can't achieve a confidence high enough, so we mark it
-    if max_confidence < confidence_threshold:
-        doomed_to_fail = True
-
     # Filter minimizer_hit_groups
-    if verbose_input:
-        if read.minimizer_hit_groups < minimum_hit_groups:
-            doomed_to_fail = True
+    failed_hit_groups = verbose_input and read.minimizer_hit_groups < minimum_hit_groups
+
+    # Has a read with the same hit profile been reclassified before?
+    if profile_cache is not None:
+        profile = (read.original_taxid, failed_hit_groups, total_kmer_hits, frozenset(taxa_kmer_dict.items()))
+        cached = profile_cache.get(profile)
+        if cached is not None:
+            reclassifications, read.ladder = cached
+
+    if profile_cache is None or cached is None:
+        # How far up the taxonomy we need to go: until the highest threshold
+        # that the read can achieve is met. If the read can't achieve any of
+        # the thresholds, we only need the confidence at the original node.
+        if full_ladder:
+            max_threshold = float('inf')
+        else:
+            max_threshold = 0
+            for threshold in thresholds:
+                if not failed_hit_groups and max_confidence >= threshold:
+                    max_threshold = max(max_threshold, threshold)
 
-    # The nr of kmers that hit within the clade rooted at the current node:
-    num_hits_within_clade = 0
+        read.ladder = climb_lineage(taxonomy_tree, read.original_taxid, taxa_kmer_dict, total_kmer_hits, max_threshold)
+        reclassifications = resolve_ladder(read.ladder, total_kmer_hits, total_hits, thresholds, failed_hit_groups)
 
-    while not read.classified:
-        taxa_in_clade = set()
+        if profile_cache is not None:
+            profile_cache.put(profile, (reclassifications, read.ladder))
 
-        # For each tax_id that kmers in the read were assigned to:
-        for tax_id in assigned_taxa_set:
+    read.current_node = read.ladder[-1][0]
+    if isinstance(confidence_threshold, list):
+        read.reclassifications = reclassifications
+    set_reclassification(read, reclassifications[0])
 
-            # Get the lineage (all ancestors including itself) for the tax_id:
-            if tax_id in taxa_lineages:
-                lineage = taxa_lineages[tax_id]
-            else:
-                lineage = taxonomy_tree.get_lineage([tax_id])[tax_id]
-
-                # Save lineage so we don't have to get it from taxonomy_tree
-                # more than once. Also make it into a set, which is faster to
-                # query (the order of tax_ids in the lineage is not important
-                # here).
-                taxa_lineages[tax_id] = set(lineage)
-
-            # If the currently classified (read.current_node) tax_id is in the
-            # lineage (parents) of tax_id, then tax_id must be in the clade
-            # rooted at read.current_node - i.e. tax_id is a descendant of
-            # current_node.
-            if read.current_node in lineage:
-
-                # There is no need to get the lineage of tax_id in future
-                # iterations since it will always be in the clade rooted at
-                # read.current_node (we only ever go up in the taxonomy).
-                # Remember which tax_ids we have counted, so we can remove them
-                # from the set, outside of the loop:
-                taxa_in_clade.add(tax_id)
-
-                # Instead, we just add the kmers that hit tax_id to the total
-                # hits at the clade:
-                num_hits_within_clade += taxa_kmer_dict[tax_id]
-
-        # Remove the already counted tax_ids:
-        if taxa_in_clade:
-            assigned_taxa_set -= taxa_in_clade
-
-        # The confidence value for the read pair classification at the current
-        # taxonomic level:
-        read.recalculated_conf = num_hits_within_clade / total_kmer_hits
-
-        # Set the original confidence score
-        if not read.original_conf:
-            read.original_conf = read.recalculated_conf
-
-            # If we can't achieve the confidence score cutoff, now is the time
-            # to exit the loop and return the read (since we have calculated
-            # the original confidence).
-            if doomed_to_fail:
-                read.recalculated_conf = max_confidence
-                read.reclassified_taxid = 0
-                return read, taxa_lineages
-
-        # If the confidence at this node is sufficient, we classify it to
-        # the current node (TaxID).
-        if read.recalculated_conf >= confidence_threshold:
-            read.classified = True
-            read.reclassified_taxid = read.current_node
-            return read, taxa_lineages
-
-        # If the current node is the root, we stop (can't go higher up in the
-        # taxonomy).
-        elif read.current_node == 1:
-            read.reclassified_taxid = 0
-            return read, taxa_lineages
+    return read
 
-        # Otherwise, set the current_node to the parent and keep going.
-        else:
-            read.current_node = taxonomy_tree.get_parent(
-                [read.current_node])[read.current_node]
+
+def reclassify_ladder_record(record, confidence_threshold, verbose_input, minimum_hit_groups):
+    """
+    Reclassifies a read from a ladder file (record is an instance of
+    ladder.LadderRecord), without parsing its kmer string. Returns an instance
+    of ReadClassification, reclassified in the same way as by reclassify_read.
+    """
+    if isinstance(confidence_threshold, list):
+        thresholds = confidence_threshold
+    else:
+        thresholds = [confidence_threshold]
+
+    read = ReadClassification(
+        original_taxid=record.ladder[0][0],
+        id=record.id,
+        length=record.length,
+        kmer_string=record.kmer_string)
+    read.minimizer_hit_groups = record.minimizer_hit_groups
+    read.total_kmer_hits = record.total_kmer_hits
+    read.assigned_kmer_hits = record.assigned_kmer_hits
+    read.max_confidence = record.assigned_kmer_hits / record.total_kmer_hits
+    read.ladder = record.ladder
+
+    failed_hit_groups = verbose_input and read.minimizer_hit_groups < minimum_hit_groups
+    reclassifications = resolve_ladder(read.ladder, read.total_kmer_hits, read.assigned_kmer_hits, thresholds, failed_hit_groups)
+
+    if isinstance(confidence_threshold, list):
+        read.reclassifications = reclassifications
+    set_reclassification(read, reclassifications[0])
+
+    return read
 
 
-def read_kraken_output():
+def set_reclassification(read, reclassification):
     """
-    This should work to read classifications from a kraken 2 output file. It's
-    not complete, but the backbone is there. The point is, we should not have
-    to run reclassification in order to produce a report file - we shuold be
-    able to just read an output file and work with the classifications as they
-    are. Could also just modify the main loop.
+    Sets the fields of the read (instance of ReadClassification) from the
+    reclassification (instance of Reclassification) at one threshold.
     """
-    tax_dict = {'hits_at_node': {}, 'hits_at_clade': {}}
+    read.reclassified_taxid = reclassification.reclassified_taxid
+    read.classified = reclassification.classified
+    read.original_conf = reclassification.original_conf
+    read.recalculated_conf = reclassification.recalculated_conf
+
+
+def read_kraken_output(f_handle, report_frequency, chunk_bytes=compression.BLOCK_SIZE):
+    """
+    Counts the classified reads per tax_id in a kraken 2 output file, opened
+    in binary mode, for a report of the classifications as they are (see
+    --report_only). Only column 1 (C/U) and column 3 (the tax_id) of the
+    lines are looked at, so no ReadClassification is created and no kmer
+    string is parsed.
+
+    Returns a tax_reads dict, and the number of lines in the file.
+    """
+    hits_per_field = Counter()
     i = 0
-    with open('Ki-1974-23-291.kraken2', 'r') as f:
-        for line in f:
-            if line.startswith('C'):
-                l = line.strip().split('\t')
-                tax_id = int(l[2])
-                if tax_id not in tax_dict['hits_at_node']:
-                    tax_dict['hits_at_node'][tax_id] = 1
-                else:
-                    tax_dict['hits_at_node'][tax_id] += 1
-            i += 1
-            if i % report_frequency == 0:
-                print('Processed {} lines'.format(i))
+    for lines in iter(lambda: f_handle.readlines(chunk_bytes), []):
+        hits_per_field.update([line.split(b'\t', 3)[2] for line in lines if line.startswith(b'C')])
+
+        # Keep track of progress
+        i += len(lines)
+        if i // report_frequency > (i - len(lines)) // report_frequency:
+            log.info('Processed {} reads...'.format(i))
+
+    # The same tax_id could be written in different ways (e.g. with leading
+    # zeros), so the counts are added up
+    tax_dict = {'hits_at_node': {}, 'hits_at_clade': {}}
+    hits_at_node = tax_dict['hits_at_node']
+    for field, hits in hits_per_field.items():
+        tax_id = int(field)
+        hits_at_node[tax_id] = hits_at_node.get(tax_id, 0) + hits
+
+    return tax_dict, i
+
+
+def report_from_classifications(taxonomy_tree, args, report_frequency, run_metrics):
+    """
+    Outputs a report of the classifications in the classifications file as
+    they are, without reclassifying any reads (--report_only).
+    """
+    with compression.open_input(args.original_classifications_file, 'rb', background=True) as f:
+        log.info('Counting read classifications in "{file}".'.format(file=path.abspath(args.original_classifications_file)))
+        with run_metrics.stage('count_classifications'):
+            tax_reads, num_lines = read_kraken_output(f, report_frequency)
+
+    log.info('Done counting reads. They were {} in total.'.format(num_lines))
+    run_metrics.counters['lines'] = num_lines
+    run_metrics.counters['classified_input_reads'] = sum(tax_reads['hits_at_node'].values())
+    run_metrics.counters['unclassified_input_reads'] = num_lines - run_metrics.counters['classified_input_reads']
+
+    with run_metrics.stage('report'):
+        make_kraken2_report(tax_reads, taxonomy_tree, num_lines, args.output_report)
 
 
 def get_kraken2_report_content(tax_reads, taxonomy_tree, total_reads):
     """
     First calculates the cumulative clade read count (i.e. for each node, how
-    many reads are classified to the clades rooted at that node).
+    many reads are classified to the clades rooted at that node). Only the
+    nodes with reads and their ancestors are visited (see
+    TaxonomyTree.get_clade_counts).
 
     Then, sorts the nodes in the order they will be printed in the report file.
     The sorting works like this: perform a depth first search of the taxonomy,
     starting at the root. At each node, continue with the depth first seach
     in the order of highest to lowest cumulative clade read counts among the
-    child nodes.
-
-    There is probably a way of merging the internal functions dfs_ccrc and
-    dfs_sort, but I was in a hurry and this is what it is.
+    child nodes (children with the same count in the order of the taxonomy).
+    Only the clades with reads are visited, and the search uses an explicit
+    stack so that deep taxonomies don't hit the recursion limit.
 
-    total_reads: total reads in the kraken output file.
+    total_reads: total reads in the kraken output file (may be 0, e.g. for a
+                 shard without lines, then all ratios are 0).
     """
     report_node_list = []
+    hits_at_node = tax_reads['hits_at_node']
 
-    # Depth First Search, cumulative clade read count
-    def dfs_ccrc(visited_nodes, taxonomy_tree, node_taxid):
-        if node_taxid not in visited_nodes:
-            visited_nodes.add(node_taxid)
-
-            # The cumulative clade read count for the clade rooted at current
-            # node will start at the number of hits at that node:
-            if node_taxid in tax_reads['hits_at_node']:
-                hits_at_node = tax_reads['hits_at_node'][node_taxid]
-            else:
-                hits_at_node = 0
-            clade_read_count = hits_at_node
-
-            # Recursively search the children in the clade rooted at the
-            # current node:
-            for child in taxonomy_tree.get_children([node_taxid])[node_taxid]:
-                clade_read_count += dfs_ccrc(visited_nodes, taxonomy_tree, child)
+    # Cumulative clade read counts, for the tax_ids with reads (tax_id 0 holds
+    # the reads that were unclassified) and their ancestors:
+    log.info('Calculating cumulative clade read counts...')
+    hits_at_clade = taxonomy_tree.get_clade_counts({
+        tax_id: hits for tax_id, hits in hits_at_node.items()
+        if hits and tax_id in taxonomy_tree})
+    tax_reads['hits_at_clade'].update(hits_at_clade)
 
-            # Only save the node if its clade read count is !=0:
-            if clade_read_count > 0:
-                tax_reads['hits_at_clade'][node_taxid] = clade_read_count
+    # The children with reads of each node. The clade counts are in depth
+    # first order, so the children come in the same order as in the taxonomy.
+    log.info('Sorting the order of the output in the report file...')
+    parents = taxonomy_tree.get_parent(list(hits_at_clade))
+    children_with_reads = {}
+    for tax_id, parent in parents.items():
+        if parent is not None:
+            children_with_reads.setdefault(parent, []).append(tax_id)
 
-            return clade_read_count  # This return ends up in the above for loop
+    # Rank codes and names of all nodes that go into the report
+    rank_tuples = taxonomy_tree.get_rank_code(list(hits_at_clade))
+    names = taxonomy_tree.get_name(list(hits_at_clade))
 
-    # Depth First Search, sorting for the hierarchy of the output report.
+    # Depth first search, sorting for the hierarchy of the output report.
     # Moves down the tree and adds the nodes with highest cumulative clade
-    # read count to report_node_list
-    def dfs_sort(visited_nodes, taxonomy_tree, node_taxid, offset):
-        if node_taxid not in visited_nodes:
-            visited_nodes.add(node_taxid)
-
-            # Find the cumluative read counts for all children of current node:
-            children_cumulative_counts = {}
-            for child in taxonomy_tree.get_children([node_taxid])[node_taxid]:
-                if child in tax_reads['hits_at_clade']:
-                    children_cumulative_counts[child] = tax_reads['hits_at_clade'][child]
-
-            # Get the hits to this node (to be output in the report):
-            if node_taxid in tax_reads['hits_at_node']:
-                hits_at_node = tax_reads['hits_at_node'][node_taxid]
-            else:
-                hits_at_node = 0
-
-            # Get some information that will go into the report file.
-            # 1) total number of reads at this node and at the clade rooted here (column 2 in output):
-            hits_at_clade = tax_reads['hits_at_clade'][node_taxid]
-            # 2) the ratio (column 1 in output):
-            ratio_classified2clade = hits_at_clade / total_reads * 100
-            # 3) the rank code and depth (column 4 in output):
-            rank_tuple = taxonomy_tree.get_rank_code([node_taxid])[node_taxid]
-            # 4) scientific name of the node (column 6 of output):
-            name = taxonomy_tree.get_name([node_taxid])[node_taxid]
-
-            # Construct the dataclass instance that holds the information
-            # about this node that is printed to the report file:
-            report_node = ReportNode(
-                ratio="{0:.2f}".format(ratio_classified2clade),
-                hits_at_clade=hits_at_clade,
-                hits_at_node=hits_at_node,
-                rank_code=rank_tuple.rank_code,
-                rank_depth=rank_tuple.rank_depth,
-                node_taxid=node_taxid,
-                offset=offset,
-                name=name)
-
-            # Append it to the list. The order of the elements in the list is
-            # the order the nodes will be printed.
-            report_node_list.append(report_node)
-
-            if len(children_cumulative_counts) > 0:
-                # sorted_by_ccrc is a list of tuples [(tax_id#1, ccrc), (tax_id#2, ccrc)...]
-                sorted_by_ccrc = sorted(
-                    children_cumulative_counts.items(),
-                    key=operator.itemgetter(1),
-                    reverse=True)
-
-                # We are going one level deeper in the taxonomy, increment
-                # the offset:
-                offset += 1
-
-                for child_tuple in sorted_by_ccrc:
-                    child_taxid = child_tuple[0]
-                    dfs_sort(visited_nodes, taxonomy_tree, child_taxid, offset)
-
-    # Depth first search to get cumulative read counts for all clades:
-    visited_nodes = set()
-    log.info('Calculating cumulative clade read counts...')
-    dfs_ccrc(visited_nodes, taxonomy_tree, 1)
-
-    # Depth first search to sort the output according to largest cumulative
-    # read count:
-    visited_nodes = set()
-    log.info('Sorting the order of the output in the report file...')
-    dfs_sort(visited_nodes, taxonomy_tree, 1, 0)
+    # read count to report_node_list.
+    stack = [(1, 0)] if 1 in hits_at_clade else []
+    while stack:
+        node_taxid, offset = stack.pop()
+        rank_tuple = rank_tuples[node_taxid]
+
+        # Construct the dataclass instance that holds the information
+        # about this node that is printed to the report file:
+        report_node = ReportNode(
+            ratio="{0:.2f}".format(hits_at_clade[node_taxid] / total_reads * 100 if total_reads else 0),
+            hits_at_clade=hits_at_clade[node_taxid],
+            hits_at_node=hits_at_node.get(node_taxid, 0),
+            rank_code=rank_tuple.rank_code,
+            rank_depth=rank_tuple.rank_depth,
+            node_taxid=node_taxid,
+            offset=offset,
+            name=names[node_taxid])
+
+        # Append it to the list. The order of the elements in the list is
+        # the order the nodes will be printed.
+        report_node_list.append(report_node)
+
+        # Children with the highest cumulative clade read count go first
+        # (the sort is stable), one level deeper in the taxonomy. They are
+        # pushed in reverse so that the first one is popped first.
+        if node_taxid in children_with_reads:
+            sorted_by_ccrc = sorted(
+                children_with_reads[node_taxid],
+                key=hits_at_clade.__getitem__,
+                reverse=True)
+            stack.extend((child_taxid, offset + 1) for child_taxid in reversed(sorted_by_ccrc))
 
     # Make sure to add the unclassified row that goes at the very top of the
     # kraken 2 report:
-    num_unclassified_reads = total_reads - tax_reads['hits_at_clade'][1]
-    ratio = num_unclassified_reads / total_reads * 100
+    num_unclassified_reads = total_reads - hits_at_clade.get(1, 0)
+    ratio = num_unclassified_reads / total_reads * 100 if total_reads else 0
     unclassified_node = ReportNode(
         ratio="{0:.2f}".format(ratio),
         hits_at_clade=num_unclassified_reads,
@@ -521,46 +800,78 @@ def make_kraken2_report(tax_reads, taxonomy_tree, total_reads, output_report):
             sys.stdout.write(report_row + '\n')
 
 
-def get_verbose_output(read, taxonomy_tree):
+def read_kraken2_report(filename):
     """
-    Gets more information about the reclassification of a read. This is for
-    the output_verbose option.
-
-    read is an instance of ReadClassification.
+    Reads the number of reads at each node (column 3) of a kraken 2 style
+    report. Returns (hits_at_node, total_reads), where total_reads is the
+    number of unclassified reads plus the reads in the clade of the root.
     """
-    # Variable renaming to make things more readable
-    new_taxid = read.reclassified_taxid
-    old_tax_id = read.original_taxid
+    hits_at_node = {}
+    total_reads = 0
+    with open(filename) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            hits_at_clade = int(fields[1])
+            node_hits = int(fields[2])
+            tax_id = int(fields[4])
+            if tax_id in (0, 1):
+                total_reads += hits_at_clade
+            if tax_id != 0 and node_hits:
+                hits_at_node[tax_id] = node_hits
 
-    # Stuff that is conditional if we have a classified read or not.
-    # TaxonomyTree doesn't cope with tax_id=0
-    if read.classified:
-        distance = taxonomy_tree.get_distance(new_taxid, old_tax_id)
-        new_rank_tuple = taxonomy_tree.get_rank_code([new_taxid])[new_taxid]
-        new_rank_depth = new_rank_tuple.rank_depth if new_rank_tuple.rank_depth != 0 else ''
-        new_rank_code = str(new_rank_tuple.rank_code) + str(new_rank_depth)
-        new_rank_name = taxonomy_tree.get_name([new_taxid])[new_taxid]
-    else:
-        distance = 'NaN'
-        new_rank_code = 'U'
-        new_rank_name = 'unclassified'
+    return hits_at_node, total_reads
 
-    # Distance information
-    read.reclassified_distance = distance
 
-    # Rank information
-    old_rank_tuple = taxonomy_tree.get_rank_code([old_tax_id])[old_tax_id]
-    old_rank_depth = old_rank_tuple.rank_depth if old_rank_tuple.rank_depth != 0 else ''
-    old_rank_code = str(old_rank_tuple.rank_code) + str(old_rank_depth)
-    read.original_rank_code = old_rank_code
-    read.reclassified_rank_code = new_rank_code
+def merge_reports():
+    """
+    Command line entry point to merge the reports of the shards of a
+    classifications file (see --shard) into the report of the whole file.
+    """
+    parser = argparse.ArgumentParser(
+        prog='stringmeup-merge-reports',
+        description='Merge reports made by stringmeup (e.g. of the shards of a classifications file, see stringmeup --shard) into one, by adding up the reads at each node.')
+    parser.add_argument(
+        'output',
+        metavar='OUTPUT',
+        help='File to save the merged report in.')
+    parser.add_argument(
+        'inputs',
+        metavar='INPUT',
+        nargs='+',
+        help='Reports to merge.')
+    parser.add_argument(
+        '--names',
+        metavar='FILE',
+        help='Taxonomy names dump file (names.dmp)')
+    parser.add_argument(
+        '--nodes',
+        metavar='FILE',
+        help='Taxonomy nodes dump file (nodes.dmp)')
+    parser.add_argument(
+        '--taxonomy_k2d',
+        metavar='FILE',
+        help='Taxonomy file of the Kraken 2 database (taxo.k2d), instead of --names and --nodes (see stringmeup --taxonomy_k2d).')
+    parser.add_argument(
+        '--taxonomy_cache',
+        metavar='FILE',
+        help='Binary cache of the taxonomy in --names and --nodes (see stringmeup --taxonomy_cache).')
+    parser.add_argument(
+        '--names_index',
+        metavar='FILE',
+        help='Index of the names in --names (see stringmeup --names_index).')
+    args = parser.parse_args()
+    check_taxonomy_arguments(parser, args)
 
-    # Scientific name information
-    old_rank_name = taxonomy_tree.get_name([old_tax_id])[old_tax_id]
-    read.original_name = old_rank_name
-    read.reclassified_name = new_rank_name
+    tax_reads = {'hits_at_node': {}, 'hits_at_clade': {}}
+    total_reads = 0
+    for filename in args.inputs:
+        hits_at_node, num_reads = read_kraken2_report(filename)
+        for tax_id, hits in hits_at_node.items():
+            tax_reads['hits_at_node'][tax_id] = tax_reads['hits_at_node'].get(tax_id, 0) + hits
+        total_reads += num_reads
 
-    return read
+    taxonomy_tree = load_taxonomy_tree(args)
+    make_kraken2_report(tax_reads, taxonomy_tree, total_reads, args.output)
 
 
 def create_read(kraken2_read, verbose_input=False):
@@ -585,139 +896,745 @@ def create_read(kraken2_read, verbose_input=False):
     return read
 
 
-def main_loop(f_handle, tax_reads_dict, taxonomy_tree, args, report_frequency, taxa_lineages, paired_input, verbose_input=False, o_handle=None, v_handle=None):
-    """
-    f_handle: classifications input file to read from.
-    o_handle: output_classifications file to write to.
-    v_handle: output_verbose file to write to.
-    """
-    def write_read_output(read):
-        # read is an instance of ReadClassification
-        classification = 'C' if read.classified else 'U'
-        row_items = [
-            classification,
-            read.id,
-            read.reclassified_taxid,
-            read.length,
-            read.kmer_string]
-
-        if verbose_input:
-            row_items.insert(4, read.minimizer_hit_groups)
-
-        row_string = '\t'.join([str(x) for x in row_items]) + '\n'
-        _ = o_handle.write(row_string)  # gzip write fnc returns output, therefore send to "_"
-
-    def write_verbose_output(read):
-        # read is an instance of ReadClassification
-        row_items = [
-            read.id,
-            read.length,
-            read.reclassified_distance,
-            read.original_taxid,
-            read.reclassified_taxid,
-            "{0:.2f}".format(read.original_conf),
-            "{0:.2f}".format(read.recalculated_conf),
-            "{0:.2f}".format(read.max_confidence),
-            read.original_rank_code,
-            read.reclassified_rank_code,
-            read.original_name,
-            read.reclassified_name,
-            read.kmer_string]
-
-        if verbose_input:
-            row_items.insert(2, read.minimizer_hit_groups)
-
-        row_string = '\t'.join([str(x) for x in row_items]) + '\n'
-        _ = v_handle.write(row_string)  # gzip write fnc returns output, therefore send to "_"
-
-    # Parse the input file, read per read
-    i = 0
-    for read_pair in f_handle:
+def format_read_output(read, verbose_input):
+    """
+    Formats the row of a read (instance of ReadClassification) for the
+    output_classifications file.
+    """
+    classification = 'C' if read.classified else 'U'
+    row_items = [
+        classification,
+        read.id,
+        read.reclassified_taxid,
+        read.length,
+        read.kmer_string]
+
+    if verbose_input:
+        row_items.insert(4, read.minimizer_hit_groups)
+
+    return '\t'.join([str(x) for x in row_items]) + '\n'
+
+
+def reclassify_lines(lines, taxonomy_tree, args, verbose_input, output_classifications, output_verbose, output_ladder=False, profile_cache=None, output_threshold_index=False, verbose_formatter=None):
+    """
+    Reclassifies the reads in a chunk of lines from the classifications input
+    file, at all confidence thresholds in args.confidence_threshold.
+    profile_cache is an optional ProfileCache (see reclassify_read), and
+    verbose_formatter an optional VerboseFormatter to reuse between chunks.
+
+    With args.engine 'numpy', the classified reads of the chunk are
+    reclassified all at once (see numpy_engine.reclassify_reads).
+
+    With args.from_ladder, lines are records from a ladder file instead. With
+    output_ladder, the confidence ladders of the reads are encoded for the
+    --output_ladder file. With output_threshold_index, the reads are added to
+    a ThresholdIndex of the chunk.
+
+    With args.metrics, counters and the time spent parsing, reclassifying and
+    formatting verbose output are collected for the chunk (see
+    metrics.RunMetrics.add_chunk).
+
+    Returns an instance of ChunkResult, that holds the hits_at_node counts and
+    the (formatted) output rows of the chunk for every threshold.
+    """
+    num_thresholds = len(args.confidence_threshold)
+    hits_at_node_list = [{} for _ in range(num_thresholds)]
+    classification_rows = [[] for _ in range(num_thresholds)]
+    verbose_rows = [[] for _ in range(num_thresholds)]
+    ladder_records = []
+    if output_verbose and verbose_formatter is None:
+        verbose_formatter = VerboseFormatter(taxonomy_tree, verbose_input)
+    t_index = threshold_index.ThresholdIndex(args.minimum_hit_groups) if output_threshold_index else None
+    taxa_kmer_dict = {}
+    if profile_cache is not None:
+        cache_hits = profile_cache.hits
+        cache_misses = profile_cache.misses
+
+    collect_metrics = bool(args.metrics)
+    if collect_metrics:
+        clock = time.perf_counter
+        chunk_metrics = {
+            'counters': {'classified_input_reads': 0, 'failed_hit_groups': 0},
+            'thresholds': [{'moved_reads': 0, 'moved_to': {}} for _ in range(num_thresholds)],
+            'seconds': {'parse': 0, 'reclassify': 0, 'verbose': 0}}
+        seconds = chunk_metrics['seconds']
+        if verbose_formatter is not None:
+            formatter_hits = verbose_formatter.hits
+            formatter_misses = verbose_formatter.misses
+
+    # Without output per read, the numpy engine only has to count the reads
+    # per tax_id
+    if args.engine == 'numpy' and not (output_classifications or output_verbose or collect_metrics):
+        read_fields = [read_pair.strip().split('\t') for read_pair in lines if read_pair.startswith('C')]
+        if read_fields:
+            batch = numpy_engine.reclassify_batch(
+                [int(fields[2]) for fields in read_fields],
+                [fields[-1] for fields in read_fields],
+                [int(fields[4]) for fields in read_fields] if verbose_input else None,
+                args.confidence_threshold,
+                taxonomy_tree,
+                verbose_input,
+                args.minimum_hit_groups)
+            hits_at_node_list = numpy_engine.count_reclassified(batch)
+
+        return ChunkResult(
+            num_lines=len(lines),
+            hits_at_node=hits_at_node_list,
+            classification_rows=classification_rows,
+            verbose_rows=verbose_rows,
+            ladder_records=ladder_records,
+            threshold_index=None,
+            cache_hits=0,
+            cache_misses=0,
+            metrics=None)
+
+    # Otherwise, it gets the classified reads of the chunk, reclassified
+    if args.engine == 'numpy':
+        if collect_metrics:
+            start = clock()
+        reads = [create_read(read_pair, verbose_input) for read_pair in lines if read_pair.startswith('C')]
+        if collect_metrics:
+            seconds['parse'] += clock() - start
+            start = clock()
+        numpy_engine.reclassify_reads(
+            reads,
+            args.confidence_threshold,
+            taxonomy_tree,
+            verbose_input,
+            args.minimum_hit_groups)
+        if collect_metrics:
+            seconds['reclassify'] += clock() - start
+
+    for read_pair in (reads if args.engine == 'numpy' else lines):
+
+        if args.engine == 'numpy':
+            read = read_pair
+
+        # Ladder files only hold classified reads, and their ladders are all
+        # that is needed to reclassify them
+        elif args.from_ladder:
+            if collect_metrics:
+                start = clock()
+            read = reclassify_ladder_record(
+                read_pair,
+                args.confidence_threshold,
+                verbose_input,
+                args.minimum_hit_groups)
+            if collect_metrics:
+                seconds['reclassify'] += clock() - start
 
         # Only working with classified reads:
-        if read_pair.startswith('C'):
+        elif not read_pair.startswith('C'):
+            # Change here if you want to keep reads from the input file
+            # that were initially unclassified.
+            continue
 
+        else:
             # Make an instance of ReadClassification to hold information
             # about the read and its classification
+            if collect_metrics:
+                start = clock()
             read = create_read(read_pair, verbose_input)
+            if collect_metrics:
+                seconds['parse'] += clock() - start
+                start = clock()
 
-            # Reclassify the read pair based on confidence
-            read, taxa_lineages = reclassify_read(
+            # Reclassify the read pair based on confidence, at all thresholds
+            read = reclassify_read(
                 read,
                 args.confidence_threshold,
                 taxonomy_tree,
                 verbose_input,
                 args.minimum_hit_groups,
-                taxa_lineages,
-                paired_input)
+                profile_cache,
+                full_ladder=output_ladder or output_threshold_index,
+                taxa_kmer_dict=taxa_kmer_dict)
+            if collect_metrics:
+                seconds['reclassify'] += clock() - start
+
+            if output_ladder:
+                ladder_records.append(ladder.encode_read(
+                    read.id,
+                    read.length,
+                    read.kmer_string,
+                    read.minimizer_hit_groups,
+                    read.total_kmer_hits,
+                    read.assigned_kmer_hits,
+                    read.ladder))
+
+        # The ladder goes all the way to the root, so it holds the
+        # reclassification of the read at any threshold
+        if output_threshold_index:
+            t_index.add_read(
+                read.ladder,
+                read.total_kmer_hits,
+                verbose_input and read.minimizer_hit_groups < args.minimum_hit_groups)
+
+        if collect_metrics:
+            chunk_metrics['counters']['classified_input_reads'] += 1
+            if verbose_input and read.minimizer_hit_groups < args.minimum_hit_groups:
+                chunk_metrics['counters']['failed_hit_groups'] += 1
+
+        for k, reclassification in enumerate(read.reclassifications):
+            set_reclassification(read, reclassification)
 
             # Counter for number of reads per taxon/node
-            if read.reclassified_taxid in tax_reads_dict['hits_at_node']:
-                tax_reads_dict['hits_at_node'][read.reclassified_taxid] += 1
+            hits_at_node = hits_at_node_list[k]
+            if read.reclassified_taxid in hits_at_node:
+                hits_at_node[read.reclassified_taxid] += 1
             else:
-                tax_reads_dict['hits_at_node'][read.reclassified_taxid] = 1
+                hits_at_node[read.reclassified_taxid] = 1
 
-            # Write the reclassified reads to file
-            if o_handle:
+            # The reclassified reads that go to file
+            if output_classifications:
                 if read.classified or args.keep_unclassified:
-                    write_read_output(read)
+                    classification_rows[k].append(format_read_output(read, verbose_input))
+
+            # Verbose output about the reclassification
+            if output_verbose:
+                if collect_metrics:
+                    start = clock()
+                verbose_rows[k].append(verbose_formatter.format(read))
+                if collect_metrics:
+                    seconds['verbose'] += clock() - start
+
+            # Reads that were moved up in the taxonomy, per tax_id they were
+            # moved to
+            if collect_metrics and read.classified and read.reclassified_taxid != read.original_taxid:
+                threshold_metrics = chunk_metrics['thresholds'][k]
+                threshold_metrics['moved_reads'] += 1
+                moved_to = threshold_metrics['moved_to']
+                moved_to[read.reclassified_taxid] = moved_to.get(read.reclassified_taxid, 0) + 1
+
+    if collect_metrics:
+        chunk_metrics['counters']['input_characters'] = sum(map(len, lines)) if not args.from_ladder else 0
+        if verbose_formatter is not None:
+            chunk_metrics['counters']['verbose_formatter_hits'] = verbose_formatter.hits - formatter_hits
+            chunk_metrics['counters']['verbose_formatter_misses'] = verbose_formatter.misses - formatter_misses
+
+    return ChunkResult(
+        num_lines=len(lines),
+        hits_at_node=hits_at_node_list,
+        classification_rows=classification_rows,
+        verbose_rows=verbose_rows,
+        ladder_records=ladder_records,
+        threshold_index=t_index,
+        cache_hits=profile_cache.hits - cache_hits if profile_cache is not None else 0,
+        cache_misses=profile_cache.misses - cache_misses if profile_cache is not None else 0,
+        metrics=chunk_metrics if collect_metrics else None)
+
+
+def _init_worker(taxonomy_tree, args, verbose_input, output_classifications, output_verbose, output_ladder, output_threshold_index):
+    """
+    Initializer of the worker processes. Each worker holds its own reference
+    to the taxonomy tree (shared copy-on-write when the processes are forked).
+    """
+    _worker_state['taxonomy_tree'] = taxonomy_tree
+    _worker_state['args'] = args
+    _worker_state['verbose_input'] = verbose_input
+    _worker_state['output_classifications'] = output_classifications
+    _worker_state['output_verbose'] = output_verbose
+    _worker_state['output_ladder'] = output_ladder
+    _worker_state['profile_cache'] = ProfileCache(args.profile_cache_size) if args.profile_cache_size else None
+    _worker_state['output_threshold_index'] = output_threshold_index
+    _worker_state['verbose_formatter'] = VerboseFormatter(taxonomy_tree, verbose_input) if output_verbose else None
+
+
+def _reclassify_lines_worker(lines):
+    """
+    Reclassifies a chunk of lines in a worker process.
+    """
+    return reclassify_lines(lines, **_worker_state)
+
+
+def _reclassify_range_worker(byte_range):
+    """
+    Reads the lines in a byte range (filename, start, end) of the
+    classifications input file, and reclassifies them in a worker process.
+    """
+    filename, start, end = byte_range
+    return reclassify_lines(shard.read_lines(filename, start, end), **_worker_state)
+
 
-            # Write verbose output about the reclassification
-            if v_handle:
-                read = get_verbose_output(read, taxonomy_tree)
-                write_verbose_output(read)
+def read_chunks(f_handle, chunk_size):
+    """
+    Yields lists of (at most) chunk_size lines from f_handle.
+    """
+    chunk = []
+    for line in f_handle:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
+
+def fork_context():
+    """
+    Returns the multiprocessing context of worker process pools: fork (where
+    available), so that the workers share the taxonomy tree of this process
+    instead of getting a pickled copy each, otherwise None (the default).
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return None
+
+
+def reclassify_chunks_parallel(chunks, threads, ordered, initargs, worker=_reclassify_lines_worker):
+    """
+    Reclassifies the chunks of lines in a pool of worker processes, and yields
+    the ChunkResults. worker is the function that reclassifies a chunk in a
+    worker process: _reclassify_lines_worker for chunks of lines, or
+    _reclassify_range_worker for byte ranges of the input file. If ordered,
+    the results are yielded in the same order as the chunks. Otherwise they
+    are yielded as soon as they are done, which keeps all workers busy even
+    if some chunks are slow.
+
+    At most a few chunks per worker are in flight at any time, so the input
+    file is not read faster than it can be reclassified.
+    """
+    max_pending = 4 * threads
+
+    with ProcessPoolExecutor(max_workers=threads, mp_context=fork_context(), initializer=_init_worker, initargs=initargs) as executor:
+        pending = deque() if ordered else set()
+
+        for chunk in chunks:
+            future = executor.submit(worker, chunk)
+
+            if ordered:
+                pending.append(future)
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+            else:
+                pending.add(future)
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+
+        if ordered:
+            while pending:
+                yield pending.popleft().result()
         else:
-            # Change here if you want to keep reads from the input file
-            # that were initially unclassified.
-            pass
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
 
-        # Keep track of progress
-        i += 1
-        if i % report_frequency == 0:
-            log.info('Processed {} reads...'.format(i))
+
+def main_loop(f_handle, tax_reads_dicts, taxonomy_tree, args, report_frequency, verbose_input=False, o_handles=None, v_handles=None, l_handle=None, t_index=None, run_metrics=None, chunk_size=10000, byte_range=None):
+    """
+    f_handle: classifications input file to read from (a ladder.LadderReader
+              with args.from_ladder).
+    tax_reads_dicts: one tax_reads dict per confidence threshold.
+    o_handles: output_classifications files to write to, one per threshold.
+    v_handles: output_verbose files to write to, one per threshold.
+    l_handle: output_ladder file to write to (a ladder.LadderWriter).
+    t_index: threshold_index.ThresholdIndex to add the reads to.
+    run_metrics: metrics.RunMetrics to add the timings and counters of the
+                 reclassification and the report(s) to.
+    byte_range: (start, end) of an uncompressed classifications input file to
+                reclassify the lines of (see shard), instead of reading
+                f_handle.
+
+    The input file is read in chunks of chunk_size lines (or of
+    shard.CHUNK_BYTES bytes of byte_range). With args.threads > 1, the chunks
+    are reclassified in a pool of worker processes, which read the chunks of
+    byte_range themselves.
+
+    Returns the number of lines in the classifications input file.
+    """
+    output_classifications = bool(o_handles)
+    output_verbose = bool(v_handles)
+    output_ladder = l_handle is not None
+    output_threshold_index = t_index is not None
+    if byte_range is not None:
+        filename = args.original_classifications_file
+        byte_ranges = [(filename, start, end) for start, end in shard.split_byte_range(*byte_range)]
+        if args.threads > 1:
+            chunks = byte_ranges
+        else:
+            chunks = (shard.read_lines(*chunk_range) for chunk_range in byte_ranges)
+    else:
+        chunks = read_chunks(f_handle, chunk_size)
+    profile_cache = ProfileCache(args.profile_cache_size) if args.profile_cache_size else None
+    verbose_formatter = VerboseFormatter(taxonomy_tree, verbose_input) if output_verbose else None
+    if run_metrics is None:
+        run_metrics = metrics.RunMetrics()
+
+    if args.threads > 1:
+        log.info('Reclassifying with {} worker processes.'.format(args.threads))
+        chunk_results = reclassify_chunks_parallel(
+            chunks,
+            args.threads,
+            not args.unordered_output,
+            (taxonomy_tree, args, verbose_input, output_classifications, output_verbose, output_ladder, output_threshold_index),
+            _reclassify_range_worker if byte_range is not None else _reclassify_lines_worker)
+    else:
+        chunk_results = (
+            reclassify_lines(chunk, taxonomy_tree, args, verbose_input, output_classifications, output_verbose, output_ladder, profile_cache, output_threshold_index, verbose_formatter)
+            for chunk in chunks)
+
+    # Parse the input file, chunk per chunk (in this process, or in the
+    # worker processes)
+    with run_metrics.stage('reclassification'):
+        i = 0
+        cache_hits = 0
+        cache_misses = 0
+        for chunk_result in chunk_results:
+            cache_hits += chunk_result.cache_hits
+            cache_misses += chunk_result.cache_misses
+            if chunk_result.metrics is not None:
+                run_metrics.add_chunk(chunk_result.metrics)
+
+            for k, tax_reads_dict in enumerate(tax_reads_dicts):
+
+                # Counter for number of reads per taxon/node
+                hits_at_node = tax_reads_dict['hits_at_node']
+                for tax_id, hits in chunk_result.hits_at_node[k].items():
+                    if tax_id in hits_at_node:
+                        hits_at_node[tax_id] += hits
+                    else:
+                        hits_at_node[tax_id] = hits
+
+                # Write the reclassified reads to file
+                if o_handles:
+                    _ = o_handles[k].write(''.join(chunk_result.classification_rows[k]))  # gzip write fnc returns output, therefore send to "_"
+
+                # Write verbose output about the reclassification
+                if v_handles:
+                    _ = v_handles[k].write(''.join(chunk_result.verbose_rows[k]))
+
+            # Write the confidence ladders of the reads
+            if l_handle:
+                l_handle.write(b''.join(chunk_result.ladder_records))
+
+            # Add the reads to the threshold index
+            if t_index is not None:
+                t_index.merge(chunk_result.threshold_index)
+
+            # Keep track of progress
+            i += chunk_result.num_lines
+            if i // report_frequency > (i - chunk_result.num_lines) // report_frequency:
+                log.info('Processed {} reads...'.format(i))
+
+    # A ladder file only holds the classified reads, but knows how many
+    # lines there were in the classifications file it was made from
+    if args.from_ladder:
+        i = f_handle.num_lines
 
     log.info('Done processing reads. They were {} in total.'.format(i))
 
-    # Output a report file
-    make_kraken2_report(tax_reads_dict, taxonomy_tree, i, args.output_report)  # i is used to calculate the ratio of classified reads (col 1 in output file).
+    if t_index is not None:
+        t_index.num_lines = i
+
+    if args.profile_cache_size:
+        log.info('Hit profile cache: {hits} hits, {misses} misses ({ratio:.1f}% hits).'.format(
+            hits=cache_hits,
+            misses=cache_misses,
+            ratio=100 * cache_hits / max(cache_hits + cache_misses, 1)))
+
+    if args.metrics:
+        summarize_run_metrics(run_metrics, tax_reads_dicts, taxonomy_tree, args, i, cache_hits, cache_misses, output_ladder or output_threshold_index)
+
+    # Output a report file per threshold
+    with run_metrics.stage('report'):
+        for k, threshold in enumerate(args.confidence_threshold):
+            if len(args.confidence_threshold) > 1:
+                output_report = threshold_filename(args.output_report, threshold)
+            else:
+                output_report = args.output_report
+            make_kraken2_report(tax_reads_dicts[k], taxonomy_tree, i, output_report)  # i is used to calculate the ratio of classified reads (col 1 in output file).
+
+    return i
 
 
-def read_file(filename):
+def summarize_run_metrics(run_metrics, tax_reads_dicts, taxonomy_tree, args, num_lines, cache_hits, cache_misses, full_ladder):
     """
-    Wrapper to read either gzipped or ordinary text file input.
+    Adds the counters that follow from the reclassification of all reads to
+    run_metrics: the number of reads that were classified and unclassified
+    at each threshold, the reads that were moved up in the taxonomy per rank
+    code they were moved to, and the cache statistics.
     """
-    if filename.endswith('.gz'):
-        return gzip.open(filename, 'rt')
+    counters = run_metrics.counters
+    counters['lines'] = num_lines
+    counters['unclassified_input_reads'] = num_lines - counters.get('classified_input_reads', 0)
+
+    # Reads that can't be classified at the lowest threshold are not walked
+    # up the taxonomy at all (unless their full ladder is needed)
+    thresholds = args.confidence_threshold
+    lowest = thresholds.index(min(thresholds))
+    if args.from_ladder or full_ladder:
+        counters['short_circuited_reads'] = 0
     else:
-        return open(filename, 'r')
+        counters['short_circuited_reads'] = tax_reads_dicts[lowest]['hits_at_node'].get(0, 0)
+
+    for k, threshold in enumerate(thresholds):
+        threshold_metrics = run_metrics.thresholds[k] if run_metrics.thresholds else {'moved_reads': 0, 'moved_to': {}}
+        hits_at_node = tax_reads_dicts[k]['hits_at_node']
+        unclassified = hits_at_node.get(0, 0)
+
+        moved_to = threshold_metrics.pop('moved_to')
+        moved_to_rank = {}
+        for tax_id, rank in taxonomy_tree.get_rank_code(list(moved_to)).items():
+            moved_to_rank[rank.rank_code] = moved_to_rank.get(rank.rank_code, 0) + moved_to[tax_id]
+
+        threshold_metrics = {
+            'confidence_threshold': threshold,
+            'classified_reads': sum(hits_at_node.values()) - unclassified,
+            'unclassified_reads': unclassified,
+            'moved_reads': threshold_metrics['moved_reads'],
+            'moved_to_rank': moved_to_rank}
+        if k < len(run_metrics.thresholds):
+            run_metrics.thresholds[k] = threshold_metrics
+        else:
+            run_metrics.thresholds.append(threshold_metrics)
+
+    run_metrics.caches['profile_cache'] = {
+        'maxsize': args.profile_cache_size,
+        'hits': cache_hits,
+        'misses': cache_misses,
+        'hit_rate': metrics.hit_rate(cache_hits, cache_misses)}
+    if 'verbose_formatter_hits' in counters:
+        hits = counters.pop('verbose_formatter_hits')
+        misses = counters.pop('verbose_formatter_misses')
+        run_metrics.caches['verbose_formatter'] = {
+            'entries': misses,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': metrics.hit_rate(hits, misses)}
+
+
+def reports_from_threshold_index(filename, taxonomy_tree, args):
+    """
+    Outputs a report file per confidence threshold from a threshold index
+    (saved with --output_threshold_index), without reclassifying any reads.
+    """
+    try:
+        t_index = threshold_index.ThresholdIndex.load(filename)
+    except threshold_index.ThresholdIndexException as e:
+        log.error(str(e))
+        sys.exit()
+
+    log.info('Read the threshold index of {} reads from "{}".'.format(t_index.num_lines, path.abspath(filename)))
+    if args.minimum_hit_groups and args.minimum_hit_groups != t_index.minimum_hit_groups:
+        log.warning('The threshold index was made with minimum_hit_groups={}, --minimum_hit_groups is ignored.'.format(t_index.minimum_hit_groups))
+
+    for threshold in args.confidence_threshold:
+        if len(args.confidence_threshold) > 1:
+            output_report = threshold_filename(args.output_report, threshold)
+        else:
+            output_report = args.output_report
+        tax_reads = {'hits_at_node': t_index.hits_at_node(threshold), 'hits_at_clade': {}}
+        make_kraken2_report(tax_reads, taxonomy_tree, t_index.num_lines, output_report)
+
+
+def load_taxonomy_tree(args, prune_tax_ids=None):
+    """
+    Creates the TaxonomyTree of args.names and args.nodes, or of
+    args.taxonomy_k2d (from args.taxonomy_cache and args.names_index, if
+    given), pruned to prune_tax_ids (see get_prune_tax_ids) if given.
+    """
+    try:
+        return taxonomy.TaxonomyTree(
+            names_filename=args.names,
+            nodes_filename=args.nodes,
+            cache_filename=args.taxonomy_cache,
+            names_index_filename=args.names_index,
+            prune_tax_ids=prune_tax_ids,
+            k2d_filename=args.taxonomy_k2d)
+    except taxonomy.TaxonomyTreeException as e:
+        log.error(str(e))
+        sys.exit()
+
+
+def check_taxonomy_arguments(parser, args):
+    """
+    Checks that the taxonomy is given either as --names and --nodes, or as
+    --taxonomy_k2d.
+    """
+    if args.taxonomy_k2d:
+        if args.names or args.nodes:
+            parser.error('--taxonomy_k2d can not be used together with --names and --nodes.')
+        if args.names_index:
+            parser.error('--names_index can only be used with --names (the names of --taxonomy_k2d are indexed with the tree).')
+    elif not (args.names and args.nodes):
+        parser.error('The taxonomy is required: either --names and --nodes, or --taxonomy_k2d.')
+
+
+def get_prune_tax_ids(args):
+    """
+    Returns the tax_ids to prune the taxonomy tree to: those in the
+    --prune_taxonomy file, or those collected from the classifications file
+    with --prune_taxonomy_to_input. Returns None if the tree should not be
+    pruned.
+    """
+    if args.prune_taxonomy:
+        try:
+            return taxonomy.read_tax_id_list(args.prune_taxonomy)
+        except (OSError, taxonomy.TaxonomyTreeException) as e:
+            log.error(str(e))
+            sys.exit()
+
+    if args.prune_taxonomy_to_input:
+        log.info('Collecting the tax_ids in "{}" to prune the taxonomy to...'.format(args.original_classifications_file))
+        return sorted(collect_tax_ids(args.original_classifications_file))
+
+    return None
+
+
+def collect_tax_ids(filename, tax_ids=None):
+    """
+    Adds the tax_ids that the reads in a kraken 2 output file are classified
+    to, and that their kmers hit, to the set tax_ids (a new set if None), and
+    returns it. These are all the tax_ids that are needed to reclassify the
+    reads in a pruned taxonomy tree (see TaxonomyTree.prune).
+    """
+    if tax_ids is None:
+        tax_ids = set()
+
+    # The tax_ids are kept as strings until all lines are read
+    seen = set()
+    with read_file(filename, background=True) as f:
+        for line in f:
+            if not line.startswith('C'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            seen.add(fields[2])
+            seen.update(kmer_info.partition(':')[0] for kmer_info in fields[-1].split())
+
+    seen.difference_update(('A', '|', '0'))
+    tax_ids.update(int(tax_id) for tax_id in seen)
+    return tax_ids
+
+
+def collect_taxids():
+    """
+    Command line entry point to collect the tax_ids in kraken 2 output files,
+    for stringmeup --prune_taxonomy.
+    """
+    parser = argparse.ArgumentParser(
+        prog='stringmeup-collect-taxids',
+        description='Collect the tax_ids that the reads in Kraken 2 output files are classified to or have kmers hitting, and save them one per line, to prune the taxonomy to with stringmeup --prune_taxonomy.')
+    parser.add_argument(
+        'output',
+        metavar='OUTPUT',
+        help='File to save the tax_ids in.')
+    parser.add_argument(
+        'inputs',
+        metavar='INPUT',
+        nargs='+',
+        help='Kraken 2 output files.')
+    args = parser.parse_args()
+
+    tax_ids = set()
+    for filename in args.inputs:
+        collect_tax_ids(filename, tax_ids)
+
+    with open(args.output, 'w') as f:
+        for tax_id in sorted(tax_ids):
+            f.write('{}\n'.format(tax_id))
+    log.info('Saved {} tax_ids from {} files in {}.'.format(len(tax_ids), len(args.inputs), args.output))
+
+
+def threshold_filename(filename, threshold):
+    """
+    Inserts the confidence threshold in a filename, to separate the output
+    files of different thresholds from each other:
+    sample.report -> sample_0.1.report
+    """
+    root, ext = path.splitext(filename)
+    if ext == '.gz':
+        root, inner_ext = path.splitext(root)
+        ext = inner_ext + ext
+    return '{root}_{threshold:g}{ext}'.format(
+        root=root, threshold=threshold, ext=ext)
+
+
+def parse_confidence_thresholds(threshold_string):
+    """
+    Parses the confidence argument. It can be a single threshold ("0.1"), a
+    comma separated list of thresholds ("0.1,0.25,0.5") or an inclusive range
+    written as start:stop:step ("0.05:0.5:0.05"). Returns a list of floats.
+    """
+    try:
+        if ':' in threshold_string:
+            start, stop, step = [float(x) for x in threshold_string.split(':')]
+            if step <= 0:
+                raise ValueError
+            num_steps = int(round((stop - start) / step, 9))
+            thresholds = [round(start + n * step, 9) for n in range(num_steps + 1)]
+        else:
+            thresholds = [float(x) for x in threshold_string.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'Invalid confidence threshold(s): "{}".'.format(threshold_string))
+
+    if not thresholds:
+        raise argparse.ArgumentTypeError(
+            'No confidence thresholds in "{}".'.format(threshold_string))
+
+    for threshold in thresholds:
+        if not 0 <= threshold <= 1:
+            raise argparse.ArgumentTypeError(
+                'The confidence threshold must be between 0 and 1, was {}.'.format(threshold))
+
+    return thresholds
+
+
+def read_file(filename, background=False):
+    """
+    Wrapper to read either compressed (gzip, bz2, xz or zstd, detected from
+    the contents of the file) or ordinary text file input. With background,
+    compressed input is decompressed in the background while it is being read
+    (see compression.open_input).
+    """
+    return compression.open_input(filename, background=background)
 
 
-def write_file(filename, gz_output):
+def write_file(filename, gz_output, compress_level=compression.DEFAULT_COMPRESS_LEVEL, compress_threads=1):
     """
-    Wrapper to write either gzipped or ordinary text file output.
+    Wrapper to write either gzipped or ordinary text file output. The output
+    is written in batches in the background, and gzipped output is compressed
+    in compress_threads threads (see compression.OutputWriter).
     """
     if gz_output:
-        return gzip.open(filename, 'wt')
+        return compression.OutputWriter(filename, 'wt', compress_level, compress_threads)
     else:
-        return open(filename, 'w')
+        return compression.OutputWriter(filename, 'wt')
+
+
+def open_threshold_files(filename, thresholds, gz_output, compress_level=compression.DEFAULT_COMPRESS_LEVEL, compress_threads=1):
+    """
+    Opens one output file per confidence threshold. With a single threshold,
+    the filename is used as is.
+    """
+    if len(thresholds) == 1:
+        return [write_file(filename, gz_output, compress_level, compress_threads)]
+    return [write_file(threshold_filename(filename, threshold), gz_output, compress_level, compress_threads) for threshold in thresholds]
 
 
-def get_arguments():
+def get_arguments(argv=None, allow_abbrev=True):
     """
     Wrapper function to get the command line arguments. Inserting this piece of code
     into its own function for conda compatibility.
+
+    argv:         the arguments to parse instead of sys.argv[1:] (e.g. a job
+                  of stringmeup-batch).
+    allow_abbrev: accept unambiguous abbreviations of the long options.
     """
 
     parser = argparse.ArgumentParser(
         prog='StringMeUp',
+        allow_abbrev=allow_abbrev,
         usage='stringmeup --names <FILE> --nodes <FILE> [--output_report <FILE>] [--output_classifications <FILE>] [--output_verbose <FILE>] [--keep_unclassified] [--minimum_hit_groups INT] [--gz_output] [--help] confidence classifications',
         description='A post-processing tool to reclassify Kraken 2 output based on the confidence score and/or minimum minimizer hit groups.')
     parser.add_argument(
         'confidence_threshold',
         metavar='confidence',
-        type=float,
-        help='The confidence score threshold to be used in reclassification [0-1].')
+        type=parse_confidence_thresholds,
+        help='The confidence score threshold to be used in reclassification [0-1]. Several thresholds can be given as a comma separated list (0.1,0.2,0.5) or as an inclusive range (start:stop:step, e.g. 0:0.5:0.05). The input is then only read once, and the output files are written once per threshold with the threshold added to their names.')
     parser.add_argument(
         'original_classifications_file',
         metavar='classifications',
@@ -742,16 +1659,56 @@ def get_arguments():
         metavar='FILE',
         type=str,
         help='File to send verbose output to. This file will contain, for each read, (1) original classification, (2) new classification, (3) original confidence, (4), new confidence (5), original taxa name (6), new taxa name, (7) original rank, (8) new rank, (9) distance travelled (how many nodes was it lifted upwards in the taxonomy).')
+    parser.add_argument(
+        '--report_only',
+        action='store_true',
+        help='Only output a report of the classifications as they are in the classifications file (e.g. to report them against another taxonomy), without reclassifying the reads. Only the tax_id of each read is read, which is much faster. The confidence threshold is ignored.')
+    parser.add_argument(
+        '--output_ladder',
+        metavar='FILE',
+        type=str,
+        help='File to save the confidence ladder of each read in (binary, gzipped if FILE ends with .gz). The ladder holds the confidence of each read at every node along its lineage where the confidence increases. Later runs can then reclassify the reads at any confidence threshold with --from_ladder, which is much faster than reading the classifications file.')
+    parser.add_argument(
+        '--from_ladder',
+        action='store_true',
+        help='The classifications file is a confidence ladder file, saved with --output_ladder, instead of a Kraken 2 output file.')
+    parser.add_argument(
+        '--output_threshold_index',
+        metavar='FILE',
+        type=str,
+        help='File to save a threshold index in (JSON, gzipped if FILE ends with .gz). It holds, for each taxID, the confidence thresholds at which reads arrive at and leave it, so that reports can be made for any confidence threshold with --from_threshold_index in a fraction of a second. Indexes of several files (e.g. lanes) can be merged with stringmeup-merge-threshold-index.')
+    parser.add_argument(
+        '--from_threshold_index',
+        action='store_true',
+        help='The classifications file is a threshold index, saved with --output_threshold_index. Only the report(s) can be output.')
     parser.add_argument(
         '--names',
         metavar='FILE',
-        required=True,
         help='Taxonomy names dump file (names.dmp)')
     parser.add_argument(
         '--nodes',
         metavar='FILE',
-        required=True,
         help='Taxonomy nodes dump file (nodes.dmp)')
+    parser.add_argument(
+        '--taxonomy_k2d',
+        metavar='FILE',
+        help='Taxonomy file of the Kraken 2 database (taxo.k2d), to use instead of --names and --nodes. It holds the part of the NCBI taxonomy that the database was built with, with the scientific names (but no genbank common names), and is read in a fraction of the time it takes to parse names.dmp and nodes.dmp.')
+    parser.add_argument(
+        '--taxonomy_cache',
+        metavar='FILE',
+        help='Binary cache of the taxonomy in --names and --nodes (or --taxonomy_k2d). It is loaded instead of parsing names.dmp and nodes.dmp if it was built from the same (unmodified) files, otherwise it is (re)built and saved. Can also be built ahead of time with stringmeup-build-taxonomy-cache.')
+    parser.add_argument(
+        '--names_index',
+        metavar='FILE',
+        help='Index of the names in --names. Names are read from names.dmp only when they are needed (for the report and verbose output), by their byte offsets in the file. The index of the offsets is loaded from FILE if it was built from the same (unmodified) names.dmp, otherwise it is (re)built and saved, so later runs don\'t need to read names.dmp at all. Not needed with --taxonomy_cache, which holds the index.')
+    parser.add_argument(
+        '--prune_taxonomy',
+        metavar='FILE',
+        help='Prune the taxonomy to the tax_ids in FILE (one per line) and their ancestors, e.g. the tax_ids of the Kraken 2 database or those collected from classifications files with stringmeup-collect-taxids. The tree is then smaller and faster to load from --taxonomy_cache, which holds the pruned tree. Reports and confidences are the same as with the full taxonomy as long as FILE holds every tax_id that the reads are classified to or have kmers hitting.')
+    parser.add_argument(
+        '--prune_taxonomy_to_input',
+        action='store_true',
+        help='Read the classifications file once first, to collect the tax_ids that its reads are classified to or have kmers hitting, and prune the taxonomy to those and their ancestors (see --prune_taxonomy).')
     parser.add_argument(
         '--minimum_hit_groups',
         metavar='INT',
@@ -762,7 +1719,54 @@ def get_arguments():
         action='store_true',
         help='Set this flag to output <output_classifications> and <output_verbose> in gzipped format (will add .gz extension to the filenames).'
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        '--compress_level',
+        metavar='INT',
+        type=int,
+        default=compression.DEFAULT_COMPRESS_LEVEL,
+        help='Gzip compression level of <output_classifications> and <output_verbose> with --gz_output, and of <output_ladder> if it ends with .gz [0-9, {}]. The files are compressed in as many threads as --threads.'.format(compression.DEFAULT_COMPRESS_LEVEL))
+    parser.add_argument(
+        '--profile_cache_size',
+        metavar='INT',
+        type=int,
+        default=0,
+        help='Cache the reclassification of up to INT distinct read hit profiles (original taxID and kmer hits per taxID), so reads with a hit profile that has been seen before are not reclassified again. Useful for amplicon, host-depleted or clonal samples. With --threads, each worker process has its own cache [0, no cache].')
+    parser.add_argument(
+        '--engine',
+        choices=['python', 'numpy'],
+        default='python',
+        help='Reclassify the reads one at a time in Python, or all reads of a chunk at once with NumPy (which must be installed). The results are the same. The numpy engine can not be used with --from_ladder, --output_ladder or --output_threshold_index [python].')
+    parser.add_argument(
+        '--metrics',
+        metavar='FILE',
+        type=str,
+        help='File to save metrics of the run in (JSON): wall and CPU time of the stages, read counters per confidence threshold, cache statistics, bytes read and written and peak memory.')
+    parser.add_argument(
+        '--shard',
+        metavar='i/N',
+        type=shard.parse_shard,
+        help='Only reclassify the ith of N shards (1 <= i <= N) of an uncompressed classifications file: the lines that start in the ith of N equal byte ranges of the file. The output files of the shards, in order, can be concatenated into those of the whole file, and their reports merged with stringmeup-merge-reports.')
+    parser.add_argument(
+        '--threads',
+        metavar='INT',
+        type=int,
+        default=1,
+        help='Number of worker processes to reclassify reads with [1]. The worker processes read uncompressed classifications files on their own.')
+    parser.add_argument(
+        '--unordered_output',
+        action='store_true',
+        help='With --threads > 1, allow <output_classifications> and <output_verbose> to be written in a different order than the reads in the input file. Keeps all workers busy when some parts of the input are slower to reclassify than others.')
+    args = parser.parse_args(argv)
+
+    if args.threads < 1:
+        parser.error('--threads must be at least 1.')
+    if args.profile_cache_size < 0:
+        parser.error('--profile_cache_size can not be negative.')
+    if not 0 <= args.compress_level <= 9:
+        parser.error('--compress_level must be between 0 and 9.')
+    if args.prune_taxonomy and args.prune_taxonomy_to_input:
+        parser.error('--prune_taxonomy and --prune_taxonomy_to_input can not be used together.')
+    check_taxonomy_arguments(parser, args)
 
     return args
 
@@ -772,13 +1776,100 @@ def stringmeup():
     # Get the CL arguments
     args = get_arguments()
 
+    run_stringmeup(args)
+
+
+def run_stringmeup(args, taxonomy_tree=None):
+    """
+    Reclassifies the classifications file as given by args (see
+    get_arguments), and writes the output files.
+
+    taxonomy_tree: an already loaded TaxonomyTree to use instead of loading
+                   the one in args.names and args.nodes (e.g. one that is
+                   shared by the jobs of stringmeup-batch).
+    """
+
     # Some initial setup
-    taxa_lineages = {}
     report_frequency = 10000000  # Will output progress every nth read
-    tax_reads_dict = {'hits_at_node': {}, 'hits_at_clade': {}}
+    thresholds = args.confidence_threshold
+    tax_reads_dicts = [{'hits_at_node': {}, 'hits_at_clade': {}} for _ in thresholds]
+    run_metrics = metrics.RunMetrics()
+
+    # Several reports can't be sent to stdout
+    if len(thresholds) > 1 and not args.report_only:
+        log.info('Reclassifying with {} confidence thresholds: {}.'.format(
+            len(thresholds), ', '.join('{:g}'.format(t) for t in thresholds)))
+        if not args.output_report:
+            log.error('You need to specify --output_report when using more than one confidence threshold.')
+            sys.exit()
+
+    if args.prune_taxonomy_to_input and (args.from_ladder or args.from_threshold_index):
+        log.error('--prune_taxonomy_to_input needs a Kraken 2 output file as the classifications file.')
+        sys.exit()
 
-    # Was the input generated with https://github.com/danisven/kraken2 ?
-    verbose_input = is_verbose_input(args.original_classifications_file)
+    # Threshold indexes hold all that is needed for the report(s)
+    if args.from_threshold_index:
+        if args.output_classifications or args.output_verbose or args.output_ladder or args.output_threshold_index or args.from_ladder or args.shard:
+            log.error('Only --output_report can be used together with --from_threshold_index.')
+            sys.exit()
+        if taxonomy_tree is None:
+            with run_metrics.stage('taxonomy_load'):
+                taxonomy_tree = load_taxonomy_tree(args, get_prune_tax_ids(args))
+        with run_metrics.stage('report'):
+            reports_from_threshold_index(args.original_classifications_file, taxonomy_tree, args)
+        if args.metrics:
+            save_run_metrics(run_metrics, args, [])
+        return
+
+    # A report of the classifications as they are only needs the tax_id of
+    # each classified read
+    if args.report_only:
+        if args.output_classifications or args.output_verbose or args.output_ladder or args.output_threshold_index or args.from_ladder or args.shard:
+            log.error('Only --output_report can be used together with --report_only.')
+            sys.exit()
+        if thresholds != [0]:
+            log.warning('The confidence threshold is ignored with --report_only, the reads are reported as they are classified in the input file (as with confidence 0).')
+            args.confidence_threshold = [0]
+        if args.minimum_hit_groups:
+            log.warning('--minimum_hit_groups is ignored with --report_only.')
+        if taxonomy_tree is None:
+            with run_metrics.stage('taxonomy_load'):
+                taxonomy_tree = load_taxonomy_tree(args, get_prune_tax_ids(args))
+        report_from_classifications(taxonomy_tree, args, report_frequency, run_metrics)
+        if args.metrics:
+            save_run_metrics(run_metrics, args, [])
+        return
+
+    # The numpy engine reclassifies the reads of a chunk all at once, without
+    # their confidence ladders
+    if args.engine == 'numpy':
+        if numpy_engine.np is None:
+            log.error('--engine numpy needs NumPy, which is not installed (pip install numpy).')
+            sys.exit()
+        if args.from_ladder or args.output_ladder or args.output_threshold_index:
+            log.error('--engine numpy can not be used together with --from_ladder, --output_ladder or --output_threshold_index.')
+            sys.exit()
+        if args.profile_cache_size:
+            log.warning('--profile_cache_size is not used with --engine numpy.')
+            args.profile_cache_size = 0
+
+    # Ladder files know what kind of classifications file they were made from
+    if args.from_ladder:
+        if args.output_ladder:
+            log.error('--output_ladder can not be used together with --from_ladder.')
+            sys.exit()
+        if args.shard:
+            log.error('--shard can not be used together with --from_ladder.')
+            sys.exit()
+        try:
+            with ladder.LadderReader(args.original_classifications_file) as f:
+                verbose_input = f.verbose_input
+        except (OSError, ladder.LadderFileException) as e:
+            log.error(str(e))
+            sys.exit()
+    else:
+        # Was the input generated with https://github.com/danisven/kraken2 ?
+        verbose_input = is_verbose_input(args.original_classifications_file)
 
     # If so, output warnings if input doesn't contain minimizer hit groups
     if verbose_input:
@@ -796,52 +1887,123 @@ def stringmeup():
             log.warning('Will NOT reclassify based on minimizer hit groups.')
             args.minimum_hit_groups = None
 
-    # Check if the input data is paired or not
-    paired_input = is_paired_input(args.original_classifications_file)
-    if paired_input:
-        log.info('Classifications were made from paired-end data.')
-    else:
-        log.info('Classifications were made from single-read data.')
-
-    # Perform a naive check of the input file
-    validate_input_file(args.original_classifications_file, verbose_input, args.minimum_hit_groups, paired_input)
+    if not args.from_ladder:
+        # Check if the input data is paired or not
+        paired_input = is_paired_input(args.original_classifications_file)
+        if paired_input:
+            log.info('Classifications were made from paired-end data.')
+        else:
+            log.info('Classifications were made from single-read data.')
+
+        # Perform a naive check of the input file
+        validate_input_file(args.original_classifications_file, verbose_input, args.minimum_hit_groups, paired_input)
+
+    # Uncompressed classifications files can be split into byte ranges that
+    # are read on their own, by a shard (--shard) or by the worker processes
+    byte_range = None
+    if not args.from_ladder:
+        file_size = path.getsize(args.original_classifications_file)
+        uncompressed = compression.detect_compression(args.original_classifications_file) is None
+        if args.shard:
+            if not uncompressed:
+                log.error('--shard needs an uncompressed classifications file.')
+                sys.exit()
+            byte_range = shard.shard_byte_range(file_size, args.shard)
+            log.info('Reclassifying shard {}/{}: the lines that start in bytes {}-{} of {}.'.format(
+                args.shard.number, args.shard.count, byte_range[0], byte_range[1], file_size))
+        elif uncompressed and args.threads > 1:
+            byte_range = (0, file_size)
 
     # Create a TaxonomyTree from the user provided names.dmp and nodes.dmp files
-    taxonomy_tree = taxonomy.TaxonomyTree(names_filename=args.names, nodes_filename=args.nodes)
+    if taxonomy_tree is None:
+        with run_metrics.stage('taxonomy_load'):
+            taxonomy_tree = load_taxonomy_tree(args, get_prune_tax_ids(args))
 
     # Filehandles-to-be
     o = None
     v = None
+    l = None
+    t_index = None
 
     # Open the classifications input file:
-    with read_file(args.original_classifications_file) as f:
+    if args.from_ladder:
+        input_file = ladder.LadderReader(args.original_classifications_file)
+    else:
+        input_file = read_file(args.original_classifications_file, background=True)
+
+    with input_file as f:
         log.info('Processing read classifications from "{file}".'.format(file=path.abspath(args.original_classifications_file)))
 
         # TODO: make sure output files are writable
-        # If user wants to save the read classifications to file, open file
+        # If user wants to save the read classifications to file, open file(s)
         if args.output_classifications:
             if args.gz_output:
                 if not args.output_classifications.endswith('.gz'):
                     args.output_classifications += '.gz'
-            log.info('Saving reclassified reads in {}.'.format(args.output_classifications))
-            o = write_file(args.output_classifications, args.gz_output)
+            o = open_threshold_files(args.output_classifications, thresholds, args.gz_output, args.compress_level, args.threads)
+            log.info('Saving reclassified reads in {}.'.format(', '.join(handle.name for handle in o)))
 
-        # If user wants to save the verbose classification output to file, open file
+        # If user wants to save the verbose classification output to file, open file(s)
         if args.output_verbose:
             if args.gz_output:
                 if not args.output_verbose.endswith('.gz'):
                     args.output_verbose += '.gz'
-            log.info('Saving verbose classification information in {}.'.format(args.output_verbose))
-            v = write_file(args.output_verbose, args.gz_output)
+            v = open_threshold_files(args.output_verbose, thresholds, args.gz_output, args.compress_level, args.threads)
+            log.info('Saving verbose classification information in {}.'.format(', '.join(handle.name for handle in v)))
+
+        # If user wants to save the confidence ladders of the reads
+        if args.output_ladder:
+            log.info('Saving confidence ladders in {}.'.format(args.output_ladder))
+            l = ladder.LadderWriter(args.output_ladder, verbose_input, args.compress_level, args.threads)
+
+        # If user wants to save a threshold index of the reads
+        if args.output_threshold_index:
+            t_index = threshold_index.ThresholdIndex(args.minimum_hit_groups)
 
         # Run the main loop (reclassification)
-        main_loop(f, tax_reads_dict, taxonomy_tree, args, report_frequency, taxa_lineages, paired_input, verbose_input, o, v)
+        num_lines = main_loop(f, tax_reads_dicts, taxonomy_tree, args, report_frequency, verbose_input, o, v, l, t_index, run_metrics, byte_range=byte_range)
+
+    # Remember to close files (the output that is still buffered is written)
+    with run_metrics.stage('close_outputs'):
+        for handle in (o or []) + (v or []):
+            handle.close()
+        if l:
+            l.close(num_lines)
+
+        if t_index is not None:
+            t_index.save(args.output_threshold_index)
+            log.info('Threshold index saved in {}.'.format(args.output_threshold_index))
 
-    # Remember to close files
-    if o:
-        o.close()
-    if v:
-        v.close()
+    if args.metrics:
+        output_files = [handle.name for handle in (o or []) + (v or [])]
+        if l:
+            output_files.append(l.name)
+        if t_index is not None:
+            output_files.append(args.output_threshold_index)
+        save_run_metrics(run_metrics, args, output_files)
+
+
+def save_run_metrics(run_metrics, args, output_files):
+    """
+    Adds the sizes of the input and output files to run_metrics, and saves
+    the metrics in args.metrics.
+    """
+    if args.output_report:
+        if len(args.confidence_threshold) > 1:
+            output_files = output_files + [threshold_filename(args.output_report, threshold) for threshold in args.confidence_threshold]
+        else:
+            output_files = output_files + [args.output_report]
+
+    run_metrics.bytes['input'] = path.getsize(args.original_classifications_file)
+    input_characters = run_metrics.counters.pop('input_characters', None)
+    if not args.from_ladder:
+        run_metrics.bytes['input_characters'] = input_characters
+    run_metrics.bytes['output'] = {filename: path.getsize(filename) for filename in output_files}
+
+    run_metrics.save(
+        args.metrics,
+        stringmeup_version=__version__,
+        arguments=vars(args))
 
 
 if __name__ == '__main__':
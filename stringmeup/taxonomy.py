@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
+import json
 import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left
 from collections import namedtuple
+from itertools import compress, islice
 from dataclasses import dataclass, field
 from os import path
 
@@ -24,6 +33,9 @@ class Node:
 
 Rank = namedtuple('Rank', ['rank_name', 'rank_code', 'rank_depth'])
 
+# The arrays of a TaxonomyTree (see TaxonomyTree.get_node_arrays)
+NodeArrays = namedtuple('NodeArrays', ['index', 'tax_ids', 'parents', 'depths', 'entries', 'exits'])
+
 # Using the same rank codes as Kraken 2 (https://github.com/DerrickWood/kraken2/blob/master/src/reports.cc)
 translate_rank2code = {
     'superkingdom': 'D',
@@ -36,90 +48,485 @@ translate_rank2code = {
     'species': 'S'
 }
 
+# All rank codes, indexed by the values in TaxonomyTree._rank_codes
+all_rank_codes = ['R'] + list(translate_rank2code.values())
+
+
+# Binary taxonomy cache (see TaxonomyTree.save_cache). The file starts with
+# the magic bytes and the length of a JSON header, which describes the source
+# files the cache was built from and where the arrays are in the file.
+CACHE_MAGIC = b'SMUPTAX1'
+CACHE_PREAMBLE = struct.Struct('<8sQ')
+CACHE_VERSION = 5
+
+# Names index files (see NamesIndex.save) are laid out like the cache
+NAMES_INDEX_MAGIC = b'SMUPNAM1'
+NAMES_INDEX_VERSION = 1
+
+# Taxonomy file of a Kraken 2 database (taxo.k2d, see Taxonomy::WriteToDisk
+# in Kraken 2): the magic, the number of nodes and the lengths of the name
+# and rank data, followed by the nodes (seven uint64 each, node 0 is not
+# used) and the null-terminated names and ranks that the nodes point into
+K2D_MAGIC = b'K2TAXDAT'
+K2D_HEADER = struct.Struct('<8sQQQ')
+K2D_NODE_FIELDS = 7
+K2D_PARENT, K2D_NAME_OFFSET, K2D_RANK_OFFSET, K2D_EXTERNAL_ID = 0, 3, 4, 5
+
 
 class TaxonomyTreeException(Exception):
     pass
 
 
+def file_signature(filename, fingerprint_size=1 << 20):
+    """
+    Returns the size, modification time and a fingerprint (sha1 of the first
+    and last MiB) of a file. Used to decide if a taxonomy cache is still valid
+    for the names.dmp and nodes.dmp it was built from, without having to read
+    the complete files.
+    """
+    stat = os.stat(filename)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        sha1.update(f.read(fingerprint_size))
+        if stat.st_size > fingerprint_size:
+            f.seek(max(fingerprint_size, stat.st_size - fingerprint_size))
+            sha1.update(f.read(fingerprint_size))
+
+    return {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'fingerprint': sha1.hexdigest()}
+
+
+def _write_sections(filename, magic, header, sections):
+    """
+    Writes a binary file of arrays (sections, a list of (name, array)): the
+    magic bytes and the length of a JSON header, the header (where the
+    arrays are added under 'sections'), and the arrays as they are, aligned
+    to 8 bytes so that they can be used directly from a memory map. The file
+    is replaced atomically.
+    """
+    header = dict(header, sections={})
+    position = 0
+    for name, data in sections:
+        data = memoryview(data)
+        header['sections'][name] = {'typecode': data.format, 'offset': position, 'nbytes': data.nbytes}
+        position += data.nbytes + (-data.nbytes % 8)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(CACHE_PREAMBLE.size + len(header_bytes)) % 8)
+
+    tmp_filename = filename + '.tmp{}'.format(os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(CACHE_PREAMBLE.pack(magic, len(header_bytes)))
+        f.write(header_bytes)
+        for name, data in sections:
+            data = memoryview(data)
+            f.write(data)
+            f.write(b'\0' * (-data.nbytes % 8))
+    os.replace(tmp_filename, filename)
+
+
+def _map_sections(filename, magic):
+    """
+    Memory-maps a file written by _write_sections. Returns (the map, the
+    header, {name: array (a memoryview into the map)}). Raises ValueError or
+    struct.error if the file is not of the expected format.
+    """
+    with open(filename, 'rb') as f:
+        file_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, header_size = CACHE_PREAMBLE.unpack_from(file_map)
+        if file_magic != magic:
+            raise ValueError('not a {} file'.format(magic.decode('ascii', 'replace')))
+        header = json.loads(file_map[CACHE_PREAMBLE.size:CACHE_PREAMBLE.size + header_size])
+
+    data_start = CACHE_PREAMBLE.size + header_size
+    view = memoryview(file_map)
+    data = {}
+    for name, section in header['sections'].items():
+        start = data_start + section['offset']
+        data[name] = view[start:start + section['nbytes']].cast(section['typecode'])
+
+    return file_map, header, data
+
+
+def read_tax_id_list(filename):
+    """
+    Reads a list of tax_ids, one per line (the first column of each line is
+    used). Empty lines and lines that start with # are skipped.
+    """
+    tax_ids = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                tax_ids.append(int(fields[0]))
+            except ValueError:
+                raise TaxonomyTreeException('"{}" in "{}" is not a tax_id.'.format(fields[0], filename))
+    return tax_ids
+
+
+def tax_ids_signature(tax_ids):
+    """
+    Returns a fingerprint (sha1) of a set of tax_ids, to tell the caches of
+    trees that are pruned to different sets of tax_ids apart.
+    """
+    return hashlib.sha1(','.join(map(str, sorted(set(tax_ids)))).encode('ascii')).hexdigest()
+
+
+class NamesIndex:
+    """
+    The scientific and genbank common names of the tax_ids in a names.dmp
+    file, read from the file when they are asked for. Reports and verbose
+    output only need the names of a small part of the taxonomy, so only the
+    tax_ids (sorted) and the byte offsets of their lines in names.dmp are
+    kept in memory, and the names are looked up in a memory map of the file.
+
+    Building the index takes one pass over names.dmp. It can be saved (see
+    save) and loaded (see load) by later runs, which then don't read
+    names.dmp at all until a name is needed.
+    """
+
+    name_types = {
+        b'scientific name': 'scientific',
+        b'genbank common name': 'common'}
+
+    def __init__(self, names_filename, sections=None):
+        """
+        sections: the arrays of the index ({name: array}, see
+                  _index_sections), or None to build them from names_filename.
+        """
+        self.names_filename = names_filename
+        self._map = None
+
+        if sections is None:
+            sections = self._build()
+
+        self._tax_ids = sections['tax_ids']
+        self._offsets = sections['offsets']
+        self._common_tax_ids = sections['common_tax_ids']
+        self._common_offsets = sections['common_offsets']
+
+    def _build(self):
+        """
+        Finds the lines with the wanted name types in names.dmp. The file is
+        searched in large blocks for the name types, and only the lines they
+        are found on are split into fields.
+        """
+        found = {name_type: (array('q'), array('q')) for name_type in self.name_types.values()}
+        block_size = 1 << 24
+
+        with open(self.names_filename, 'rb') as f:
+            position = 0
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                if not block.endswith(b'\n'):
+                    block += f.readline()
+
+                for name_type, key in self.name_types.items():
+                    tax_ids, offsets = found[key]
+                    j = block.find(name_type)
+                    while j >= 0:
+                        line_start = block.rfind(b'\n', 0, j) + 1
+                        line_end = block.find(b'\n', j)
+                        if line_end < 0:
+                            line_end = len(block)
+                        name_info = block[line_start:line_end].split(b'|')
+                        if len(name_info) > 3 and name_info[3].strip() == name_type:
+                            tax_ids.append(int(name_info[0].strip()))
+                            offsets.append(position + line_start)
+                        j = block.find(name_type, line_end)
+
+                position += len(block)
+
+        sections = {}
+        for key, prefix in (('scientific', ''), ('common', 'common_')):
+            tax_ids, offsets = self._sort(*found[key])
+            sections[prefix + 'tax_ids'] = tax_ids
+            sections[prefix + 'offsets'] = offsets
+
+        return sections
+
+    @staticmethod
+    def _sort(tax_ids, offsets):
+        """
+        Sorts the tax_ids (and their offsets), unless they are sorted already
+        as in the NCBI names.dmp. There should only be one name of each type
+        for a tax_id.
+        """
+        if any(tax_id >= next_tax_id for tax_id, next_tax_id in zip(tax_ids, islice(tax_ids, 1, None))):
+            order = sorted(range(len(tax_ids)), key=tax_ids.__getitem__)
+            tax_ids = array('q', [tax_ids[k] for k in order])
+            offsets = array('q', [offsets[k] for k in order])
+            for k in range(len(tax_ids) - 1):
+                if tax_ids[k] == tax_ids[k + 1]:
+                    raise TaxonomyTreeException("Found more than one name of the same type for a unique tax_id. The tax_id was '{}'".format(tax_ids[k]))
+        return tax_ids, offsets
+
+    def _index_sections(self):
+        return [
+            ('tax_ids', self._tax_ids),
+            ('offsets', self._offsets),
+            ('common_tax_ids', self._common_tax_ids),
+            ('common_offsets', self._common_offsets)]
+
+    def __len__(self):
+        return len(self._tax_ids)
+
+    def __getstate__(self):
+        # The memory maps are opened again when needed (e.g. in worker
+        # processes), and arrays from a memory map are copied
+        state = self.__dict__.copy()
+        state['_map'] = None
+        state.pop('_index_map', None)
+        for name, value in state.items():
+            if isinstance(value, memoryview):
+                state[name] = array(value.format, value)
+        return state
+
+    def _get_map(self):
+        if self._map is None:
+            with open(self.names_filename, 'rb') as f:
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _get_line_name(self, offset):
+        """
+        Returns the name (field 2) of the line at offset in names.dmp.
+        """
+        names_map = self._get_map()
+        line_end = names_map.find(b'\n', offset)
+        if line_end < 0:
+            line_end = len(names_map)
+        return names_map[offset:line_end].split(b'|')[1].strip().decode('utf-8')
+
+    @staticmethod
+    def _find(tax_ids, tax_id):
+        k = bisect_left(tax_ids, tax_id)
+        if k < len(tax_ids) and tax_ids[k] == tax_id:
+            return k
+        return -1
+
+    def get_name(self, tax_id):
+        """
+        Returns the scientific name of tax_id. Raises KeyError if it has none.
+        """
+        k = self._find(self._tax_ids, tax_id)
+        if k < 0:
+            raise KeyError(tax_id)
+        return self._get_line_name(self._offsets[k])
+
+    def get_common_name(self, tax_id):
+        """
+        Returns the genbank common name of tax_id, or None if it has none.
+        """
+        k = self._find(self._common_tax_ids, tax_id)
+        if k < 0:
+            return None
+        return self._get_line_name(self._common_offsets[k])
+
+    def find_missing(self, tax_ids):
+        """
+        Returns the lowest of the tax_ids that has no scientific name, or
+        None if they all have one.
+        """
+        missing = set(tax_ids).difference(self._tax_ids)
+        return min(missing) if missing else None
+
+    def subset(self, tax_ids):
+        """
+        Returns an index (of the same kind) of the names of the (sorted)
+        tax_ids only.
+        """
+        sections = {}
+        for prefix, index_tax_ids, offsets in (
+                ('', self._tax_ids, self._offsets),
+                ('common_', self._common_tax_ids, self._common_offsets)):
+            found = [k for k in (self._find(index_tax_ids, tax_id) for tax_id in tax_ids) if k >= 0]
+            sections[prefix + 'tax_ids'] = array('q', [index_tax_ids[k] for k in found])
+            sections[prefix + 'offsets'] = array('q', [offsets[k] for k in found])
+
+        return type(self)(self.names_filename, sections)
+
+    def items(self):
+        """
+        Yields (tax_id, scientific name) of all tax_ids, in tax_id order.
+        """
+        for tax_id, offset in zip(self._tax_ids, self._offsets):
+            yield tax_id, self._get_line_name(offset)
+
+    def save(self, index_filename):
+        """
+        Saves the index, so that it can be loaded instead of built as long
+        as names.dmp is not modified.
+        """
+        _write_sections(
+            index_filename,
+            NAMES_INDEX_MAGIC,
+            {'version': NAMES_INDEX_VERSION, 'source': file_signature(self.names_filename)},
+            self._index_sections())
+        log.info('Names index saved in "{index_file}".'.format(index_file=index_filename))
+
+    @classmethod
+    def load(cls, names_filename, index_filename):
+        """
+        Loads an index saved by save. Returns None if the index doesn't
+        exist, is of the wrong format, or was built from another (or since
+        modified) names.dmp file.
+        """
+        if not path.isfile(index_filename):
+            log.info('Found no names index in "{index_file}".'.format(index_file=index_filename))
+            return None
+
+        try:
+            index_map, header, data = _map_sections(index_filename, NAMES_INDEX_MAGIC)
+        except (ValueError, struct.error) as e:
+            log.warning('Could not read the names index "{index_file}" ({error}), will rebuild it.'.format(index_file=index_filename, error=e))
+            return None
+
+        if header['version'] != NAMES_INDEX_VERSION or header['source'] != file_signature(names_filename):
+            log.info('The names index "{index_file}" is outdated, will rebuild it.'.format(index_file=index_filename))
+            return None
+
+        names_index = cls(names_filename, data)
+        names_index._index_map = index_map
+        return names_index
+
+
+class K2dNamesIndex(NamesIndex):
+    """
+    The names of the tax_ids in a Kraken 2 taxonomy file (taxo.k2d), read
+    from the file when they are asked for, like NamesIndex. The offsets are
+    those of the null-terminated scientific names in the file; taxo.k2d has
+    no genbank common names.
+    """
+
+    def _build(self):
+        raise TaxonomyTreeException('The names index of "{}" is built with the taxonomy tree (see TaxonomyTree.construct_tree_from_k2d).'.format(self.names_filename))
+
+    def _get_line_name(self, offset):
+        """
+        Returns the null-terminated name at offset in taxo.k2d.
+        """
+        k2d_map = self._get_map()
+        return k2d_map[offset:k2d_map.find(b'\0', offset)].decode('utf-8')
+
+
 class TaxonomyTree:
     """
     Creates a representation of the taxonomy in the files names.dmp and
-    nodes.dmp of a kraken2 database.
+    nodes.dmp of a kraken2 database, or in the taxonomy file of the database
+    itself (taxo.k2d, see construct_tree_from_k2d).
+
+    The tax_ids are remapped to dense indices (0..N-1), and the tree is kept
+    in typed arrays indexed by them: the tax_id, parent index, depth and rank
+    of every node, the children in CSR style (children_offsets[i] to
+    children_offsets[i + 1] in children are the children of node i, in the
+    order they appear in nodes.dmp). The names are read from names.dmp when
+    they are needed (see NamesIndex). This keeps the full NCBI taxonomy
+    small, and avoids copying of memory pages in forked workers.
+
+    The nodes are also numbered in depth first (pre-order) order. The clade
+    rooted at node i is then the nodes numbered entries[i] to exits[i] - 1, so
+    ancestry can be tested with two integer comparisons (see is_ancestor).
 
     Inspired by https://github.com/frallain/NCBI_taxonomy_tree.
     """
 
-    def __init__(self, nodes_filename, names_filename):
+    def __init__(self, nodes_filename=None, names_filename=None, cache_filename=None, names_index_filename=None, prune_tax_ids=None, k2d_filename=None):
+        """
+        prune_tax_ids: tax_ids to prune the tree to (see prune), e.g. those of
+                       a Kraken 2 database. A cache of a pruned tree is only
+                       loaded for the same set of tax_ids.
+        k2d_filename:  taxo.k2d of a Kraken 2 database, to read the taxonomy
+                       from instead of nodes_filename and names_filename.
+        """
+        if k2d_filename is None and (nodes_filename is None or names_filename is None):
+            raise TaxonomyTreeException('A taxonomy tree needs either a nodes.dmp and a names.dmp file, or a taxo.k2d file.')
+
+        self.k2d_filename = k2d_filename
         self.nodes_filename = nodes_filename
         self.names_filename = names_filename
-        self.wanted_name_types = set(
-            ['scientific name', 'genbank common name'])
-
-        # Main data structure
-        self.taxonomy = {}
-
-        self.byranks = {}
-        self.leaves = set()
+        self.names_index_filename = names_index_filename
+        self.pruned_to = tax_ids_signature(prune_tax_ids) if prune_tax_ids is not None else None
+
+        # Main data structures (arrays indexed by node index)
+        self.num_nodes = 0
+        self._index = None
+        self._tax_ids = None
+        self._parents = None
+        self._depths = None
+        self._entries = None
+        self._exits = None
+        self._rank_codes = None
+        self._rank_depths = None
+        self._ranks = None
+        self._rank_names = []
+        self._children_offsets = None
+        self._children = None
+        self._names_index = None
+
+        # Binary lifting table for LCA queries (see build_lca_index)
+        self._ancestors = None
 
         # "Memory" data structure to be populated at function calls
         # For faster response in case of same query is asked again
         self.lineages = {}
-        self.distances = {}
-        self.lca_mappings = {}
+        self.formatted_rank_codes = {}
+
+        # Build the tree, from the cache if there is a valid one
+        if cache_filename and self.load_cache(cache_filename):
+            return
+
+        if k2d_filename is not None:
+            self.construct_tree_from_k2d()
+        else:
+            self.construct_tree()
 
-        # Add nodes to self.taxonomy
-        self.construct_tree()
+        if prune_tax_ids is not None:
+            self.prune(list(prune_tax_ids))
+
+        if cache_filename:
+            self.save_cache(cache_filename)
 
     def construct_tree(self):
         """
         Reads a names.dmp and nodes.dmp file, and constructs a taxonomy tree
-        representation:
-            {tax_id#1: Node('name', 'genbank_common_name', 'rank', 'parent', 'children'),
-             tax_id#2: Node('name', 'genbank_common_name', 'rank', 'parent', 'children'),
-             ...,
-             tax_id#N: ...}
+        representation (see the class docstring). Nodes get their index in
+        the order they are first seen in nodes.dmp, as a node or as a parent.
         """
 
         log.info("Constructing taxonomy tree...")
-        taxid2name = {}
 
         try:
-            log.info('Mapping taxonomic ID to scientific and genbank common names from "{names_file}"...'.format(names_file=self.names_filename))
-            # TODO: check so that names.dmp conforms to expected format
-            with open(self.names_filename, 'r') as f:
-                for name_line in f:
-                    name_info = name_line.split('|')
-                    name_type = name_info[3].strip()
-                    if name_type not in self.wanted_name_types:
-                        continue
-
-                    tax_id = int(name_info[0].strip())
-                    if tax_id not in taxid2name:
-                        taxid2name[tax_id] = {
-                            'scientific_name': None,
-                            'genbank_common_name': None}
-
-                    tax_name = name_info[1].strip()
-
-                    if name_type == 'scientific name':
-                        if taxid2name[tax_id]['scientific_name'] is not None:
-                            # Some logical checking, should only be one scientific name for a tax_id
-                            raise TaxonomyTreeException("Found more than one scientific name for a unique tax_id. The tax_id was '{}'".format(tax_id))
-                        taxid2name[tax_id]['scientific_name'] = tax_name
-
-                    elif name_type == 'genbank common name':
-                        if taxid2name[tax_id]['genbank_common_name'] is not None:
-                            # Some logical checking, should only be one genbank common name for a tax_id
-                            raise TaxonomyTreeException("Found more than one genbank common name for a unique tax_id. The tax_id was '{}'".format(tax_id))
-                        taxid2name[tax_id]['genbank_common_name'] = tax_name
-
-                    else:
-                        raise TaxonomyTreeException("Logical error. Should not end up here. name_type was '{}'".format(tax_name))
-
+            self._names_index = self._get_names_index()
         except FileNotFoundError:
             log.exception('Could not find the file "{names_file}".'.format(names_file=self.names_filename))
             raise
 
+        index = {}
+        tax_ids = array('q')
+        parents = array('i')
+        ranks = array('H')
+        rank_index = {None: 0}
+        rank_names = [None]
+
+        # The (child, parent) edges, in nodes.dmp order
+        edge_children = array('i')
+        edge_parents = array('i')
+
+        def get_or_add_index(tax_id):
+            if tax_id not in index:
+                index[tax_id] = len(tax_ids)
+                tax_ids.append(tax_id)
+                parents.append(-1)
+                ranks.append(0)
+            return index[tax_id]
+
         try:
             log.info('Reading taxonomy from "{nodes_file}"...'.format(nodes_file=self.nodes_filename))
             # TODO: check so that nodes.dmp conforms to expected format
@@ -129,53 +536,507 @@ class TaxonomyTree:
                     tax_id = int(tax_info[0].strip())
                     tax_parent = int(tax_info[1].strip())
                     tax_rank = tax_info[2].strip()
-                    tax_scientific_name = taxid2name[tax_id]['scientific_name']
-                    tax_common_name = taxid2name[tax_id]['genbank_common_name']
-
-                    if tax_id in self.taxonomy:
-                        # We already inserted the current tax_id as a parent of another
-                        self.taxonomy[tax_id].rank = tax_rank
-                        self.taxonomy[tax_id].parent = tax_parent
-                    else:
-                        node = Node(
-                            name=tax_scientific_name,
-                            genbank_common_name=tax_common_name,
-                            rank=tax_rank,
-                            parent=tax_parent,
-                            children=[])
-                        self.taxonomy[tax_id] = node
-                        self.leaves.add(tax_id)
-
-                    if tax_parent in self.taxonomy:
-                        self.taxonomy[tax_parent].children.append(tax_id)
-                        if tax_parent in self.leaves:
-                            self.leaves.remove(tax_parent)
-                    else:
-                        parent_node = Node(
-                            name=taxid2name[tax_parent]['scientific_name'],
-                            genbank_common_name=taxid2name[tax_parent]['genbank_common_name'],
-                            rank=None,
-                            parent=None,
-                            children=[tax_id])
-                        self.taxonomy[tax_parent] = parent_node
-
-                    # Save the tax_id to it's corresponding rank set
-                    if tax_rank in self.byranks:
-                        self.byranks[tax_rank].add(tax_id)
-                    else:
-                        self.byranks[tax_rank] = set([tax_id])
+
+                    if tax_rank not in rank_index:
+                        rank_index[tax_rank] = len(rank_names)
+                        rank_names.append(tax_rank)
+
+                    i = get_or_add_index(tax_id)
+                    parent_i = get_or_add_index(tax_parent)
+                    ranks[i] = rank_index[tax_rank]
+
+                    # The root (tax_id=1) is its own parent in nodes.dmp, but
+                    # has no parent in the tree
+                    if tax_id == 1 and tax_parent == 1:
+                        continue
+
+                    parents[i] = parent_i
+                    edge_children.append(i)
+                    edge_parents.append(parent_i)
 
         except FileNotFoundError:
             log.exception('Could not find the nodes file "{nodes_file}".'.format(nodes_file=self.nodes_filename))
             raise
 
-        # Adjust the root (the root is tax_id=1, and its parent is also tax_id=1)
-        root_children = self.taxonomy[1].children
-        root_children.remove(1)
-        self.taxonomy[1].parent = None
-        self.taxonomy[1].children = root_children
+        # Every tax_id in nodes.dmp must have a scientific name
+        self._check_names(tax_ids)
+
+        self._tax_ids = tax_ids
+        self._parents = parents
+        self._ranks = ranks
+        self._rank_names = rank_names
+        self.num_nodes = len(tax_ids)
+        self._set_children(edge_children, edge_parents)
+        self._index = self._make_index(tax_ids)
+        self._set_tree_order()
+        self._set_rank_codes()
+
+        log.info("Taxonomy tree built.")
+
+    def _check_names(self, tax_ids):
+        """
+        Raises TaxonomyTreeException if any of the tax_ids has no scientific
+        name in the names index.
+        """
+        missing_tax_id = self._names_index.find_missing(tax_ids)
+        if missing_tax_id is not None:
+            raise TaxonomyTreeException("Found no scientific name for a tax_id in the taxonomy. The tax_id was '{}'".format(missing_tax_id))
+
+    def construct_tree_from_k2d(self):
+        """
+        Reads the taxonomy file of a Kraken 2 database (taxo.k2d), and
+        constructs the taxonomy tree representation from it. Kraken 2 numbers
+        the nodes of its taxonomy in breadth first order (internal IDs, from 1
+        for the root), with the children of each node next to each other, and
+        reports the external IDs (the NCBI tax_ids) of the nodes. Node i of
+        the tree is internal ID i + 1, and its tax_id is the external ID.
+
+        The file is memory-mapped, and the names are read from it when they
+        are needed (see K2dNamesIndex).
+        """
+        log.info('Reading taxonomy from Kraken 2 taxonomy file "{k2d_file}"...'.format(k2d_file=self.k2d_filename))
+
+        try:
+            with open(self.k2d_filename, 'rb') as f:
+                k2d_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            log.exception('Could not find the Kraken 2 taxonomy file "{k2d_file}".'.format(k2d_file=self.k2d_filename))
+            raise
+
+        with k2d_map:
+            try:
+                magic, node_count, name_data_len, rank_data_len = K2D_HEADER.unpack_from(k2d_map)
+            except struct.error:
+                magic = None
+            if magic != K2D_MAGIC:
+                raise TaxonomyTreeException('"{}" is not a Kraken 2 taxonomy file (taxo.k2d).'.format(self.k2d_filename))
+
+            name_data_start = K2D_HEADER.size + node_count * K2D_NODE_FIELDS * 8
+            rank_data_start = name_data_start + name_data_len
+            if node_count < 2 or len(k2d_map) < rank_data_start + rank_data_len:
+                raise TaxonomyTreeException('The Kraken 2 taxonomy file "{}" is truncated.'.format(self.k2d_filename))
+
+            # Kraken 2 writes the nodes in the byte order of the machine
+            nodes = array('Q')
+            nodes.frombytes(k2d_map[K2D_HEADER.size:name_data_start])
+            if sys.byteorder != 'little':
+                nodes.byteswap()
+
+            # Node 0 of taxo.k2d is not used (internal ID 0 is "no node")
+            first = K2D_NODE_FIELDS
+            tax_ids = array('q', nodes[first + K2D_EXTERNAL_ID::K2D_NODE_FIELDS])
+            parents = array('i', [parent_id - 1 for parent_id in nodes[first + K2D_PARENT::K2D_NODE_FIELDS]])
+
+            rank_index = {}
+            rank_names = [None]
+            ranks = array('H')
+            for rank_offset in nodes[first + K2D_RANK_OFFSET::K2D_NODE_FIELDS]:
+                if rank_offset not in rank_index:
+                    start = rank_data_start + rank_offset
+                    rank_index[rank_offset] = len(rank_names)
+                    rank_names.append(k2d_map[start:k2d_map.find(b'\0', start)].decode('utf-8'))
+                ranks.append(rank_index[rank_offset])
+
+            name_offsets = array('q', [name_data_start + name_offset for name_offset in nodes[first + K2D_NAME_OFFSET::K2D_NODE_FIELDS]])
+
+        # The children of each node are in internal ID order
+        edge_children = array('i', [i for i in range(len(tax_ids)) if parents[i] >= 0])
+        edge_parents = array('i', [parents[i] for i in edge_children])
+
+        name_tax_ids, name_offsets = NamesIndex._sort(tax_ids, name_offsets)
+        self._names_index = K2dNamesIndex(self.k2d_filename, {
+            'tax_ids': name_tax_ids,
+            'offsets': name_offsets,
+            'common_tax_ids': array('q'),
+            'common_offsets': array('q')})
+
+        self._tax_ids = tax_ids
+        self._parents = parents
+        self._ranks = ranks
+        self._rank_names = rank_names
+        self.num_nodes = len(tax_ids)
+        self._set_children(edge_children, edge_parents)
+        self._index = self._make_index(tax_ids)
+        self._set_tree_order()
+        self._set_rank_codes()
+
         log.info("Taxonomy tree built.")
 
+    def prune(self, tax_id_list):
+        """
+        Prunes the tree to the tax_ids in the list and all of their ancestors
+        (tax_ids that are not in the tree are skipped). The nodes that are
+        kept stay in the same order, and so do their children, so the depths,
+        rank codes and depth first order of the nodes are the same as in the
+        full tree. Reports, and the confidences of reads that only have kmers
+        hitting the tax_ids in the list, are therefore the same as with the
+        full tree.
+
+        Returns the number of tax_ids in the list that were not in the tree.
+        """
+        self._verify_list(tax_id_list)
+        parents = self._parents
+        keep = bytearray(self.num_nodes)
+        num_missing = 0
+
+        for tax_id in tax_id_list:
+            if tax_id not in self:
+                num_missing += 1
+                continue
+
+            # Walk up until a node that is already kept (with its ancestors)
+            i = self._get_index(tax_id)
+            while i >= 0 and not keep[i]:
+                keep[i] = 1
+                i = parents[i]
+
+        kept = array('i', compress(range(self.num_nodes), keep))
+        new_index = array('i', [-1]) * self.num_nodes
+        for new_i, i in enumerate(kept):
+            new_index[i] = new_i
+
+        # The (child, parent) edges, in the order of the children of each node
+        children_offsets = self._children_offsets
+        children = self._children
+        edge_children = array('i')
+        edge_parents = array('i')
+        for new_i, i in enumerate(kept):
+            for child_i in children[children_offsets[i]:children_offsets[i + 1]]:
+                if keep[child_i]:
+                    edge_children.append(new_index[child_i])
+                    edge_parents.append(new_i)
+
+        self._tax_ids = array('q', [self._tax_ids[i] for i in kept])
+        self._parents = array('i', [new_index[parents[i]] if parents[i] >= 0 else -1 for i in kept])
+        self._ranks = array('H', [self._ranks[i] for i in kept])
+        self.num_nodes = len(kept)
+        self._set_children(edge_children, edge_parents)
+        self._index = self._make_index(self._tax_ids)
+        self._set_tree_order()
+        self._set_rank_codes()
+        self._names_index = self._names_index.subset(sorted(self._tax_ids))
+
+        # The subset has a name for each kept tax_id, if none is missing
+        if len(self._names_index) != self.num_nodes:
+            self._check_names(self._tax_ids)
+        self.pruned_to = tax_ids_signature(tax_id_list)
+
+        # Nothing is left in the cache file, and the memoised answers and the
+        # LCA table are of the full tree
+        self.__dict__.pop('_cache_map', None)
+        self._ancestors = None
+        self.lineages = {}
+        self.formatted_rank_codes = {}
+
+        log.info('Pruned the taxonomy tree to {} nodes ({} tax_ids and their ancestors).'.format(self.num_nodes, len(tax_id_list) - num_missing))
+        if num_missing:
+            log.warning('{} of the tax_ids to prune the taxonomy tree to are not in the tree.'.format(num_missing))
+
+        return num_missing
+
+    def _get_names_index(self):
+        """
+        Loads the names index from self.names_index_filename if there is a
+        valid one, otherwise builds it from names.dmp (and saves it in
+        self.names_index_filename, if given).
+        """
+        if self.names_index_filename:
+            names_index = NamesIndex.load(self.names_filename, self.names_index_filename)
+            if names_index is not None:
+                log.info('Loaded the names index "{index_file}".'.format(index_file=self.names_index_filename))
+                return names_index
+
+        log.info('Indexing the scientific and genbank common names in "{names_file}"...'.format(names_file=self.names_filename))
+        names_index = NamesIndex(self.names_filename)
+
+        if self.names_index_filename:
+            names_index.save(self.names_index_filename)
+
+        return names_index
+
+    def _set_children(self, edge_children, edge_parents):
+        """
+        Builds the CSR children arrays from (child, parent) edges. The children
+        of each node are kept in the order of the edges.
+        """
+        children_offsets = array('i', [0]) * (self.num_nodes + 1)
+        for parent_i in edge_parents:
+            children_offsets[parent_i + 1] += 1
+        for i in range(self.num_nodes):
+            children_offsets[i + 1] += children_offsets[i]
+
+        children = array('i', [0]) * len(edge_children)
+        position = array('i', children_offsets[:-1])
+        for child_i, parent_i in zip(edge_children, edge_parents):
+            children[position[parent_i]] = child_i
+            position[parent_i] += 1
+
+        self._children_offsets = children_offsets
+        self._children = children
+
+    def _set_tree_order(self):
+        """
+        Calculates the depth (number of edges from the root) of every node,
+        and the pre-order numbering of the nodes (entries) together with the
+        end of the numbering of their clades (exits), in one depth first pass
+        over the tree.
+        """
+        depths = array('H', [0]) * self.num_nodes
+        entries = array('i', [0]) * self.num_nodes
+        exits = array('i', [0]) * self.num_nodes
+        children_offsets = self._children_offsets
+        children = self._children
+        parents = self._parents
+
+        preorder = []
+        stack = [i for i in range(self.num_nodes) if parents[i] < 0]
+        stack.reverse()
+        while stack:
+            i = stack.pop()
+            entries[i] = len(preorder)
+            preorder.append(i)
+            depth = depths[i] + 1
+            node_children = children[children_offsets[i]:children_offsets[i + 1]]
+            for child_i in node_children:
+                depths[child_i] = depth
+            stack.extend(reversed(node_children))
+
+        # Clade sizes, from the leaves and up
+        clade_sizes = array('i', [1]) * self.num_nodes
+        for i in reversed(preorder):
+            if parents[i] >= 0:
+                clade_sizes[parents[i]] += clade_sizes[i]
+        for i in preorder:
+            exits[i] = entries[i] + clade_sizes[i]
+
+        self._depths = depths
+        self._entries = entries
+        self._exits = exits
+
+    def _set_rank_codes(self):
+        """
+        Calculates the rank code and rank depth (see get_rank_code) of every
+        node, in one top-down pass over the tree: a node with a rank in
+        translate_rank2code gets that code at depth 0, the root gets R, and
+        any other node gets the rank code of its parent, one level deeper.
+        """
+        code_index = {code: k for k, code in enumerate(all_rank_codes)}
+        rank_code_of_rank = [
+            code_index[translate_rank2code[rank]] if rank in translate_rank2code else -1
+            for rank in self._rank_names]
+
+        node_rank_codes = array('B', [0]) * self.num_nodes
+        rank_depths = array('H', [0]) * self.num_nodes
+        parents = self._parents
+
+        # Parents come before their children in the depth first order
+        preorder = array('i', [0]) * self.num_nodes
+        for i, entry in enumerate(self._entries):
+            preorder[entry] = i
+
+        for i in preorder:
+            rank_code = rank_code_of_rank[self._ranks[i]]
+            parent_i = parents[i]
+            if rank_code >= 0:
+                node_rank_codes[i] = rank_code
+            elif self._tax_ids[i] == 1 or parent_i < 0:
+                # Special case for root, as it has rank 'no rank'
+                node_rank_codes[i] = code_index['R']
+            else:
+                node_rank_codes[i] = node_rank_codes[parent_i]
+                rank_depths[i] = rank_depths[parent_i] + 1
+
+        self._rank_codes = node_rank_codes
+        self._rank_depths = rank_depths
+
+    @staticmethod
+    def _make_index(tax_ids):
+        """
+        Returns the tax_id -> index mapping. That is a lookup table (an array
+        indexed by tax_id, -1 for missing tax_ids) if the tax_ids are dense
+        enough, such as for the NCBI taxonomy, otherwise a dict.
+        """
+        max_tax_id = max(tax_ids) if len(tax_ids) else 0
+        if 0 <= min(tax_ids, default=0) and max_tax_id < 4 * len(tax_ids) + 1000000:
+            index = array('i', [-1]) * (max_tax_id + 1)
+            for i, tax_id in enumerate(tax_ids):
+                index[tax_id] = i
+        else:
+            index = {tax_id: i for i, tax_id in enumerate(tax_ids)}
+        return index
+
+    def _get_index(self, tax_id):
+        """
+        Internal function to get the index of a tax_id in the arrays.
+        Raises an exception if tax_id does not exist in the taxonomy tree.
+        Raises an exception if the taxonomy tree isn't built yet.
+        """
+        if not self.num_nodes:
+            log.exception('You have not built the taxonomy tree yet.')
+            raise TaxonomyTreeException('You have not built the taxonomy tree yet.')
+
+        try:
+            i = self._index[tax_id] if tax_id >= 0 else -1
+        except (IndexError, KeyError, TypeError):
+            i = -1
+
+        if i < 0:
+            try:
+                raise KeyError(tax_id)
+            except KeyError:
+                log.exception('Could not find tax_id={tax_id} in the taxonomy tree.'.format(tax_id=tax_id))
+                raise
+
+        return i
+
+    def __contains__(self, tax_id):
+        try:
+            return (self._index[tax_id] if tax_id >= 0 else -1) >= 0
+        except (IndexError, KeyError, TypeError):
+            return False
+
+    def __len__(self):
+        return self.num_nodes
+
+    def __getstate__(self):
+        # Arrays that are memory-mapped from a cache file can't be pickled
+        # (e.g. when sent to worker processes), so they are copied.
+        state = self.__dict__.copy()
+        state.pop('_cache_map', None)
+        for name, value in state.items():
+            if isinstance(value, memoryview):
+                state[name] = array(value.format, value) if value.format != 'B' else bytes(value)
+        return state
+
+    @property
+    def leaves(self):
+        """
+        The tax_ids of all nodes that have no children.
+        """
+        children_offsets = self._children_offsets
+        return set(
+            self._tax_ids[i] for i in range(self.num_nodes)
+            if children_offsets[i] == children_offsets[i + 1])
+
+    @property
+    def byranks(self):
+        """
+        {rank: set(tax_ids of that rank)} for all ranks in nodes.dmp.
+        """
+        byranks = {}
+        for i in range(self.num_nodes):
+            rank = self._rank_names[self._ranks[i]]
+            if rank is None:
+                continue
+            if rank in byranks:
+                byranks[rank].add(self._tax_ids[i])
+            else:
+                byranks[rank] = set([self._tax_ids[i]])
+        return byranks
+
+    def _source_signatures(self):
+        if self.k2d_filename is not None:
+            return {'k2d': file_signature(self.k2d_filename)}
+        return {
+            'nodes': file_signature(self.nodes_filename),
+            'names': file_signature(self.names_filename)}
+
+    def _cache_sections(self):
+        sections = [
+            ('tax_ids', self._tax_ids),
+            ('parents', self._parents),
+            ('depths', self._depths),
+            ('entries', self._entries),
+            ('exits', self._exits),
+            ('rank_codes', self._rank_codes),
+            ('rank_depths', self._rank_depths),
+            ('ranks', self._ranks),
+            ('children_offsets', self._children_offsets),
+            ('children', self._children)]
+
+        # The names are still read from names.dmp, only their index is saved
+        sections.extend(('names_' + name, data) for name, data in self._names_index._index_sections())
+
+        # The tax_id lookup table is saved as well, so it doesn't have to be
+        # rebuilt when loading the cache
+        if not isinstance(self._index, dict):
+            sections.append(('index', self._index))
+
+        return sections
+
+    def save_cache(self, cache_filename):
+        """
+        Saves the taxonomy tree in a compact binary file, that can be loaded
+        by load_cache much faster than parsing names.dmp and nodes.dmp. The
+        file holds the arrays of the tree as they are.
+        """
+        log.info('Saving taxonomy cache to "{cache_file}"...'.format(cache_file=cache_filename))
+        sections = self._cache_sections()
+
+        header = {
+            'version': CACHE_VERSION,
+            'sources': self._source_signatures(),
+            'num_nodes': self.num_nodes,
+            'rank_names': self._rank_names,
+            'pruned_to': self.pruned_to}
+        _write_sections(cache_filename, CACHE_MAGIC, header, sections)
+
+        log.info('Taxonomy cache saved.')
+
+    def load_cache(self, cache_filename):
+        """
+        Loads the taxonomy tree from a cache saved by save_cache. The cache is
+        memory-mapped and the arrays are used straight from the map, so there
+        is next to nothing to do before the tree can be used.
+
+        Returns False (and leaves the tree empty) if the cache doesn't exist,
+        is of the wrong format, or was built from other (or since modified)
+        names.dmp and nodes.dmp files.
+        """
+        if not path.isfile(cache_filename):
+            log.info('Found no taxonomy cache in "{cache_file}".'.format(cache_file=cache_filename))
+            return False
+
+        try:
+            cache_map, header, data = _map_sections(cache_filename, CACHE_MAGIC)
+        except (ValueError, struct.error) as e:
+            log.warning('Could not read the taxonomy cache "{cache_file}" ({error}), will rebuild it.'.format(cache_file=cache_filename, error=e))
+            return False
+
+        if header['version'] != CACHE_VERSION or header['sources'] != self._source_signatures():
+            log.info('The taxonomy cache "{cache_file}" is outdated, will rebuild it.'.format(cache_file=cache_filename))
+            return False
+
+        if header['pruned_to'] != self.pruned_to:
+            log.info('The taxonomy cache "{cache_file}" is of a tree pruned to other tax_ids, will rebuild it.'.format(cache_file=cache_filename))
+            return False
+
+        log.info('Loading taxonomy from cache "{cache_file}"...'.format(cache_file=cache_filename))
+        self._cache_map = cache_map
+        self.num_nodes = header['num_nodes']
+        self._rank_names = header['rank_names']
+        self._tax_ids = data['tax_ids']
+        self._parents = data['parents']
+        self._depths = data['depths']
+        self._entries = data['entries']
+        self._exits = data['exits']
+        self._rank_codes = data['rank_codes']
+        self._rank_depths = data['rank_depths']
+        self._ranks = data['ranks']
+        self._children_offsets = data['children_offsets']
+        self._children = data['children']
+        names_sections = {name[len('names_'):]: data[name] for name in data if name.startswith('names_')}
+        if self.k2d_filename is not None:
+            self._names_index = K2dNamesIndex(self.k2d_filename, names_sections)
+        else:
+            self._names_index = NamesIndex(self.names_filename, names_sections)
+        if 'index' in data:
+            self._index = data['index']
+        else:
+            self._index = self._make_index(self._tax_ids)
+
+        log.info("Taxonomy tree built.")
+        return True
 
     def translate2taxid(self, scientific_names_list):
         """
@@ -192,9 +1053,8 @@ class TaxonomyTree:
         if len(tax_id_dict) != len(scientific_names_list):
             log.warning('You entered duplicated names in the input list for translate2taxid.')
 
-        for tax_id in self.taxonomy:
-            if self.taxonomy[tax_id].name in tax_id_dict:
-                name = self.taxonomy[tax_id].name
+        for tax_id, name in self._names_index.items():
+            if name in tax_id_dict and tax_id in self:
                 tax_id_dict[name].append(tax_id)
             else:
                 # continue search
@@ -202,25 +1062,32 @@ class TaxonomyTree:
 
         return tax_id_dict
 
-
     def _get_property(self, tax_id, property):
         """
-        Internal function to fetch the value of a single property of a namedtuple in the taxonomy dictionary.
+        Internal function to fetch the value of a single property (a field of
+        Node) of a tax_id from the arrays.
         Raises an exception if tax_id does not exist in the taxonomy tree.
         Raises an exception if the taxonomy tree isn't built yet.
         """
-        if self.taxonomy:
+        i = self._get_index(tax_id)
+
+        if property == 'name':
+            property_value = self._names_index.get_name(tax_id)
+        elif property == 'genbank_common_name':
+            property_value = self._names_index.get_common_name(tax_id)
+        elif property == 'rank':
+            property_value = self._rank_names[self._ranks[i]]
+        elif property == 'parent':
+            parent_i = self._parents[i]
+            property_value = self._tax_ids[parent_i] if parent_i >= 0 else None
+        elif property == 'children':
+            property_value = [self._tax_ids[child_i] for child_i in self._children[self._children_offsets[i]:self._children_offsets[i + 1]]]
+        else:
             try:
-                property_value = getattr(self.taxonomy[tax_id], property)
-            except KeyError:
-                log.exception('Could not find tax_id={tax_id} in the taxonomy tree.'.format(tax_id=tax_id))
-                raise
+                raise AttributeError(property)
             except AttributeError:
                 log.exception('There is no such field ("{field}") in the namedtuple.'.format(field=property))
                 raise
-        else:
-            log.exception('You have not built the taxonomy tree yet.')
-            raise TaxonomyTreeException('You have not built the taxonomy tree yet.')
 
         return property_value
 
@@ -275,6 +1142,17 @@ class TaxonomyTree:
             parent_dict[tax_id] = self._get_property(tax_id, 'parent')
         return parent_dict
 
+    def get_depth(self, tax_id_list):
+        """
+        Returns the depth of each tax_id, i.e. the number of edges between the
+        tax_id and the root (the root has depth 0).
+        """
+        self._verify_list(tax_id_list)
+        depth_dict = {}
+        for tax_id in tax_id_list:
+            depth_dict[tax_id] = self._depths[self._get_index(tax_id)]
+        return depth_dict
+
     def get_distance(self, tax_id_1, tax_id_2):
         """
         Return the distance between two tax_ids. The distance is defined as
@@ -288,53 +1166,29 @@ class TaxonomyTree:
         All edges between two tax_ids are counted, so the distance between two
         ranks in one part of the tree can be different from that in another
         part of the tree (depending on tree structure).
-        """
-
-        def one_way_distance(tax_id_ancestor, tax_id):
-            """
-            Find the distance (number of steps) between the
-            ancestor (tax_id_ancestor) and the taxon (tax_id).
-            """
 
-            # Lineage of the descendant tax_id (of which ancestor tax_id is part of)
-            lineage = self.get_lineage([tax_id])[tax_id]
-
-            # The indices of both tax_ids in the lineage
-            ancestor_index = lineage.index(tax_id_ancestor)
-            tax_id_index = lineage.index(tax_id)
-
-            distance = tax_id_index - ancestor_index
-
-            return distance
-
-        distance = None
-
-        # Extra calcs to check for distance from self.distances
-        tax_id_small = min(tax_id_1, tax_id_2)
-        tax_id_large = max(tax_id_1, tax_id_2)
-
-        # self.distances is ordered... smallest tax_id always goes first
-        if tax_id_small in self.distances:
-            if tax_id_large in self.distances[tax_id_small]:
-                distance = self.distances[tax_id_small][tax_id_large]
-        else:
-            self.distances[tax_id_small] = {}
-
-        # Do we need to calculate the distance?
-        if distance is None:
-
-            # Lowest common ancestor
-            lca = self.get_lca(tax_id_1, tax_id_2)
-
-            # Sum of distances between both tax_ids and the LCA makes the total distance
-            distance_1 = one_way_distance(lca, tax_id_1)
-            distance_2 = one_way_distance(lca, tax_id_2)
-            distance = distance_1 + distance_2
-
-            # Save distance for faster response next time
-            self.distances[tax_id_small][tax_id_large] = distance
+        The distance is the sum of the depths of the tax_ids minus twice the
+        depth of their lowest common ancestor. Raises TaxonomyTreeException
+        if the tax_ids have no common ancestor.
+        """
+        i = self._get_index(tax_id_1)
+        j = self._get_index(tax_id_2)
+        depths = self._depths
+        return depths[i] + depths[j] - 2 * depths[self._lca(i, j)]
 
-        return distance
+    def get_distances(self, tax_id_pairs):
+        """
+        Batched form of get_distance. Returns the distance for each
+        (tax_id_1, tax_id_2) pair in the input list, in the same order.
+        """
+        self._verify_list(tax_id_pairs)
+        depths = self._depths
+        distances = []
+        for tax_id_1, tax_id_2 in tax_id_pairs:
+            i = self._get_index(tax_id_1)
+            j = self._get_index(tax_id_2)
+            distances.append(depths[i] + depths[j] - 2 * depths[self._lca(i, j)])
+        return distances
 
     def get_rank(self, tax_id_list):
         """
@@ -357,60 +1211,90 @@ class TaxonomyTree:
         of rank 'order' that is closes above it in the lineage. The rank code
         is therefore O, and the depth is 4. So the full rank code is O4.
 
+        The rank codes and depths are calculated for all nodes when the tree
+        is built, so this is a lookup.
+
         Returns a dict of namedtupes, one for each tax_id in the supplied list.
         """
-        rank_dict = self.get_rank(tax_id_list)
+        self._verify_list(tax_id_list)
         rank_code_dict = {}
-        for tax_id in rank_dict:
-            rank = rank_dict[tax_id]
-            rank_code = ''
-            current_node = tax_id
-
-            # Find the rank code for this node or the one above
-            while not rank_code:
-                if rank in translate_rank2code:
-                    rank_code = translate_rank2code[rank]
-                elif current_node == 1:
-                    # Special case for root, as it has rank 'no rank'
-                    rank_code = 'R'
-                else:
-                    current_node = self.get_parent([current_node])[current_node]
-                    rank = self.get_rank([current_node])[current_node]
-
-            rank_depth = self.get_distance(current_node, tax_id)
-            rank_name = self.get_rank([tax_id])[tax_id]
-
-            rank_tuple = Rank(
-                rank_name=rank_name,
-                rank_code=rank_code,
-                rank_depth=rank_depth)
-
-            rank_code_dict[tax_id] = rank_tuple
+        for tax_id in tax_id_list:
+            i = self._get_index(tax_id)
+            rank_code_dict[tax_id] = Rank(
+                rank_name=self._rank_names[self._ranks[i]],
+                rank_code=all_rank_codes[self._rank_codes[i]],
+                rank_depth=self._rank_depths[i])
 
         return rank_code_dict
 
+    def get_formatted_rank_code(self, tax_id_list):
+        """
+        Returns the full rank code of each tax_id as it is written in reports
+        (e.g. 'O4', or 'O' at depth 0). The strings are cached per tax_id.
+        """
+        self._verify_list(tax_id_list)
+        formatted_dict = {}
+        for tax_id in tax_id_list:
+            if tax_id not in self.formatted_rank_codes:
+                i = self._get_index(tax_id)
+                rank_depth = self._rank_depths[i]
+                self.formatted_rank_codes[tax_id] = all_rank_codes[self._rank_codes[i]] + (str(rank_depth) if rank_depth != 0 else '')
+            formatted_dict[tax_id] = self.formatted_rank_codes[tax_id]
+        return formatted_dict
+
     def get_node(self, tax_id_list):
         """
-        Returns the node instances of the supplied tax_ids.
+        Returns node instances (Node) of the supplied tax_ids. The nodes are
+        created from the arrays on each call.
         """
-        #TODO: Use this fnc in other fncs when getting nodes from self.taxonomy
         self._verify_list(tax_id_list)
         node_dict = {}
 
-        if self.taxonomy:
-            for tax_id in tax_id_list:
-                try:
-                    node = self.taxonomy[tax_id]
-                except KeyError:
-                    log.exception('Could not find tax_id={tax_id} in the taxonomy tree.'.format(tax_id=tax_id))
-                    raise
-                node_dict[tax_id] = node
-        else:
-            log.exception('You have not built the taxonomy tree yet.')
-            raise TaxonomyTreeException('You have not built the taxonomy tree yet.')
+        for tax_id in tax_id_list:
+            node_dict[tax_id] = Node(
+                name=self._get_property(tax_id, 'name'),
+                genbank_common_name=self._get_property(tax_id, 'genbank_common_name'),
+                rank=self._get_property(tax_id, 'rank'),
+                parent=self._get_property(tax_id, 'parent'),
+                children=self._get_property(tax_id, 'children'))
 
         return node_dict
 
+    def get_dfs_interval(self, tax_id):
+        """
+        Returns (entry, exit) of the tax_id in the depth first numbering of
+        the tree. The tax_ids in the clade rooted at tax_id are exactly those
+        with entry <= (their entry) < exit.
+        """
+        i = self._get_index(tax_id)
+        return self._entries[i], self._exits[i]
+
+    def get_node_arrays(self):
+        """
+        Returns the arrays of the tree (see the class docstring) as a
+        NodeArrays, for code that works on all nodes at once (e.g. the numpy
+        engine). The arrays are indexed by node index, and index maps tax_ids
+        to node indices: an array indexed by tax_id (-1 for missing tax_ids),
+        or a dict. The arrays must not be modified.
+        """
+        return NodeArrays(
+            index=self._index,
+            tax_ids=self._tax_ids,
+            parents=self._parents,
+            depths=self._depths,
+            entries=self._entries,
+            exits=self._exits)
+
+    def is_ancestor(self, tax_id_ancestor, tax_id):
+        """
+        Returns True if tax_id_ancestor is an ancestor of tax_id, i.e. if
+        tax_id is in the clade rooted at tax_id_ancestor. A tax_id counts as
+        its own ancestor.
+        """
+        ancestor_i = self._get_index(tax_id_ancestor)
+        entry = self._entries[self._get_index(tax_id)]
+        return self._entries[ancestor_i] <= entry < self._exits[ancestor_i]
+
     def get_lineage(self, tax_id_list):
         """
         For each tax_id, returns the input tax_id and the tax_ids of its
@@ -426,11 +1310,11 @@ class TaxonomyTree:
                 continue
 
             lineage = [tax_id]
-            node = self.get_node([tax_id])[tax_id]
+            i = self._parents[self._get_index(tax_id)]
 
-            while node.parent:
-                lineage.append(node.parent)
-                node = self.get_node([node.parent])[node.parent]
+            while i >= 0:
+                lineage.append(self._tax_ids[i])
+                i = self._parents[i]
 
             lineage.reverse()
             lineage_dict[tax_id] = lineage
@@ -453,8 +1337,7 @@ class TaxonomyTree:
         clade_dict = {}
 
         for tax_id in tax_id_list:
-            node = self.get_node([tax_id])[tax_id]
-            children_pool = set(node.children)
+            children_pool = set(self.get_children([tax_id])[tax_id])
             clade = set([tax_id])
             clade.update(children_pool)
 
@@ -464,7 +1347,7 @@ class TaxonomyTree:
                 except KeyError:
                     break
                 else:
-                    new_children = self.get_node([clade_taxon])[clade_taxon].children
+                    new_children = self.get_children([clade_taxon])[clade_taxon]
                     clade.update(new_children)
                     children_pool.update(new_children)
 
@@ -472,6 +1355,46 @@ class TaxonomyTree:
 
         return clade_dict
 
+    def get_clade_counts(self, count_dict):
+        """
+        Sums counts over clades. count_dict maps tax_ids to counts (e.g. the
+        number of reads classified to each tax_id). Returns the sum of the
+        counts in the clade rooted at each of the tax_ids and at each of their
+        ancestors.
+
+        Only the tax_ids in count_dict and their ancestors are visited, so the
+        time it takes depends on the number of tax_ids with counts rather than
+        on the size of the tree. The nodes are summed from the bottom up, in
+        reverse depth first order.
+
+        returns: {tax_id#1: clade count, tax_id#2: clade count, ...}, in depth
+                 first order, i.e. each tax_id comes after its parent, and
+                 siblings come in the same order as in get_children.
+        """
+        parents = self._parents
+        clade_counts = {}
+
+        for tax_id, count in count_dict.items():
+            i = self._get_index(tax_id)
+            clade_counts[i] = count
+
+        # Add the ancestors, up until an ancestor that has already been added
+        for i in list(clade_counts):
+            i = parents[i]
+            while i >= 0 and i not in clade_counts:
+                clade_counts[i] = 0
+                i = parents[i]
+
+        # Children come after their parent in the depth first order, so going
+        # through it in reverse sums the clades from the bottom up
+        order = sorted(clade_counts, key=self._entries.__getitem__)
+        for i in reversed(order):
+            if parents[i] >= 0:
+                clade_counts[parents[i]] += clade_counts[i]
+
+        tax_ids = self._tax_ids
+        return {tax_ids[i]: clade_counts[i] for i in order}
+
     def get_leaves(self, tax_ids=[1]):
         """
         Returns a {tax_id: set(leaf_taxids)} mapping of leaf node tax_ids for
@@ -503,40 +1426,77 @@ class TaxonomyTree:
 
         return clade_dict
 
-    def get_lca(self, tax_id_1, tax_id_2):
+    def build_lca_index(self):
         """
-        Get the tax_id of the lowest common ancestor (LCA) of two tax_ids.
+        Builds the binary lifting table used to find lowest common ancestors:
+        ancestors[k][i] is the index of the 2^k:th ancestor of node i (-1 above
+        the root). Built on the first LCA query if not called before; call it
+        up front to build it once before forking worker processes.
         """
-        lca = None
+        if self._ancestors is not None:
+            return
 
-        # Extra calcs to check for lca from self.lca_mappings
-        tax_id_small = min(tax_id_1, tax_id_2)
-        tax_id_large = max(tax_id_1, tax_id_2)
+        max_depth = max(self._depths) if self.num_nodes else 0
+        ancestors = [array('i', self._parents)]
+        for _ in range(1, max(max_depth.bit_length(), 1)):
+            previous = ancestors[-1]
+            ancestors.append(array('i', [
+                previous[ancestor] if ancestor >= 0 else -1
+                for ancestor in previous]))
 
-        # self.lca_mappings is ordered... smallest tax_id always goes first
-        if tax_id_small in self.lca_mappings:
-            if tax_id_large in self.lca_mappings[tax_id_small]:
-                lca = self.lca_mappings[tax_id_small][tax_id_large]
-        else:
-            self.lca_mappings[tax_id_small] = {}
+        self._ancestors = ancestors
 
-        if lca is None:
-            # Get lineages and convert to sets for fast operation
-            lineages = self.get_lineage([tax_id_1, tax_id_2])
-            lineage_1 = set(lineages[tax_id_1])
-            lineage_2 = set(lineages[tax_id_2])
+    def _lca(self, i, j):
+        """
+        Index of the lowest common ancestor of the nodes with index i and j.
+        Climbs from i in decreasing powers of two, as long as the ancestor
+        reached is not an ancestor of j (tested with the depth first interval
+        index). Raises TaxonomyTreeException if the nodes are in different
+        trees of a forest (e.g. a pruned taxonomy), without a common ancestor.
+        """
+        entries = self._entries
+        exits = self._exits
+        entry_j = entries[j]
 
-            # Get only the common tax_ids between the lineages of tax_id 1 and 2
-            common_lineage = lineage_1.intersection(lineage_2)
+        if entries[i] <= entry_j < exits[i]:
+            return i
 
-            # The LCA will be the tax_id @ index (num(common_taxIDs) - 1)
-            lca = lineages[tax_id_1][len(common_lineage) - 1]
+        if self._ancestors is None:
+            self.build_lca_index()
 
-            # Save LCA for faster response next time
-            self.lca_mappings[tax_id_small][tax_id_large] = lca
+        node = i
+        for ancestors in reversed(self._ancestors):
+            ancestor = ancestors[node]
+            if ancestor >= 0 and not entries[ancestor] <= entry_j < exits[ancestor]:
+                node = ancestor
+
+        lca = self._parents[node]
+        if lca < 0:
+            raise TaxonomyTreeException("The tax_ids '{}' and '{}' have no common ancestor.".format(self._tax_ids[i], self._tax_ids[j]))
 
         return lca
 
+    def get_lca(self, tax_id_1, tax_id_2):
+        """
+        Get the tax_id of the lowest common ancestor (LCA) of two tax_ids.
+        Raises TaxonomyTreeException if they have none (in different trees of
+        a forest).
+        """
+        lca = self._lca(self._get_index(tax_id_1), self._get_index(tax_id_2))
+        return self._tax_ids[lca]
+
+    def get_lcas(self, tax_id_pairs):
+        """
+        Batched form of get_lca. Returns the tax_id of the lowest common
+        ancestor for each (tax_id_1, tax_id_2) pair in the input list, in the
+        same order.
+        """
+        self._verify_list(tax_id_pairs)
+        tax_ids = self._tax_ids
+        return [
+            tax_ids[self._lca(self._get_index(tax_id_1), self._get_index(tax_id_2))]
+            for tax_id_1, tax_id_2 in tax_id_pairs]
+
     def get_clade_rank_taxids(self, tax_ids, rank=None):
         """
         For each clade rooted at the input tax_ids, return all tax_ids that
@@ -658,6 +1618,39 @@ class TaxonomyTree:
         return siblings
 
 
+def build_taxonomy_cache():
+    """
+    Command line entry point to build a taxonomy cache ahead of time, to be
+    used with stringmeup --taxonomy_cache.
+    """
+    parser = argparse.ArgumentParser(
+        prog='stringmeup-build-taxonomy-cache',
+        description='Parse names.dmp and nodes.dmp (or taxo.k2d) once, and save the taxonomy in a binary cache file that StringMeUp loads much faster (see stringmeup --taxonomy_cache).')
+    parser.add_argument(
+        '--names',
+        metavar='FILE',
+        help='Taxonomy names dump file (names.dmp)')
+    parser.add_argument(
+        '--nodes',
+        metavar='FILE',
+        help='Taxonomy nodes dump file (nodes.dmp)')
+    parser.add_argument(
+        '--taxonomy_k2d',
+        metavar='FILE',
+        help='Taxonomy file of the Kraken 2 database (taxo.k2d), instead of --names and --nodes.')
+    parser.add_argument(
+        'cache',
+        metavar='FILE',
+        help='File to save the taxonomy cache in.')
+    args = parser.parse_args()
+
+    if not (args.taxonomy_k2d or (args.names and args.nodes)):
+        parser.error('The taxonomy is required: either --names and --nodes, or --taxonomy_k2d.')
+
+    taxonomy_tree = TaxonomyTree(args.nodes, args.names, k2d_filename=args.taxonomy_k2d)
+    taxonomy_tree.save_cache(args.cache)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--nodes')
@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import logging
+from bisect import bisect_left
+from os import path
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d [%H:%M:%S]')
+log = logging.getLogger(path.basename(__file__))
+
+THRESHOLD_INDEX_VERSION = 1
+
+
+class ThresholdIndexException(Exception):
+    pass
+
+
+class ThresholdIndex:
+    """
+    Number of reads per tax_id as a function of the confidence threshold.
+
+    The tax_id that a read is reclassified to is a step function of the
+    threshold t: with the confidence ladder [(tax_id_0, conf_0), ...,
+    (tax_id_n, conf_n)] (see stringmeup.climb_lineage), the read is at tax_id_r
+    for conf_(r-1) < t <= conf_r (tax_id_0 for all t <= conf_0), and
+    unclassified (tax_id 0) for t > conf_n, the max confidence. Reads that fail
+    the minimum hit groups are unclassified at all t.
+
+    For each tax_id, the index counts how many reads arrive at it and leave it
+    at each threshold:
+        hits_at_node(t) = base + #(arrivals < t) - #(departures < t)
+    where base is the number of reads that are at the tax_id from t = 0. This
+    makes it possible to get hits_at_node for any threshold without any per
+    read data, and indexes made from different files (e.g. lanes) can be
+    merged by adding the counts.
+    """
+
+    def __init__(self, minimum_hit_groups=None):
+        self.minimum_hit_groups = minimum_hit_groups
+        self.num_lines = 0
+
+        # {tax_id: [base, {threshold: #arrivals}, {threshold: #departures}]}
+        self.taxa = {}
+
+        # Sorted thresholds and cumulative counts for queries, per tax_id
+        self._sorted = None
+
+    def _get_taxon(self, tax_id):
+        if tax_id not in self.taxa:
+            self.taxa[tax_id] = [0, {}, {}]
+        return self.taxa[tax_id]
+
+    def add_read(self, ladder, total_kmer_hits, failed_hit_groups):
+        """
+        Adds a read to the index. ladder is the full confidence ladder of the
+        read (up to the root), as a list of (tax_id, clade_kmer_hits).
+        """
+        self._sorted = None
+
+        if failed_hit_groups:
+            self._get_taxon(0)[0] += 1
+            return
+
+        previous_conf = None
+        for tax_id, clade_kmer_hits in ladder:
+            conf = clade_kmer_hits / total_kmer_hits
+            taxon = self._get_taxon(tax_id)
+
+            if previous_conf is None:
+                taxon[0] += 1
+            else:
+                arrivals = taxon[1]
+                arrivals[previous_conf] = arrivals.get(previous_conf, 0) + 1
+
+            departures = taxon[2]
+            departures[conf] = departures.get(conf, 0) + 1
+            previous_conf = conf
+
+        # Above the max confidence, the read is unclassified
+        arrivals = self._get_taxon(0)[1]
+        arrivals[previous_conf] = arrivals.get(previous_conf, 0) + 1
+
+    def merge(self, other):
+        """
+        Adds the counts of another ThresholdIndex to this one.
+        """
+        if other.minimum_hit_groups != self.minimum_hit_groups:
+            raise ThresholdIndexException('Can not merge threshold indexes made with different minimum hit groups ({} and {}).'.format(self.minimum_hit_groups, other.minimum_hit_groups))
+
+        self._sorted = None
+        self.num_lines += other.num_lines
+
+        for tax_id, (base, other_arrivals, other_departures) in other.taxa.items():
+            taxon = self._get_taxon(tax_id)
+            taxon[0] += base
+            for counts, other_counts in ((taxon[1], other_arrivals), (taxon[2], other_departures)):
+                for threshold, count in other_counts.items():
+                    counts[threshold] = counts.get(threshold, 0) + count
+
+    def _sort(self):
+        def cumulative(counts):
+            thresholds = sorted(counts)
+            cumulative_counts = [0]
+            for threshold in thresholds:
+                cumulative_counts.append(cumulative_counts[-1] + counts[threshold])
+            return thresholds, cumulative_counts
+
+        self._sorted = {
+            tax_id: (base, cumulative(arrivals), cumulative(departures))
+            for tax_id, (base, arrivals, departures) in self.taxa.items()}
+
+    def hits_at_node(self, threshold):
+        """
+        Returns {tax_id: number of reads reclassified to tax_id} at the
+        confidence threshold, the same as the hits_at_node counts of a run
+        with that threshold. tax_id 0 holds the reads that were classified in
+        the input but are unclassified at the threshold.
+        """
+        if self._sorted is None:
+            self._sort()
+
+        hits_at_node = {}
+        for tax_id, (base, (arrival_thresholds, arrival_counts), (departure_thresholds, departure_counts)) in self._sorted.items():
+            hits = base \
+                + arrival_counts[bisect_left(arrival_thresholds, threshold)] \
+                - departure_counts[bisect_left(departure_thresholds, threshold)]
+            if hits:
+                hits_at_node[tax_id] = hits
+
+        return hits_at_node
+
+    def save(self, filename):
+        """
+        Saves the index as JSON (gzipped if filename ends with .gz).
+        """
+        content = {
+            'version': THRESHOLD_INDEX_VERSION,
+            'minimum_hit_groups': self.minimum_hit_groups,
+            'num_lines': self.num_lines,
+            'taxa': [
+                [tax_id, base, list(arrivals.items()), list(departures.items())]
+                for tax_id, (base, arrivals, departures) in self.taxa.items()]}
+
+        opener = gzip.open if filename.endswith('.gz') else open
+        with opener(filename, 'wt') as f:
+            json.dump(content, f)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Loads an index saved with save().
+        """
+        opener = gzip.open if filename.endswith('.gz') else open
+        try:
+            with opener(filename, 'rt') as f:
+                content = json.load(f)
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            raise ThresholdIndexException('Could not read the threshold index "{}" ({}).'.format(filename, e))
+
+        if not isinstance(content, dict) or content.get('version') != THRESHOLD_INDEX_VERSION:
+            raise ThresholdIndexException('"{}" is not a threshold index of a supported version.'.format(filename))
+
+        index = cls(content['minimum_hit_groups'])
+        index.num_lines = content['num_lines']
+        for tax_id, base, arrivals, departures in content['taxa']:
+            index.taxa[tax_id] = [base, dict(arrivals), dict(departures)]
+
+        return index
+
+
+def merge_threshold_indexes():
+    """
+    Command line entry point to merge threshold indexes, e.g. from several
+    lanes of the same sample.
+    """
+    parser = argparse.ArgumentParser(
+        prog='stringmeup-merge-threshold-index',
+        description='Merge threshold indexes saved with stringmeup --output_threshold_index into one.')
+    parser.add_argument(
+        'output',
+        metavar='OUTPUT',
+        help='File to save the merged threshold index in.')
+    parser.add_argument(
+        'inputs',
+        metavar='INPUT',
+        nargs='+',
+        help='Threshold index files to merge.')
+    args = parser.parse_args()
+
+    merged = ThresholdIndex.load(args.inputs[0])
+    for filename in args.inputs[1:]:
+        merged.merge(ThresholdIndex.load(filename))
+
+    merged.save(args.output)
+    log.info('Merged {} threshold indexes into {}.'.format(len(args.inputs), args.output))